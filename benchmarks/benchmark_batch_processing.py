@@ -0,0 +1,97 @@
+"""Benchmarks batched window processing against the per-window path.
+
+Usage:
+  python -m benchmarks.benchmark_batch_processing --num_windows 256
+  python -m benchmarks.benchmark_batch_processing --sensor seismometer \
+    --num_channels 6 --num_samples 6000 --batch_size 64
+"""
+
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from preprocessing import batch_processing
+from preprocessing import parameters
+from preprocessing import process_das
+from preprocessing import process_seismometer
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+def _time(func):
+  start = time.perf_counter()
+  result = func()
+  return result, time.perf_counter() - start
+
+
+def benchmark(sensor, num_windows, batch_size, num_channels, num_samples):
+  """Processes synthetic windows one at a time and in batches.
+
+  Seismometer windows are processed trace by trace, as in
+  `process_seismometer.read_hdf5`.
+
+  Returns:
+    (per-window windows/s, batched windows/s, max absolute difference) tuple.
+  """
+  rng = np.random.default_rng(0)
+  windows = list(rng.standard_normal(
+      (num_windows, num_channels, num_samples)).astype(np.float32))
+  if sensor == 'das':
+    args = (parameters.low_freq, parameters.high_freq, parameters.das_dt,
+            parameters.das_downsampling_factor)
+    process = process_das._process  # pylint: disable=protected-access
+    process_batch = batch_processing.process_das
+  else:
+    args = (parameters.low_freq, parameters.high_freq,
+            parameters.seismometer_dt,
+            parameters.seismometer_downsampling_factor)
+
+    def process(window, *args):
+      return np.stack([process_seismometer._process(trace, *args)  # pylint: disable=protected-access
+                       for trace in window])
+
+    def process_batch(windows, *args):
+      traces = batch_processing.process_seismometer(
+          [trace for window in windows for trace in window], *args)
+      return list(np.stack(traces).reshape((len(windows), num_channels, -1)))
+
+  def per_window():
+    return [process(window, *args) for window in windows]
+
+  def batched():
+    results = []
+    for i in range(0, num_windows, batch_size):
+      results.extend(process_batch(windows[i:i + batch_size], *args))
+    return results
+
+  reference, per_window_time = _time(per_window)
+  result, batched_time = _time(batched)
+  max_diff = max(np.max(np.abs(a - b)) for a, b in zip(result, reference))
+  return num_windows / per_window_time, num_windows / batched_time, max_diff
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sensor', choices=['das', 'seismometer'],
+                      default='das')
+  parser.add_argument('--num_windows', type=int, default=256)
+  parser.add_argument('--batch_size', type=int, default=32)
+  parser.add_argument('--num_channels', type=int, default=620)
+  parser.add_argument('--num_samples', type=int, default=3000)
+  args = parser.parse_args()
+
+  per_window_rate, batched_rate, max_diff = benchmark(
+      args.sensor, args.num_windows, args.batch_size, args.num_channels,
+      args.num_samples)
+  logging.info('Per-window: %.1f windows/s', per_window_rate)
+  logging.info('Batched (batch size %s): %.1f windows/s',
+               args.batch_size, batched_rate)
+  logging.info('Speedup: %.2fx', batched_rate / per_window_rate)
+  logging.info('Max absolute difference: %.3g', max_diff)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,95 @@
+"""Benchmarks loading the catalogs in the fixed and table formats.
+
+The noise catalog is loaded as is, and a synthetic event catalog of
+`--num_events` rows is loaded in full, with a column subset, and with a time
+and magnitude filter that selects about one month of data.
+
+Usage:
+  python -m benchmarks.benchmark_catalog_store --num_events 10000000
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from preprocessing import catalog_store
+from preprocessing import parameters
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+
+def make_catalog(num_events, seed=0):
+  """Creates a synthetic catalog with the columns of the event catalog."""
+  rng = np.random.default_rng(seed)
+  datetime = pd.Timestamp(parameters.starttime) + pd.to_timedelta(
+      np.sort(rng.uniform(0, 1e8, num_events)), unit='s')
+  return pd.DataFrame({
+      'id': np.arange(num_events, dtype=np.int32),
+      'type': rng.choice(['earthquake', 'quarry blast'], num_events,
+                         p=[0.95, 0.05]).astype(object),
+      'focal_time': datetime - pd.to_timedelta(5, unit='s'),
+      'datetime': datetime,
+      'latitude': rng.uniform(37, 38, num_events).astype(np.float32),
+      'longitude': rng.uniform(-123, -121, num_events).astype(np.float32),
+      'magnitude': rng.exponential(0.5, num_events).astype(np.float32),
+      'distance': rng.uniform(0, 1e5, num_events).astype(np.float32),
+      'onset': rng.choice(['emergent', 'impulsive'],
+                          num_events).astype(object),
+  })
+
+
+def _time(name, func):
+  start = time.perf_counter()
+  result = func()
+  logging.info('%s: %s rows in %.3f s.', name, len(result),
+               time.perf_counter() - start)
+  return result
+
+
+def benchmark(catalog_file, label, **filters):
+  _time('{}, full'.format(label),
+        lambda: catalog_store.load_catalog(catalog_file))
+  _time('{}, datetime column'.format(label),
+        lambda: catalog_store.load_catalog(catalog_file,
+                                           columns=['datetime']))
+  if filters:
+    _time('{}, filtered'.format(label),
+          lambda: catalog_store.load_catalog(catalog_file, **filters))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_events', type=int, default=10000000)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    noise_catalog = pd.read_hdf(parameters.noise_catalog, 'df')
+    noise_file = os.path.join(tmp_dir, 'noise_catalog.h5')
+    catalog_store.save_catalog(noise_catalog, noise_file)
+    benchmark(parameters.noise_catalog, 'noise catalog, fixed')
+    benchmark(noise_file, 'noise catalog, table')
+
+    catalog = make_catalog(args.num_events)
+    filters = {
+        'starttime': parameters.starttime,
+        'endtime': parameters.starttime + pd.Timedelta(days=30),
+        'min_magnitude': 1.0,
+    }
+    fixed_file = os.path.join(tmp_dir, 'fixed.h5')
+    table_file = os.path.join(tmp_dir, 'table.h5')
+    _time('write fixed', lambda: catalog.to_hdf(fixed_file, key='df')
+          or catalog)
+    _time('write table', lambda: catalog_store.save_catalog(
+        catalog, table_file) or catalog)
+    benchmark(fixed_file, 'synthetic catalog, fixed', **filters)
+    benchmark(table_file, 'synthetic catalog, table', **filters)
+
+
+if __name__ == '__main__':
+  main()
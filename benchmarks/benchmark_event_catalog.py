@@ -0,0 +1,84 @@
+"""Benchmarks building the event catalog from obspy events.
+
+Usage:
+  python -m benchmarks.benchmark_event_catalog --num_events 1000 2000 4000
+"""
+
+import argparse
+import logging
+import time
+
+from obspy import UTCDateTime
+from obspy.core.event import Amplitude
+from obspy.core.event import Catalog
+from obspy.core.event import Event
+from obspy.core.event import Origin
+from obspy.core.event import Pick
+from obspy.core.event import WaveformStreamID
+
+from preprocessing import create_earthquake_catalog
+from preprocessing import parameters
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+
+def _make_event(i, starttime):
+  """Creates a synthetic event with a pick and a duration."""
+  waveform_id = WaveformStreamID(station_code=parameters.closest_station,
+                                 channel_code=parameters.reference_channel)
+  origin = Origin(time=starttime + 60 * i, latitude=37.4, longitude=-122.2,
+                  depth=5000.0)
+  event = Event(
+      resource_id='quakeml:nc.anss.org/Event/NC/{}'.format(i),
+      event_type='earthquake',
+      origins=[origin],
+      picks=[Pick(time=origin.time + 3, waveform_id=waveform_id,
+                  onset='impulsive', evaluation_mode='manual')],
+      amplitudes=[Amplitude(generic_amplitude=10.0, category='duration',
+                            waveform_id=waveform_id)],
+  )
+  event.preferred_origin_id = origin.resource_id
+  return event
+
+
+def benchmark(num_events, num_windows=10):
+  """Appends `num_events` events split into `num_windows` query windows.
+
+  Returns:
+    Elapsed time (seconds).
+  """
+  starttime = UTCDateTime(parameters.starttime)
+  events = [_make_event(i, starttime) for i in range(num_events)]
+  window_size = -(-num_events // num_windows)
+  obspy_catalogs = [Catalog(events[i:i + window_size])
+                    for i in range(0, num_events, window_size)]
+
+  catalog_builder = create_earthquake_catalog.EventCatalogBuilder(
+      clientcode=None,
+      reference_coordinates=(parameters.stanford_latitude,
+                             parameters.stanford_longitude,
+                             parameters.stanford_elevation),
+      reference_station=parameters.closest_station,
+      reference_channel=parameters.reference_channel)
+  start = time.perf_counter()
+  for obspy_catalog in obspy_catalogs:
+    catalog_builder.append_events_to_catalog(obspy_catalog)
+  assert len(catalog_builder.catalog) == num_events
+  return time.perf_counter() - start
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_events', type=int, nargs='+',
+                      default=[1000, 2000, 4000, 8000])
+  args = parser.parse_args()
+
+  for num_events in args.num_events:
+    elapsed = benchmark(num_events)
+    logging.info('%s events: %.3f s (%.1f us/event)', num_events, elapsed,
+                 elapsed / num_events * 1e6)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,260 @@
+"""Matches detections on continuous data against the event catalog.
+
+Inference on a continuous data file `data_YYYYmmdd_HHMMSS.npy` writes one
+score per sliding window to `data_YYYYmmdd_HHMMSS_logits.npy`. The windows of
+all the files are laid on a single time line, sorted by start time:
+  - a window covers a catalog event if the event time is within the window,
+    extended by the tolerance on each side,
+  - at a given threshold, a detection is a run of consecutive overlapping
+    windows whose scores are all above the threshold,
+  - a detection is true if one of its windows covers an event, and a false
+    alarm otherwise,
+  - an event is matched if one of the windows covering it is above the
+    threshold, and missed otherwise. Events not covered by any window, i.e.
+    outside the continuous data, are left out.
+
+The event times are read from the catalog index, optionally restricted to a
+range of distances to the reference point.
+
+For each event and each pair of consecutive covering windows, the threshold
+above which it is matched or connected only depends on the scores, so all the
+thresholds are evaluated at once by sorting these critical values and
+searching the thresholds in them, in O((N + M + T) log(N + M)) for N windows,
+M events and T thresholds. The sorts make it log-linear rather than linear,
+but the cost no longer grows as the product of T and N + M.
+
+Usage:
+  python -m postprocessing.match_detections \
+      --logits_pattern 'DATAPATH/das/continuous/*_logits.npy' \
+      --window_length 20.48 --overlap 0.5 --output_file results.csv
+"""
+
+import argparse
+import glob
+import logging
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from preprocessing import catalog_index
+from preprocessing import parameters
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+
+_START_TIME_PATTERN = re.compile(r'(\d{8}_\d{6})_logits\.npy$')
+
+
+def get_file_starttime(filename):
+  """Parses the start time of a continuous data file from its name."""
+  match = _START_TIME_PATTERN.search(os.path.basename(filename))
+  if match is None:
+    raise ValueError('Cannot parse the start time of {}.'.format(filename))
+  return pd.to_datetime(match.group(1), format='%Y%m%d_%H%M%S')
+
+
+def load_scores(filename):
+  """Loads the logits of a file as one score per window.
+
+  With one logit per class, the score is the logit of the last class.
+  """
+  logits = np.load(filename)
+  if logits.ndim > 1:
+    logits = logits.reshape((logits.shape[0], -1))[:, -1]
+  return logits.astype(np.float64)
+
+
+def get_windows(logits_files, window_length, stride):
+  """Lays the windows of all the files on a single time line.
+
+  Args:
+    logits_files: Logits files.
+    window_length: Length of a window (seconds).
+    stride: Time between the starts of consecutive windows (seconds).
+
+  Returns:
+    (starts, scores) tuple: window start times (int64 ns) and scores, sorted
+    by start time.
+  """
+  starts = []
+  scores = []
+  for filename in logits_files:
+    file_scores = load_scores(filename)
+    file_start = get_file_starttime(filename).value
+    starts.append(file_start + np.round(
+        np.arange(len(file_scores)) * stride * 1e9).astype(np.int64))
+    scores.append(file_scores)
+  if not starts:
+    return np.empty(0, dtype=np.int64), np.empty(0)
+  starts = np.concatenate(starts)
+  scores = np.concatenate(scores)
+  order = np.argsort(starts, kind='stable')
+  return starts[order], scores[order]
+
+
+def _count_above(values, thresholds):
+  """Counts the values greater than or equal to each threshold."""
+  values = np.sort(values)
+  return len(values) - np.searchsorted(values, thresholds, 'left')
+
+
+def match(window_starts, scores, event_times, window_length, thresholds,
+          tolerance=0.0):
+  """Matches the detections against the events, for many thresholds.
+
+  Args:
+    window_starts: Window start times (int64 ns), sorted.
+    scores: Window scores.
+    event_times: Event times (int64 ns).
+    window_length: Length of a window (seconds).
+    thresholds: Score thresholds.
+    tolerance: Time by which the windows are extended on each side when
+      matching events (seconds).
+
+  Returns:
+    pd.DataFrame with one row per threshold and the columns `threshold`,
+    `detections`, `true_detections`, `false_alarms`, `matched_events`,
+    `missed_events`, `precision` and `recall`.
+
+  Runs in O((N + M + T) log(N + M)) for N windows, M events and T thresholds.
+  """
+  thresholds = np.asarray(thresholds, dtype=np.float64)
+  scores = np.asarray(scores, dtype=np.float64)
+  length = int(round(window_length * 1e9))
+  tolerance = int(round(tolerance * 1e9))
+  event_times = np.sort(np.asarray(event_times, dtype=np.int64))
+
+  # windows covering each event: start in [t - length - tolerance,
+  # t + tolerance]
+  first = np.searchsorted(window_starts, event_times - length - tolerance,
+                          'left')
+  last = np.searchsorted(window_starts, event_times + tolerance, 'right')
+  observed = last > first
+  first, last = first[observed], last[observed]
+  num_events = len(first)
+
+  # an event is matched above the max score of its covering windows
+  # (running max over the window ranges, padded so reduceat is defined)
+  padded = np.append(scores, -np.inf)
+  bounds = np.stack([first, last], axis=1).ravel()
+  event_scores = np.maximum.reduceat(padded, bounds)[::2]
+  matched = _count_above(event_scores, thresholds)
+
+  # windows covering at least one event: +1 at the first covering window of
+  # each event, -1 after the last one
+  coverage = np.zeros(len(scores) + 1, dtype=np.int64)
+  np.add.at(coverage, first, 1)
+  np.add.at(coverage, last, -1)
+  covering = np.cumsum(coverage)[:-1] > 0
+
+  # consecutive windows belong to the same detection if they overlap
+  connected = np.diff(window_starts) <= length
+  # a detection starts at window i if i is above the threshold and i - 1
+  # is not, or is not connected to i
+  previous = np.full(len(scores), -np.inf)
+  previous[1:][connected] = scores[:-1][connected]
+  detections = (_count_above(scores, thresholds) -
+                _count_above(np.minimum(scores, previous), thresholds))
+
+  # true detections: covering windows above the threshold, minus the pairs of
+  # consecutive covering windows that fall in the same detection, i.e. whose
+  # whole range of windows is connected and above the threshold
+  indices = np.flatnonzero(covering)
+  true_detections = _count_above(scores[indices], thresholds)
+  if len(indices) > 1:
+    range_min = np.minimum.reduceat(scores, indices)[:-1]
+    range_min = np.minimum(range_min, scores[indices[1:]])
+    breaks = np.concatenate([[0], np.cumsum(~connected)])
+    range_min[breaks[indices[1:]] != breaks[indices[:-1]]] = -np.inf
+    true_detections -= _count_above(range_min, thresholds)
+
+  false_alarms = detections - true_detections
+  with np.errstate(divide='ignore', invalid='ignore'):
+    precision = np.where(detections > 0, true_detections / detections, np.nan)
+    recall = matched / num_events if num_events else np.full(
+        len(thresholds), np.nan)
+  return pd.DataFrame({
+      'threshold': thresholds,
+      'detections': detections,
+      'true_detections': true_detections,
+      'false_alarms': false_alarms,
+      'matched_events': matched,
+      'missed_events': num_events - matched,
+      'precision': precision,
+      'recall': recall,
+  })
+
+
+def parse_args():
+  """Parse arguments."""
+  parser = argparse.ArgumentParser(
+      description='Matches detections on continuous data against the event '
+      'catalog.')
+  parser.add_argument(
+      '--logits_pattern', type=str, required=True,
+      help='Unix glob pattern of the logits files.')
+  parser.add_argument(
+      '--catalog', type=str, default=parameters.event_catalog,
+      help='Event catalog file.')
+  parser.add_argument(
+      '--time_column', type=str, default='datetime',
+      help='Catalog column holding the event times.')
+  parser.add_argument(
+      '--min_distance', type=float, default=None,
+      help='Minimum distance of the events to the reference point (meters).')
+  parser.add_argument(
+      '--max_distance', type=float, default=None,
+      help='Maximum distance of the events to the reference point (meters).')
+  parser.add_argument(
+      '--window_length', type=float, default=parameters.detect_window_length,
+      help='Length of the sliding windows (seconds).')
+  parser.add_argument(
+      '--overlap', type=float, default=0.0,
+      help='Overlap between consecutive windows, as a fraction of the window '
+      'length.')
+  parser.add_argument(
+      '--tolerance', type=float, default=0.0,
+      help='Time by which the windows are extended on each side when matching '
+      'events (seconds).')
+  parser.add_argument(
+      '--num_thresholds', type=int, default=101,
+      help='Number of thresholds, evenly spaced over the range of scores.')
+  parser.add_argument(
+      '--output_file', type=str, default=None,
+      help='CSV file to which to write the results.')
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+  logits_files = sorted(glob.glob(args.logits_pattern))
+  stride = args.window_length * (1 - args.overlap)
+  window_starts, scores = get_windows(logits_files, args.window_length,
+                                      stride)
+  if not len(scores):
+    raise ValueError('No logits files match {}.'.format(args.logits_pattern))
+  logging.info('Loaded %s windows from %s files.', len(scores),
+               len(logits_files))
+
+  index = catalog_index.CatalogIndex.load_or_build(
+      args.catalog, time_column=args.time_column)
+  tolerance = int(round(args.tolerance * 1e9))
+  end = window_starts[-1] + int(round(args.window_length * 1e9))
+  event_times = index.get_times(
+      window_starts[0] - tolerance, end + tolerance,
+      min_distance=args.min_distance, max_distance=args.max_distance)
+
+  thresholds = np.linspace(scores.min(), scores.max(), args.num_thresholds)
+  results = match(window_starts, scores, event_times, args.window_length,
+                  thresholds, args.tolerance)
+  with pd.option_context('display.max_rows', None):
+    logging.info('Results:\n%s', results.to_string(index=False))
+  if args.output_file:
+    results.to_csv(args.output_file, index=False)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,74 @@
+"""Processing of batches of windows in single calls.
+
+All the event and noise windows are processed with the same parameters, so
+the traces of a batch of windows can be stacked into a single
+(traces, samples) array and filtered along the time axis by one
+processing_utils call, which pays the filter design and the Python call
+overhead once per batch instead of once per window. The traces go through
+the same processing_utils functions as in the per-window path, so the outputs
+are the same.
+"""
+
+import numpy as np
+from processing_utils import processing_utils as processing
+
+
+def apply_to_traces(func, windows, *args):
+  """Applies a function to the traces of many windows at once.
+
+  Args:
+    func: Function that processes each row of a (traces, samples) array
+      along the time axis, such as `processing.bandpass`.
+    windows: List of (samples,) traces or (channels, samples) windows.
+      Windows of different shapes or dtypes are processed in one call per
+      shape and dtype.
+    *args: Additional arguments of `func`.
+
+  Returns:
+    List of the processed windows.
+  """
+  groups = {}
+  for i, window in enumerate(windows):
+    groups.setdefault((window.shape, window.dtype), []).append(i)
+  results = [None] * len(windows)
+  for (shape, _), indices in groups.items():
+    traces = np.stack([windows[i] for i in indices]).reshape(
+        (-1, shape[-1]))
+    traces = func(traces, *args)
+    traces = traces.reshape((len(indices),) + shape[:-1] + traces.shape[-1:])
+    for i, window in zip(indices, traces):
+      results[i] = window
+  return results
+
+
+def process_das(windows, low_freq, high_freq, dt, q):
+  """Batch version of `process_das._process`.
+
+  The median removal applies across the channels of each window, so it is
+  the only step applied window by window.
+
+  Args:
+    windows: List of (channels, samples) raw DAS windows.
+
+  Returns:
+    List of the processed windows.
+  """
+  windows = apply_to_traces(processing.get_strain_rate, windows)
+  windows = [processing.remove_median(window) for window in windows]
+  windows = apply_to_traces(processing.bandpass, windows, low_freq, high_freq,
+                            dt)
+  return apply_to_traces(processing.decimate, windows, q)
+
+
+def process_seismometer(traces, low_freq, high_freq, dt, q):
+  """Batch version of `process_seismometer._process`.
+
+  Args:
+    traces: List of (samples,) raw seismometer traces.
+
+  Returns:
+    List of the processed traces.
+  """
+  traces = apply_to_traces(processing.bandpass, traces, low_freq, high_freq,
+                           dt)
+  return apply_to_traces(processing.decimate, traces, q)
@@ -0,0 +1,204 @@
+"""Time and distance index over the event catalog.
+
+The index answers "which events fall in [t0, t1]", for many intervals at
+once, without loading and sorting the catalog DataFrame:
+  - times: event times as a sorted int64 array (nanoseconds since the epoch),
+    queried with binary searches.
+  - distance: distance of each event to the reference point, in the same
+    order, to restrict the queries to a distance range.
+
+The noise catalog sampling and the matching of continuous data detections
+read their event times from the index. The index is saved as a single .npz
+file next to the catalog and rebuilt only when the catalog file changes, so
+it loads in a few milliseconds.
+
+Usage:
+  python -m preprocessing.catalog_index
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from preprocessing import catalog_store
+from preprocessing import ledger
+from preprocessing import parameters
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+_ARRAYS = ('times', 'rows', 'distance')
+
+
+def _to_nanoseconds(times):
+  """Converts time stamps of any pandas-compatible type to int64 ns."""
+  return pd.to_datetime(np.atleast_1d(times)).to_numpy(
+      dtype='datetime64[ns]').astype(np.int64)
+
+
+def _source_fingerprint(catalog_file, time_column):
+  stat = os.stat(catalog_file)
+  return ledger.fingerprint({
+      'catalog_file': os.path.abspath(catalog_file),
+      'size': stat.st_size,
+      'mtime': stat.st_mtime_ns,
+      'time_column': time_column,
+  })
+
+
+def get_index_file(catalog_file):
+  """Gets the default index file of a catalog file."""
+  return '{}_index.npz'.format(os.path.splitext(catalog_file)[0])
+
+
+class CatalogIndex():
+  """Time index over the rows of an event catalog.
+
+  Attr:
+    times: Sorted event times (int64 ns). Rows without time are left out.
+    rows: Row positions of `times` in the catalog, to be used with
+      `catalog.iloc`.
+    distance: Distances to the reference point (meters) of the events of
+      `times`, NaN if unknown.
+    source: Fingerprint of the catalog file the index was built from.
+  """
+
+  def __init__(self, times, rows, distance, source=''):
+    self.times = times
+    self.rows = rows
+    self.distance = distance
+    self.source = source
+
+  def __len__(self):
+    return len(self.times)
+
+  @classmethod
+  def from_catalog(cls, catalog, time_column='datetime', source=''):
+    """Builds the index of a catalog DataFrame.
+
+    Args:
+      catalog: Event catalog.
+      time_column: Column holding the event times, e.g. 'datetime' for the
+        arrival at the reference station or 'focal_time'.
+      source: Fingerprint of the catalog file.
+    """
+    times = catalog[time_column].to_numpy(dtype='datetime64[ns]')
+    rows = np.flatnonzero(~np.isnat(times))
+    times = times[rows].astype(np.int64)
+    order = np.argsort(times, kind='stable')
+    rows = rows[order]
+    if 'distance' in catalog:
+      distance = catalog['distance'].to_numpy(dtype=np.float64)[rows]
+    else:
+      distance = np.full(len(rows), np.nan)
+    return cls(times[order], rows, distance, source)
+
+  @classmethod
+  def load(cls, filename):
+    with np.load(filename) as f:
+      return cls(*[f[name] for name in _ARRAYS], source=str(f['source']))
+
+  def save(self, filename):
+    """Saves the index, atomically."""
+    with ledger.atomic_output(filename) as tmp_filename:
+      with open(tmp_filename, 'wb') as f:
+        np.savez(f, source=self.source,
+                 **{name: getattr(self, name) for name in _ARRAYS})
+
+  @classmethod
+  def load_or_build(cls, catalog_file, index_file=None,
+                    time_column='datetime'):
+    """Loads the index of a catalog file, rebuilding it if out of date.
+
+    Args:
+      catalog_file: Event catalog file.
+      index_file: Index file. Defaults to `get_index_file(catalog_file)`.
+      time_column: Column holding the event times.
+    """
+    if index_file is None:
+      index_file = get_index_file(catalog_file)
+    source = _source_fingerprint(catalog_file, time_column)
+    if os.path.isfile(index_file):
+      index = cls.load(index_file)
+      if index.source == source:
+        return index
+    logging.info('Building catalog index: %s', index_file)
+    index = cls.from_catalog(catalog_store.load_catalog(catalog_file),
+                             time_column, source)
+    index.save(index_file)
+    return index
+
+  def _search_intervals(self, starts, ends):
+    left = np.searchsorted(self.times, _to_nanoseconds(starts), 'left')
+    right = np.searchsorted(self.times, _to_nanoseconds(ends), 'right')
+    return left, np.maximum(right, left)
+
+  def count_intervals(self, starts, ends):
+    """Counts the events in each [start, end] time interval.
+
+    Args:
+      starts, ends: Arrays of interval bounds, included.
+
+    Returns:
+      int64 array of event counts, one per interval.
+    """
+    left, right = self._search_intervals(starts, ends)
+    return right - left
+
+  def query_intervals(self, starts, ends):
+    """Finds the events in each [start, end] time interval.
+
+    Args:
+      starts, ends: Arrays of interval bounds, included.
+
+    Returns:
+      (offsets, rows) tuple: the catalog rows of the events of the i-th
+      interval are rows[offsets[i]:offsets[i + 1]], in time order.
+    """
+    left, right = self._search_intervals(starts, ends)
+    counts = right - left
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    positions = (np.repeat(left - offsets[:-1], counts) +
+                 np.arange(offsets[-1]))
+    return offsets, self.rows[positions]
+
+  def get_times(self, starttime=None, endtime=None, min_distance=None,
+                max_distance=None):
+    """Gets the sorted times of the events that match the filters.
+
+    Args:
+      starttime, endtime: Time bounds, included.
+      min_distance, max_distance: Bounds of the distance to the reference
+        point (meters), included. Events of unknown distance are left out if
+        either bound is set.
+
+    Returns:
+      int64 array of event times (ns).
+    """
+    left, right = 0, len(self.times)
+    if starttime is not None:
+      left = np.searchsorted(self.times, _to_nanoseconds(starttime)[0],
+                             'left')
+    if endtime is not None:
+      right = max(left, np.searchsorted(
+          self.times, _to_nanoseconds(endtime)[0], 'right'))
+    times = self.times[left:right]
+    distance = self.distance[left:right]
+    mask = np.ones(len(times), dtype=bool)
+    if min_distance is not None:
+      mask &= distance >= min_distance
+    if max_distance is not None:
+      mask &= distance <= max_distance
+    return times[mask]
+
+
+def main():
+  """Builds the index of the event catalog."""
+  index = CatalogIndex.load_or_build(parameters.event_catalog)
+  logging.info('Indexed %s events.', len(index))
+
+
+if __name__ == '__main__':
+  main()
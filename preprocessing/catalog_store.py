@@ -0,0 +1,136 @@
+"""Columnar storage of the event and noise catalogs.
+
+The catalogs are stored as queryable pandas HDF5 tables:
+  - times are datetime64 columns, stored as int64 nanoseconds,
+  - string columns with few distinct values are categoricals,
+  - times, magnitudes and distances are data columns, so time, magnitude and
+    distance filters are evaluated by PyTables and only the matching rows are
+    read. The time columns are also indexed.
+
+Catalogs written in the fixed format by earlier versions are still read, and
+filtered in memory. Running this module converts the catalogs in place.
+
+Usage:
+  python -m preprocessing.catalog_store
+"""
+
+import logging
+
+import pandas as pd
+
+from preprocessing import ledger
+from preprocessing import parameters
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+
+_KEY = 'df'
+_TIME_COLUMNS = ('focal_time', 'arrival_time', 'datetime')
+_CATEGORICAL_COLUMNS = ('type', 'onset', 'evaluation_mode',
+                        'evaluation_status')
+_DATA_COLUMNS = _TIME_COLUMNS + ('magnitude', 'distance')
+
+
+def _to_storage_types(catalog):
+  """Converts the time and categorical columns to their storage types."""
+  catalog = catalog.copy()
+  for column in _TIME_COLUMNS:
+    if column in catalog:
+      catalog[column] = pd.to_datetime(catalog[column]).astype(
+          'datetime64[ns]')
+  for column in _CATEGORICAL_COLUMNS:
+    if column in catalog:
+      catalog[column] = catalog[column].astype('category')
+  return catalog
+
+
+def is_table(filename):
+  """Checks whether a catalog file is in the queryable table format."""
+  with pd.HDFStore(filename, 'r') as store:
+    return store.get_storer(_KEY).is_table
+
+
+def save_catalog(catalog, filename):
+  """Saves a catalog in the table format, atomically.
+
+  Args:
+    catalog (pd.DataFrame): event or noise catalog.
+    filename (str): catalog file.
+  """
+  catalog = _to_storage_types(catalog)
+  data_columns = [column for column in _DATA_COLUMNS if column in catalog]
+  time_columns = [column for column in _TIME_COLUMNS if column in catalog]
+  with ledger.atomic_output(filename) as tmp_filename:
+    catalog.to_hdf(tmp_filename, key=_KEY, mode='w', format='table',
+                   data_columns=data_columns, index=False)
+    # indexing dominates the write time, so only the time columns, which
+    # the most selective filters apply to, are indexed
+    with pd.HDFStore(tmp_filename) as store:
+      store.create_table_index(_KEY, columns=time_columns)
+
+
+def load_catalog(filename, columns=None, starttime=None, endtime=None,
+                 time_column='datetime', min_magnitude=None,
+                 max_magnitude=None, min_distance=None, max_distance=None):
+  """Loads the rows and columns of a catalog that match the filters.
+
+  With the table format, the filters are evaluated by PyTables on the data
+  columns, so the rows that do not match are never read.
+
+  Args:
+    filename (str): catalog file.
+    columns (list of str): columns to load, all by default.
+    starttime (datetime): minimum time, included.
+    endtime (datetime): maximum time, excluded.
+    time_column (str): column the time filter applies to.
+    min_magnitude, max_magnitude (float): magnitude bounds, included.
+    min_distance, max_distance (float): bounds of the distance to the
+      reference point (meters), included.
+
+  Returns:
+    pd.DataFrame: the matching rows, with their original index.
+  """
+  bounds = [
+      (time_column, '>=', None if starttime is None else pd.Timestamp(
+          starttime)),
+      (time_column, '<', None if endtime is None else pd.Timestamp(endtime)),
+      ('magnitude', '>=', min_magnitude),
+      ('magnitude', '<=', max_magnitude),
+      ('distance', '>=', min_distance),
+      ('distance', '<=', max_distance),
+  ]
+  bounds = [(column, op, value) for column, op, value in bounds
+            if value is not None]
+
+  if is_table(filename):
+    where = ['{} {} {!r}'.format(column, op, str(value)
+                                 if isinstance(value, pd.Timestamp)
+                                 else float(value))
+             for column, op, value in bounds]
+    return pd.read_hdf(filename, _KEY, where=where or None, columns=columns)
+
+  # fixed format: read everything and filter in memory
+  catalog = _to_storage_types(pd.read_hdf(filename, _KEY))
+  mask = pd.Series(True, index=catalog.index)
+  for column, op, value in bounds:
+    values = catalog[column]
+    mask &= {'>=': values >= value, '<=': values <= value,
+             '<': values < value}[op]
+  catalog = catalog[mask]
+  if columns is not None:
+    catalog = catalog[columns]
+  return catalog
+
+
+def main():
+  """Converts the event and noise catalogs to the table format."""
+  for filename in (parameters.event_catalog, parameters.noise_catalog):
+    if is_table(filename):
+      continue
+    logging.info('Converting catalog to the table format: %s', filename)
+    save_catalog(load_catalog(filename), filename)
+
+
+if __name__ == '__main__':
+  main()
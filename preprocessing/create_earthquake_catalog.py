@@ -1,21 +1,41 @@
 """Creates seismic event catalog using the Obspy client."""
+import concurrent.futures
 import datetime as dt
+import hashlib
+import json
 import logging
+import os
 import re
+import sys
+import threading
 from typing import Text, Tuple
 
 import numpy as np
+from obspy import Catalog
+from obspy import read_events
+from obspy import UTCDateTime
 from obspy.clients.fdsn import Client
-from obspy.geodetics.base import gps2dist_azimuth
+from obspy.clients.fdsn.header import FDSNNoDataException
 import pandas as pd
 from scipy.optimize import curve_fit
 
+from preprocessing import catalog_store
+from preprocessing import geodetics
 from preprocessing import parameters
 
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
 
+_COLUMNS = ['id', 'type',
+            'focal_time', 'datetime',
+            'magnitude', 'distance', 'azimuth',
+            'latitude', 'longitude', 'depth',
+            'arrival_time', 'velocity_estimate', 'duration',
+            'onset', 'evaluation_mode', 'evaluation_status',
+            ]
+
+
 class EventCatalogBuilder():
   """Class for creating a catalog of local seismic events."""
 
@@ -29,25 +49,39 @@ class EventCatalogBuilder():
     """Initialization.
 
     Args:
-        clientcode: Obspy client code.
+        clientcode: Obspy client code, or None to only build a catalog from
+            events that were already downloaded.
         reference_coordinates: (longitude, latitude, altitude)
             coordinates to be used for the radius search.
         reference_station: reference station code.
         reference_channel: reference channel code.
     """
-    self.client = Client(clientcode)
-    self.catalog = pd.DataFrame(
-        columns=['id', 'type',
-                 'focal_time', 'datetime',
-                 'magnitude', 'distance', 'azimuth',
-                 'latitude', 'longitude', 'depth',
-                 'arrival_time', 'velocity_estimate', 'duration',
-                 'onset', 'evaluation_mode', 'evaluation_status',
-                 ])
+    self.client = Client(clientcode) if clientcode else None
+    self._catalog = pd.DataFrame(columns=_COLUMNS)
+    # catalog chunks not yet concatenated to the catalog
+    self._pending = []
     self.reference_coordinates = reference_coordinates
     self.station = reference_station
     self.channel = reference_channel
 
+  @property
+  def catalog(self):
+    """Catalog dataframe.
+
+    The chunks appended by `append_events_to_catalog` are concatenated once,
+    the next time the catalog is accessed.
+    """
+    if self._pending:
+      frames = [self._catalog] if len(self._catalog) else []
+      self._catalog = pd.concat(frames + self._pending, ignore_index=True)
+      self._pending = []
+    return self._catalog
+
+  @catalog.setter
+  def catalog(self, catalog):
+    self._catalog = catalog
+    self._pending = []
+
   def _get_preferred_pick(self, event):
     """Wrapper to parse event picks."""
     selected_pick = None
@@ -73,80 +107,181 @@ class EventCatalogBuilder():
   def append_events_to_catalog(self, obspy_catalog):
     """Append the events from obspy_catalog to the catalog.
 
+    The event attributes are accumulated column by column and converted into
+    a single dataframe chunk, instead of appending to the catalog dataframe
+    one event at a time, which copies the whole catalog for every event.
+
     Args:
         obspy_catalog (obspy.core.event.Catalog): Obspy container for events.
     """
+    columns = {name: [] for name in _COLUMNS}
     for event in obspy_catalog:
       origin = event.preferred_origin()
       pick = self._get_preferred_pick(event)
-      self.catalog = self.catalog.append(
-          {
-              'id': _get_id(event),
-              'type': event.event_type,
-              'focal_time': origin.time.datetime,
-              'magnitude': _get_magnitude(event),
-              'latitude': origin.latitude,
-              'longitude': origin.longitude,
-              'depth': origin.depth,
-              'arrival_time': pick.time.datetime if pick else None,
-              'duration': self._get_duration(event),
-              'onset': pick.onset if pick else None,
-              'evaluation_mode': pick.evaluation_mode if pick else None,
-              'evaluation_status': pick.evaluation_status if pick else None,
-          },
-          ignore_index=True)
+      columns['id'].append(_get_id(event))
+      columns['type'].append(event.event_type)
+      columns['focal_time'].append(origin.time.datetime)
+      columns['datetime'].append(None)
+      columns['magnitude'].append(_get_magnitude(event))
+      columns['distance'].append(None)
+      columns['azimuth'].append(None)
+      columns['latitude'].append(origin.latitude)
+      columns['longitude'].append(origin.longitude)
+      columns['depth'].append(origin.depth)
+      columns['arrival_time'].append(pick.time.datetime if pick else None)
+      columns['velocity_estimate'].append(None)
+      columns['duration'].append(self._get_duration(event))
+      columns['onset'].append(pick.onset if pick else None)
+      columns['evaluation_mode'].append(
+          pick.evaluation_mode if pick else None)
+      columns['evaluation_status'].append(
+          pick.evaluation_status if pick else None)
+    if columns['id']:
+      self._pending.append(pd.DataFrame(columns, columns=_COLUMNS))
 
   def _get_distance_azimuth(self, latitude, longitude, depth):
-    """Compute distance and azimuth."""
+    """Compute distance and azimuth, for scalars or arrays."""
     ref_latitude, ref_longitude, ref_elevation = self.reference_coordinates
-    flat_distance, azimuth, _ = gps2dist_azimuth(
+    flat_distance, azimuth = geodetics.distance_azimuth(
         ref_latitude, ref_longitude, latitude, longitude)
     distance = np.sqrt(flat_distance**2 + (-depth - ref_elevation)**2)
     return distance, azimuth
 
-  def _fill_datetime(self):
-    """Fill catalog with computed arrival times."""
+  def _fill_datetime(self, rows):
+    """Fill catalog with computed arrival times.
+
+    Args:
+        rows (np.ndarray): boolean mask of the rows to fill.
+    """
     # for earthquakes, we approximate velocity as a linear function of distance
     # pylint: disable=invalid-name
     def _func(x, a, b):
       return a * x + b
 
-    earthquakes = self.catalog[self.catalog.type == 'earthquake']
+    catalog = self.catalog
+    earthquakes = catalog[catalog.type == 'earthquake']
     earthquakes = earthquakes[earthquakes.velocity_estimate > 0]
     coef, _ = curve_fit(_func, earthquakes.distance,
                         earthquakes.velocity_estimate)
 
     # for quarry blasts, we take the mean velocity
-    quarry_blasts = self.catalog[self.catalog.type == 'quarry blast']
+    quarry_blasts = catalog[catalog.type == 'quarry blast']
     quarry_blast_velocity = np.mean(quarry_blasts.velocity_estimate)
 
-    for i in range(len(self.catalog)):
-      if self.catalog.at[i, 'type'] == 'quarry blast':
-        time_lag = self.catalog.at[i, 'distance'] / quarry_blast_velocity
-      else:
-        velocity = _func(self.catalog.at[i, 'distance'], *coef)
-        time_lag = self.catalog.at[i, 'distance'] / velocity
-      self.catalog.at[i, 'datetime'] = (
-          self.catalog.at[i, 'focal_time'] + dt.timedelta(seconds=time_lag))
-
-  def fill_computed_columns(self):
-    """Fills in computed values."""
-    for i in range(len(self.catalog)):
-      distance, azimuth = self._get_distance_azimuth(
-          self.catalog.at[i, 'latitude'],
-          self.catalog.at[i, 'longitude'],
-          self.catalog.at[i, 'depth'])
-      self.catalog.at[i, 'distance'] = distance
-      self.catalog.at[i, 'azimuth'] = azimuth
-
-      focal_time = self.catalog.at[i, 'focal_time']
-      arrival_time = self.catalog.at[i, 'arrival_time']
-      velocity = _get_velocity(distance, focal_time, arrival_time)
-      self.catalog.at[i, 'velocity_estimate'] = velocity
-
-    self._fill_datetime()
-
-  def create_event_catalog(self, starttime, endtime, maxradius):
+    distance = catalog['distance'].to_numpy(dtype=np.float64)[rows]
+    velocity = np.where(catalog['type'][rows] == 'quarry blast',
+                        quarry_blast_velocity, _func(distance, *coef))
+    time_lag = pd.to_timedelta(distance / velocity, unit='s')
+    datetime = _get_column(catalog, 'datetime', 'datetime64[ns]')
+    datetime[rows] = _to_datetime64(catalog['focal_time'][rows]) + time_lag
+    catalog['datetime'] = datetime
+
+  def fill_computed_columns(self, rows=None):
+    """Fills in computed values.
+
+    The columns are computed for all the rows at once, so they can be cheaply
+    recomputed for the whole catalog, e.g. after changing
+    `reference_coordinates`.
+
+    Args:
+        rows (np.ndarray): boolean mask of the rows to fill, e.g. the new
+            events of an update. Defaults to all the rows.
+    """
+    catalog = self.catalog
+    if rows is None:
+      rows = np.ones(len(catalog), dtype=bool)
+    if not rows.any():
+      return
+    distance, azimuth = self._get_distance_azimuth(
+        catalog['latitude'].to_numpy(dtype=np.float64)[rows],
+        catalog['longitude'].to_numpy(dtype=np.float64)[rows],
+        catalog['depth'].to_numpy(dtype=np.float64)[rows])
+    velocity = _get_velocity(distance, catalog['focal_time'][rows],
+                             catalog['arrival_time'][rows])
+    for name, values in [('distance', distance), ('azimuth', azimuth),
+                         ('velocity_estimate', velocity)]:
+      column = _get_column(catalog, name, np.float64)
+      column[rows] = values
+      catalog[name] = column
+
+    self._fill_datetime(rows)
+
+  def _get_events(self, starttime, endtime, maxradius, cache_dir=None):
+    """Pulls the events of a time window, through the on-disk cache.
+
+    The raw QuakeML responses are cached under a key of the query parameters.
+    Windows that end in the future are not cached, since more events may
+    still be added to them.
+
+    Returns:
+        obspy.core.event.Catalog: the events of the time window.
+    """
+    reference_latitude, reference_longitude, _ = self.reference_coordinates
+    query = dict(
+        starttime=UTCDateTime(starttime),
+        endtime=UTCDateTime(endtime),
+        includearrivals=True,
+        latitude=reference_latitude,
+        longitude=reference_longitude,
+        minradius=0,
+        maxradius=maxradius,
+        orderby='time-asc')
+    if cache_dir is None or endtime > _utcnow():
+      logging.info('Pulling events from %s to %s...', starttime, endtime)
+      try:
+        return self.client.get_events(**query)
+      except FDSNNoDataException:
+        return Catalog()
+
+    key = hashlib.sha256(json.dumps(
+        dict(query, base_url=self.client.base_url), sort_keys=True,
+        default=str).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, '{}.xml'.format(key))
+    if not os.path.isfile(cache_file):
+      logging.info('Pulling events from %s to %s...', starttime, endtime)
+      os.makedirs(cache_dir, exist_ok=True)
+      tmp_file = '{}.tmp{}'.format(cache_file, threading.get_ident())
+      try:
+        self.client.get_events(filename=tmp_file, **query)
+      except FDSNNoDataException:
+        return Catalog()
+      os.replace(tmp_file, cache_file)
+    else:
+      logging.info('Reading cached events from %s to %s...',
+                   starttime, endtime)
+    return read_events(cache_file, format='QUAKEML')
+
+  def _pull_events(self, starttime, endtime, maxradius, n_threads, cache_dir):
+    """Pulls events between starttime and endtime into the catalog."""
+    # The obspy client times out when pulling too many events at the same time,
+    # so we divide the server calls into shorter time windows.
+    time_windows = _split_into_time_windows(starttime, endtime)
+
+    def get_events(time_window):
+      return self._get_events(*time_window, maxradius, cache_dir)
+
+    # map returns the windows in order, while at most n_threads requests are
+    # in flight
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+      for obspy_catalog in executor.map(get_events, time_windows):
+        self.append_events_to_catalog(obspy_catalog)
+
+  def _finalize(self, existing=None):
+    """Deduplicates and sorts the events, and fills in the computed columns
+    of the events pulled after the rows of the `existing` catalog."""
+    num_existing = 0 if existing is None else len(existing)
+    self.catalog = self.catalog.drop_duplicates(subset='id', keep='last')
+    self.catalog = self.catalog.sort_values(by=['focal_time'])
+    new_rows = self.catalog.index.to_numpy() >= num_existing
+    self.catalog = self.catalog.reset_index(drop=True)
+    self.fill_computed_columns(new_rows)
+    if existing is not None:
+      _fill_existing_columns(self.catalog, existing, new_rows)
+    logging.info('Found %s events, %s new.', len(self.catalog),
+                 new_rows.sum())
+
+  def create_event_catalog(self, starttime, endtime, maxradius, n_threads=1,
+                           cache_dir=None):
     """Calls the obspy client to create a seismic event catalog.
     The events are pulled within maxradius from the reference point.
     The catalog is stored in a dataframe.
@@ -156,31 +291,66 @@ class EventCatalogBuilder():
         endtime (datetime): end of query time window.
         maxradius (float): limit query to events within the specified maximum
             number of longitude/latitude degrees from the reference point.
+        n_threads (int): maximum number of concurrent requests.
+        cache_dir (str): directory in which to cache the raw responses.
     """
-    # The obspy client times out when pulling too many events at the same time,
-    # so we divide the server calls into shorter time windows.
-    time_windows = _split_into_time_windows(starttime, endtime)
+    self._pull_events(starttime, endtime, maxradius, n_threads, cache_dir)
+    self._finalize()
 
-    reference_latitude, reference_longitude, _ = self.reference_coordinates
-    for (window_starttime, window_endtime) in time_windows:
-      logging.info('Pulling events from %s to %s...',
-                   window_starttime, window_endtime)
-      obspy_catalog = self.client.get_events(
-          starttime=window_starttime,
-          endtime=window_endtime,
-          includearrivals=True,
-          latitude=reference_latitude,
-          longitude=reference_longitude,
-          minradius=0,
-          maxradius=maxradius,
-          orderby='time-asc')
-      self.append_events_to_catalog(obspy_catalog)
+  def update_event_catalog(self, catalog, endtime, maxradius, n_threads=1,
+                           cache_dir=None):
+    """Updates an existing catalog with the events that occurred since.
 
-    self.fill_computed_columns()
+    Only the time windows after the last focal time in the existing catalog
+    are pulled. Events already in the catalog are replaced by their new
+    version, based on their id. The computed columns are only filled in for
+    the pulled events, so those of the other events are left unchanged.
+    The other columns of the existing catalog, e.g. `has_das_data`, are
+    carried over for the replaced events and filled with defaults for the
+    others, and all the columns keep their dtypes.
 
-    self.catalog.sort_values(by=['focal_time'])
+    Args:
+        catalog (pd.DataFrame): existing catalog.
+        endtime (datetime): end of query time window.
+        maxradius (float): limit query to events within the specified maximum
+            number of longitude/latitude degrees from the reference point.
+        n_threads (int): maximum number of concurrent requests.
+        cache_dir (str): directory in which to cache the raw responses.
+    """
+    self.catalog = catalog.reset_index(drop=True)
+    starttime = pd.Timestamp(catalog['focal_time'].max()).to_pydatetime()
+    self._pull_events(starttime, endtime, maxradius, n_threads, cache_dir)
+    self._finalize(existing=catalog)
 
-    logging.info('Found %s events.', len(self.catalog))
+
+def _fill_existing_columns(catalog, existing, rows):
+  """Fills the columns of the existing catalog in the pulled rows.
+
+  The columns that are not pulled, e.g. the data availability flags, are
+  copied from the existing event with the same id if any, and otherwise set
+  to False for boolean columns and left missing for the others. The columns
+  are then cast back to their dtypes in the existing catalog, except the
+  categoricals, whose categories may have grown.
+
+  Args:
+      catalog (pd.DataFrame): updated catalog, modified in place.
+      existing (pd.DataFrame): catalog before the update.
+      rows (np.ndarray): boolean mask of the pulled rows of `catalog`.
+  """
+  previous = existing.drop_duplicates(subset='id', keep='last').set_index('id')
+  for name, dtype in existing.dtypes.items():
+    if name not in _COLUMNS:
+      values = (catalog[name].astype(object) if name in catalog
+                else pd.Series(None, index=catalog.index, dtype=object))
+      missing = rows & values.isna().to_numpy()
+      values[missing] = catalog['id'][missing].map(
+          previous[name]).astype(object).to_numpy()
+      if dtype.kind == 'b':
+        values[values.isna()] = False
+      catalog[name] = values
+    if dtype.kind in 'bfM' or (dtype.kind in 'iu' and
+                               catalog[name].notna().all()):
+      catalog[name] = catalog[name].astype(dtype)
 
 
 def _split_into_time_windows(starttime, endtime, interval=6 * 30):
@@ -230,16 +400,66 @@ def _get_magnitude(event):
   return event.preferred_magnitude().mag
 
 
+def _utcnow():
+  """Current UTC time, as a naive datetime like the catalog times."""
+  return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+def _get_last_complete_day():
+  """Start of the current UTC day, i.e. the end of the last day whose events
+  are all published."""
+  now = _utcnow()
+  return dt.datetime(now.year, now.month, now.day)
+
+
+def _get_column(catalog, name, dtype):
+  """Copies a column to an array, filled with missing values if absent."""
+  if name not in catalog:
+    return np.full(len(catalog), np.nan).astype(dtype)
+  if np.dtype(dtype).kind == 'M':
+    return _to_datetime64(catalog[name]).astype(dtype)
+  return catalog[name].to_numpy(dtype=dtype, copy=True)
+
+
+def _to_datetime64(times):
+  return pd.to_datetime(times).to_numpy(dtype='datetime64[ns]')
+
+
 def _get_velocity(distance, focal_time, arrival_time):
-  """Computes travel velocity from the available recorded arrival times."""
-  if arrival_time is not None:
-    time_lag = (arrival_time - focal_time).total_seconds()
+  """Computes travel velocity from the available recorded arrival times.
+
+  The velocity is NaN where the arrival time is unavailable.
+  """
+  focal_time = _to_datetime64(focal_time)
+  arrival_time = _to_datetime64(arrival_time)
+  available = ~np.isnat(arrival_time)
+  time_lag = (arrival_time.astype(np.int64) -
+              focal_time.astype(np.int64)) / 1e9
+  time_lag = np.where(available, time_lag, np.nan)
+  with np.errstate(divide='ignore', invalid='ignore'):
     return distance / time_lag
-  return None
+
+
+def parse_args():
+  """Parse arguments."""
+  available_options = ['full', 'update']
+
+  option = 'full'
+  if len(sys.argv) > 1:
+    option = sys.argv[1]
+    if option not in available_options:
+      print("Argument should be 'full' or 'update'")
+      sys.exit()
+  return option
 
 
 def main():
-  """Creates a catalog of seismic events close to Stanford."""
+  """Creates a catalog of seismic events close to Stanford.
+
+  With the 'update' argument, the existing catalog is updated with the events
+  that occurred since its last event.
+  """
+  option = parse_args()
   logging.info('Creating seismic event catalog...')
   catalog_builder = EventCatalogBuilder(
       clientcode=parameters.clientcode,
@@ -251,14 +471,25 @@ def main():
       reference_station=parameters.closest_station,
       reference_channel=parameters.reference_channel
   )
-  catalog_builder.create_event_catalog(
-      starttime=parameters.starttime,
-      endtime=parameters.endtime,
-      maxradius=parameters.max_radius
-  )
+  if option == 'update':
+    catalog_builder.update_event_catalog(
+        catalog=catalog_store.load_catalog(parameters.event_catalog),
+        endtime=_get_last_complete_day(),
+        maxradius=parameters.max_radius,
+        n_threads=parameters.catalog_threads,
+        cache_dir=parameters.catalog_cache_datapath,
+    )
+  else:
+    catalog_builder.create_event_catalog(
+        starttime=parameters.starttime,
+        endtime=parameters.endtime,
+        maxradius=parameters.max_radius,
+        n_threads=parameters.catalog_threads,
+        cache_dir=parameters.catalog_cache_datapath,
+    )
 
   logging.info('Saving catalog to file: %s', parameters.event_catalog)
-  catalog_builder.catalog.to_hdf(parameters.event_catalog, key='df')
+  catalog_store.save_catalog(catalog_builder.catalog, parameters.event_catalog)
 
 
 if __name__ == '__main__':
@@ -1,68 +1,158 @@
 """Create background noise catalog."""
 import datetime as dt
 import logging
-import random
 
+import numpy as np
 import pandas as pd
 
-from earthquakes import parameters
+from preprocessing import catalog_index
+from preprocessing import catalog_store
+from preprocessing import parameters
 
 
-random.seed(1337)
+_SECONDS_PER_HOUR = 60 * 60
+_HOURS_PER_DAY = 24
 
 
 class NoiseCatalogBuilder():
   """Class for creating a catalog of background noise."""
 
-  def __init__(self, event_catalog, num_entries):
+  def __init__(self, event_catalog, num_entries,
+               buffer=dt.timedelta(minutes=5), min_spacing=dt.timedelta(0),
+               stratify_by_hour=False, seed=1337):
     """Initialization.
 
     Args:
         event_catalog (str): path to the event catalog.
         num_entries (int): number of entries to create.
+        buffer (timedelta): minimum time between a noise time stamp and any
+            recorded event.
+        min_spacing (timedelta): minimum time between two noise time stamps.
+        stratify_by_hour (bool): whether to draw the same number of time
+            stamps in each hour of the day.
+        seed (int): seed of the random number generator.
     """
     self.catalog = pd.DataFrame(index=range(num_entries), columns=['datetime'])
     self.num_entries = num_entries
-    self.event_catalog = pd.read_pickle(event_catalog)
-    self.event_catalog = self.event_catalog.sort_values(by=['datetime'])
+    self.buffer = buffer
+    self.min_spacing = min_spacing
+    self.stratify_by_hour = stratify_by_hour
+    self.rng = np.random.default_rng(seed)
+    # sorted event times, read from the catalog index
+    self.event_times = catalog_index.CatalogIndex.load_or_build(
+        event_catalog).times
 
   def create_noise_catalog(self):
     """Creates a background noise catalog.
     The background noise windows are randomly selected within the time span of
-    the event catalog, while ensuring they are at least 5 minutes away from any
+    the event catalog, while ensuring they are at least `buffer` away from any
     recorded event.
-    """
-    num_events = len(self.event_catalog)
-    catalog_starttime = self.event_catalog.at[0, 'datetime']
-    catalog_endtime = self.event_catalog.at[num_events - 1, 'datetime']
-
-    buffer = dt.timedelta(minutes=5)
-    timespan = int((catalog_endtime - catalog_starttime).total_seconds())
-
-    count = 0
-    while count < self.num_entries:
-      random_time_shift = dt.timedelta(seconds=random.randrange(timespan))
-      random_time = catalog_starttime + random_time_shift
-      if self._check_interval(random_time - buffer, random_time + buffer):
-        self.catalog.at[count, 'datetime'] = random_time
-        count += 1
 
-  def _check_interval(self, starttime, endtime):
-    """Checks whether there are no recorded events in the time interval.
-
-    Args:
-        starttime (datetime): start of time interval.
-        endtime (datetime): end of time interval.
+    The time stamps are drawn uniformly from the allowed time intervals, at a
+    resolution of one second, so no draw is ever rejected.
+    """
+    starts, ends = self._get_allowed_intervals()
+    spacing = int(self.min_spacing.total_seconds())
+    if not self.stratify_by_hour:
+      times = _sample_intervals(self.rng, starts, ends, self.num_entries,
+                                spacing)
+    else:
+      starts, ends = _split_by_hour(starts, ends)
+      if spacing:
+        # time stamps in different pieces are then at least `spacing` apart
+        ends = ends - spacing
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+      hours = (starts // _SECONDS_PER_HOUR) % _HOURS_PER_DAY
+      counts = np.full(_HOURS_PER_DAY, self.num_entries // _HOURS_PER_DAY)
+      counts[self.rng.choice(_HOURS_PER_DAY,
+                             self.num_entries % _HOURS_PER_DAY,
+                             replace=False)] += 1
+      times = np.concatenate([
+          _sample_intervals(self.rng, starts[hours == hour],
+                            ends[hours == hour], counts[hour], spacing)
+          for hour in range(_HOURS_PER_DAY)])
+      times.sort()
+
+    self.catalog = pd.DataFrame({
+        'datetime': times.astype('datetime64[s]').astype('datetime64[ns]')})
+
+  def _get_allowed_intervals(self):
+    """Computes the time intervals at least `buffer` away from any event.
 
     Returns:
-        bool: True if there are no events in the time interval.
+        (starts, ends) tuple of int64 arrays: the disjoint [start, end) allowed
+        intervals, in seconds since the epoch, sorted by time.
     """
-    # search is faster on a sorted dataframe
-    left_count = self.event_catalog['datetime'].searchsorted(
-        starttime, 'right')
-    right_count = self.event_catalog['datetime'].searchsorted(
-        endtime, 'right')
-    return (right_count - left_count) == 0
+    event_times = self.event_times
+    if not len(event_times):
+      raise ValueError('The event catalog is empty.')
+    buffer = int(self.buffer / dt.timedelta(microseconds=1)) * 1000
+
+    # complement of the union of the [event - buffer, event + buffer]
+    # intervals, within the time span of the catalog
+    forbidden_ends = np.maximum.accumulate(event_times + buffer)
+    forbidden_starts = event_times - buffer
+    gaps = forbidden_starts[1:] > forbidden_ends[:-1]
+    starts = forbidden_ends[:-1][gaps]
+    ends = forbidden_starts[1:][gaps]
+
+    # round inwards to whole seconds
+    starts = -(-starts // 10**9)
+    ends = ends // 10**9
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+
+def _split_by_hour(starts, ends):
+  """Splits [start, end) intervals at the hour boundaries."""
+  first_hours = starts // _SECONDS_PER_HOUR
+  last_hours = (ends - 1) // _SECONDS_PER_HOUR
+  counts = last_hours - first_hours + 1
+  interval = np.repeat(np.arange(len(starts)), counts)
+  offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+  hours = first_hours[interval] + offsets
+  return (np.maximum(starts[interval], hours * _SECONDS_PER_HOUR),
+          np.minimum(ends[interval], (hours + 1) * _SECONDS_PER_HOUR))
+
+
+def _sample_intervals(rng, starts, ends, num_samples, spacing=0):
+  """Draws time stamps uniformly from a union of disjoint intervals.
+
+  The intervals are laid end to end on a virtual time line. Drawing sorted
+  uniform samples on the line shortened by (num_samples - 1) * spacing and
+  shifting the i-th sample by i * spacing gives uniform samples at least
+  `spacing` apart, and mapping them back to the intervals can only increase
+  the time between them.
+
+  Args:
+      rng (numpy.random.Generator): random number generator.
+      starts (np.ndarray): sorted int64 interval starts (seconds).
+      ends (np.ndarray): int64 interval ends (seconds), excluded.
+      num_samples (int): number of time stamps to draw.
+      spacing (int): minimum time between two time stamps (seconds).
+
+  Raises:
+      ValueError: the intervals are too short for the requested samples.
+
+  Returns:
+      np.ndarray: sorted int64 time stamps (seconds).
+  """
+  if not num_samples:
+    return np.empty(0, dtype=np.int64)
+  lengths = ends - starts
+  offsets = np.cumsum(lengths) - lengths
+  free_length = lengths.sum() - (num_samples - 1) * spacing
+  if free_length <= 0:
+    raise ValueError(
+        'Cannot draw {} samples {} seconds apart from {} seconds of allowed '
+        'time intervals.'.format(num_samples, spacing, lengths.sum()))
+
+  samples = np.sort(rng.integers(free_length, size=num_samples))
+  samples += np.arange(num_samples) * spacing
+  interval = np.searchsorted(offsets, samples, 'right') - 1
+  return starts[interval] + samples - offsets[interval]
 
 
 def main():
@@ -70,13 +160,17 @@ def main():
   logging.info('Creating background noise catalog...')
   catalog_builder = NoiseCatalogBuilder(
       event_catalog=parameters.event_catalog,
-      num_entries=parameters.num_noise_examples
+      num_entries=parameters.num_noise_examples,
+      buffer=dt.timedelta(seconds=parameters.noise_buffer),
+      min_spacing=dt.timedelta(seconds=parameters.noise_min_spacing),
+      stratify_by_hour=parameters.noise_stratify_by_hour,
+      seed=parameters.noise_seed,
   )
 
   catalog_builder.create_noise_catalog()
 
   logging.info('Saving catalog to file: %s', parameters.noise_catalog)
-  catalog_builder.catalog.to_pickle(parameters.noise_catalog)
+  catalog_store.save_catalog(catalog_builder.catalog, parameters.noise_catalog)
 
 
 if __name__ == "__main__":
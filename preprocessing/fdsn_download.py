@@ -0,0 +1,263 @@
+"""Thread-based download engine for FDSN web services.
+
+Waveform requests are network-bound, so they are run in a thread pool rather
+than in forked processes. Each thread reuses its own HTTP session, failed
+requests are retried with exponential backoff, requests are rate-limited per
+host, and the requests that still fail are written to a failure manifest so
+that a rerun only fetches those.
+"""
+
+import collections
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional, Text
+import urllib.parse
+
+import obspy
+from obspy import UTCDateTime
+from obspy.clients.fdsn.header import URL_MAPPINGS
+import requests
+
+
+# HTTP status codes worth retrying
+_RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+# HTTP status codes meaning that no data is available
+_NO_DATA_STATUS_CODES = (204, 404)
+
+
+DownloadTask = collections.namedtuple(
+    'DownloadTask', ['filename', 'starttime', 'window'])
+
+
+class DownloadError(Exception):
+  """Raised when a request still fails after all retries."""
+
+
+def _format_time(timestamp):
+  return UTCDateTime(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def get_time_window(task: DownloadTask):
+  starttime = UTCDateTime(task.starttime)
+  return starttime, starttime + task.window
+
+
+def coalesce(time_windows):
+  """Merges overlapping time windows.
+
+  Args:
+    time_windows: (starttime, endtime) tuples.
+
+  Returns:
+    Sorted list of disjoint (starttime, endtime) tuples covering the input
+    time windows.
+  """
+  merged = []
+  for starttime, endtime in sorted(time_windows):
+    if merged and starttime <= merged[-1][1]:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], endtime))
+    else:
+      merged.append((starttime, endtime))
+  return merged
+
+
+def make_batches(tasks, batch_size: int):
+  """Groups download tasks that are close in time into batches."""
+  tasks = sorted(tasks, key=lambda task: UTCDateTime(task.starttime))
+  return [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+
+
+class RateLimiter():
+  """Spaces out requests to the same host, across all threads."""
+
+  def __init__(self, max_requests_per_second: float):
+    self.interval = 1.0 / max_requests_per_second
+    self._lock = threading.Lock()
+    self._next_time = collections.defaultdict(float)
+
+  def wait(self, host: Text):
+    with self._lock:
+      now = time.monotonic()
+      request_time = max(now, self._next_time[host])
+      self._next_time[host] = request_time + self.interval
+    time.sleep(max(request_time - now, 0))
+
+
+class FDSNSession():
+  """Thread-safe client for the FDSN dataselect web service.
+
+  Attr:
+    base_url: Service base URL, e.g. 'https://service.ncedc.org'.
+  """
+
+  def __init__(
+      self, clientcode: Text, max_retries: int = 5, backoff: float = 1.0,
+      max_requests_per_second: float = 10.0, timeout: float = 120.0,
+  ):
+    """Initialization.
+
+    Args:
+      clientcode: Obspy client code, e.g. 'NCEDC', or the base URL of an FDSN
+        service, e.g. 'http://localhost:8080'.
+      max_retries: Maximum number of retries of a failed request.
+      backoff: Delay before the first retry (seconds), doubled at each retry.
+      max_requests_per_second: Maximum request rate per host.
+      timeout: Request timeout (seconds).
+    """
+    self.base_url = URL_MAPPINGS.get(clientcode, clientcode).rstrip('/')
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.rate_limiter = RateLimiter(max_requests_per_second)
+    self._local = threading.local()
+
+  @property
+  def _session(self):
+    # requests sessions are not guaranteed to be thread-safe, so each thread
+    # keeps its own session and connection pool
+    if not hasattr(self._local, 'session'):
+      self._local.session = requests.Session()
+    return self._local.session
+
+  def request(self, method: Text, service: Text, **kwargs):
+    """Sends a request to an FDSN service, retrying on failure.
+
+    Args:
+      method: HTTP method.
+      service: Service path, e.g. 'fdsnws/dataselect/1/query'.
+      **kwargs: Arguments passed to `requests.Session.request`.
+
+    Returns:
+      The response content, or None if no data is available.
+
+    Raises:
+      DownloadError: The request failed after all retries.
+    """
+    url = '{}/{}'.format(self.base_url, service)
+    host = urllib.parse.urlparse(url).netloc
+    error = None
+    for attempt in range(self.max_retries + 1):
+      if attempt:
+        time.sleep(self.backoff * 2**(attempt - 1))
+      self.rate_limiter.wait(host)
+      try:
+        response = self._session.request(
+            method, url, timeout=self.timeout, **kwargs)
+      except requests.RequestException as e:
+        error = e
+        continue
+      if response.status_code in _NO_DATA_STATUS_CODES:
+        return None
+      if response.status_code in _RETRY_STATUS_CODES:
+        error = 'HTTP {}'.format(response.status_code)
+        continue
+      if response.status_code != 200:
+        raise DownloadError('HTTP {} for {}: {}'.format(
+            response.status_code, url, response.text[:200]))
+      return response.content
+    raise DownloadError('{} failed after {} retries: {}'.format(
+        url, self.max_retries, error))
+
+  def get_waveforms(
+      self, network: Text, station: Text, location: Text, channel: Text,
+      starttime, endtime,
+  ) -> Optional[obspy.Stream]:
+    """Downloads waveforms, mirroring `obspy.clients.fdsn.Client`.
+
+    Returns:
+      The waveforms, or None if no data is available.
+    """
+    content = self.request('GET', 'fdsnws/dataselect/1/query', params={
+        'network': network,
+        'station': station,
+        'location': location,
+        'channel': channel,
+        'starttime': _format_time(starttime),
+        'endtime': _format_time(endtime),
+    })
+    if content is None:
+      return None
+    return obspy.read(io.BytesIO(content), format='MSEED')
+
+  def get_waveforms_bulk(self, bulk) -> Optional[obspy.Stream]:
+    """Downloads waveforms for many time windows in a single request.
+
+    Args:
+      bulk: (network, station, location, channel, starttime, endtime) tuples.
+
+    Returns:
+      The waveforms, or None if no data is available.
+    """
+    lines = ['{} {} {} {} {} {}'.format(
+        network, station, location, channel, _format_time(starttime),
+        _format_time(endtime))
+             for network, station, location, channel, starttime, endtime
+             in bulk]
+    content = self.request('POST', 'fdsnws/dataselect/1/query',
+                           data='\n'.join(lines).encode())
+    if content is None:
+      return None
+    return obspy.read(io.BytesIO(content), format='MSEED')
+
+
+def write_failures(failure_file: Text, tasks):
+  """Writes the failed download tasks to a JSON lines manifest."""
+  os.makedirs(os.path.dirname(os.path.abspath(failure_file)), exist_ok=True)
+  with open(failure_file, 'w') as f:
+    for task in tasks:
+      f.write(json.dumps({
+          'filename': task.filename,
+          'starttime': _format_time(task.starttime),
+          'window': task.window,
+      }) + '\n')
+
+
+def read_failures(failure_file: Text):
+  """Reads the download tasks from a failure manifest."""
+  with open(failure_file, 'r') as f:
+    entries = [json.loads(line) for line in f if line.strip()]
+  return [DownloadTask(entry['filename'], UTCDateTime(entry['starttime']),
+                       entry['window']) for entry in entries]
+
+
+def download(download_func, batches, n_threads: int, failure_file: Text):
+  """Runs batches of download tasks in a thread pool.
+
+  Args:
+    download_func: Function called on each batch, which raises an exception
+      when the download fails.
+    batches: Lists of download tasks.
+    n_threads: Number of concurrent downloads.
+    failure_file: Manifest to which the tasks of the failed batches are
+      written.
+
+  Returns:
+    List of the failed tasks.
+  """
+  failures = []
+  num_tasks = sum(len(batch) for batch in batches)
+  count = 0
+  with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+    futures = {executor.submit(download_func, batch): batch
+               for batch in batches}
+    for future in concurrent.futures.as_completed(futures):
+      batch = futures[future]
+      try:
+        future.result()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.warning('Could not download data for %s files from %s: %s',
+                        len(batch), batch[0].filename, e)
+        failures.extend(batch)
+      if count // 1000 != (count + len(batch)) // 1000:
+        logging.info('Downloaded %s of %s files.', count, num_tasks)
+      count += len(batch)
+  failures.sort(key=lambda task: task.filename)
+  write_failures(failure_file, failures)
+  logging.info('%s downloads failed, written to %s.', len(failures),
+               failure_file)
+  return failures
@@ -0,0 +1,82 @@
+"""Vectorized geodetic computations on the WGS84 ellipsoid."""
+
+import numpy as np
+
+
+WGS84_A = 6378137.0  # semi-major axis (meters)
+WGS84_F = 1 / 298.257223563  # flattening
+
+
+def distance_azimuth(lat1, lon1, lat2, lon2, max_iterations=100,
+                     tolerance=1e-12):
+  """Computes the geodesic distance and azimuth between points.
+
+  Vectorized version of `obspy.geodetics.gps2dist_azimuth`, using Vincenty's
+  inverse formula. All the arguments are broadcast against each other.
+
+  Args:
+    lat1, lon1: Coordinates of the first points (degrees).
+    lat2, lon2: Coordinates of the second points (degrees).
+    max_iterations: Maximum number of iterations of Vincenty's formula.
+    tolerance: Convergence tolerance on the longitude difference (radians).
+
+  Returns:
+    (distance, azimuth) tuple: distance in meters and azimuth from the first
+    to the second points in degrees clockwise from north, in [0, 360).
+  """
+  a = WGS84_A
+  f = WGS84_F
+  b = a * (1 - f)
+
+  lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+      *[np.radians(np.asarray(x, dtype=np.float64))
+        for x in (lat1, lon1, lat2, lon2)])
+  delta_lon = lon2 - lon1
+  u1 = np.arctan((1 - f) * np.tan(lat1))
+  u2 = np.arctan((1 - f) * np.tan(lat2))
+  sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+  sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+  lam = delta_lon.copy()
+  for _ in range(max_iterations):
+    sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+    sin_sigma = np.hypot(cos_u2 * sin_lam,
+                         cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+    cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+    sigma = np.arctan2(sin_sigma, cos_sigma)
+    coincident = sin_sigma == 0
+    sin_alpha = np.where(
+        coincident, 0.0,
+        cos_u1 * cos_u2 * sin_lam / np.where(coincident, 1.0, sin_sigma))
+    cos2_alpha = 1 - sin_alpha**2
+    # points on the equator
+    equatorial = cos2_alpha == 0
+    cos_2sigma_m = np.where(
+        equatorial, 0.0,
+        cos_sigma - 2 * sin_u1 * sin_u2 / np.where(equatorial, 1.0,
+                                                   cos2_alpha))
+    c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+    lam_prev = lam
+    lam = delta_lon + (1 - c) * f * sin_alpha * (
+        sigma + c * sin_sigma * (
+            cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m**2)))
+    if np.all(np.abs(lam - lam_prev) < tolerance):
+      break
+
+  u_squared = cos2_alpha * (a**2 - b**2) / b**2
+  big_a = 1 + u_squared / 16384 * (
+      4096 + u_squared * (-768 + u_squared * (320 - 175 * u_squared)))
+  big_b = u_squared / 1024 * (
+      256 + u_squared * (-128 + u_squared * (74 - 47 * u_squared)))
+  delta_sigma = big_b * sin_sigma * (
+      cos_2sigma_m + big_b / 4 * (
+          cos_sigma * (-1 + 2 * cos_2sigma_m**2)
+          - big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma**2)
+          * (-3 + 4 * cos_2sigma_m**2)))
+  distance = b * big_a * (sigma - delta_sigma)
+
+  sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+  azimuth = np.degrees(np.arctan2(
+      cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam))
+  azimuth = np.where(coincident, 0.0, np.mod(azimuth, 360.0))
+  return distance, azimuth
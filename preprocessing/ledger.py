@@ -0,0 +1,103 @@
+"""Completion ledger for resumable preprocessing runs."""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+
+
+def fingerprint(params):
+  """Computes a fingerprint of the processing parameters."""
+  text = json.dumps(params, sort_keys=True, default=str)
+  return hashlib.sha256(text.encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_output(filename):
+  """Yields a temporary path that is renamed to `filename` on success.
+
+  A job killed while writing leaves a temporary file behind instead of a
+  truncated `filename`.
+  """
+  tmp_filename = '{}.tmp{}'.format(filename, os.getpid())
+  try:
+    yield tmp_filename
+    os.replace(tmp_filename, filename)
+  finally:
+    if os.path.exists(tmp_filename):
+      os.remove(tmp_filename)
+
+
+class CompletionLedger():
+  """Record of the input files that were processed to completion.
+
+  The ledger is an append-only JSON lines file. Each entry holds the size and
+  modification time of an input file and the fingerprint of the parameters it
+  was processed with. An input is complete only if all three still match, so
+  a rerun only processes new, modified or differently parameterized inputs.
+
+  Attr:
+    path: Ledger file.
+    fingerprint: Fingerprint of the current processing parameters.
+  """
+
+  def __init__(self, path, params):
+    """Initialization.
+
+    Args:
+      path: Ledger file. Created if it does not exist.
+      params: Processing parameters, used to fingerprint the entries.
+    """
+    self.path = path
+    self.fingerprint = fingerprint(params)
+    self._entries = {}
+    if os.path.isfile(path):
+      with open(path, 'r') as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            # last line of a ledger whose writer was killed
+            continue
+          self._entries[entry['input']] = entry
+
+  def _entry(self, filename):
+    stat = os.stat(filename)
+    return {
+        'input': filename,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'fingerprint': self.fingerprint,
+    }
+
+  def is_complete(self, filename):
+    """Checks whether `filename` was processed with the current parameters."""
+    entry = self._entries.get(filename)
+    return entry is not None and entry == self._entry(filename)
+
+  def filter_incomplete(self, filenames, has_output=None):
+    """Returns the files that still need to be processed.
+
+    Args:
+      filenames: Input files.
+      has_output: If set, function checking whether the output of an input
+        file exists. Complete files whose output is missing are processed
+        again.
+    """
+    incomplete = [filename for filename in filenames
+                  if not self.is_complete(filename) or
+                  (has_output is not None and not has_output(filename))]
+    logging.info('Skipping %s completed files.',
+                 len(filenames) - len(incomplete))
+    return incomplete
+
+  def record(self, filename):
+    """Marks `filename` as processed."""
+    entry = self._entry(filename)
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    with open(self.path, 'a') as f:
+      f.write(json.dumps(entry) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+    self._entries[filename] = entry
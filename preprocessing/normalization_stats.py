@@ -0,0 +1,229 @@
+"""Streaming normalization statistics of the preprocessed windows.
+
+The windows are normalized by clipping them to a percentile of their absolute
+values and dividing them by the standard deviation of the clipped values. Both
+are computed in a single pass over the windows, with memory independent of
+their number:
+  - the absolute values are counted in a histogram with fixed, logarithmically
+    spaced bins, from which percentiles are interpolated within a relative
+    error of about 0.6%, and the mean square of the values clipped to any
+    value is integrated,
+  - the mean and variance of the raw values are accumulated with the parallel
+    algorithm of Chan et al., in float64.
+Both merge exactly, so the windows are split between processes and their
+statistics merged at the end. With `per_channel`, the statistics are kept for
+each row of the windows, i.e. each seismometer channel, and otherwise over
+all the values.
+"""
+
+import logging
+
+import numpy as np
+
+from preprocessing import ledger
+from preprocessing import parallel
+from preprocessing import window_store
+
+
+# histogram bins: [0, 1e-12), then 200 bins per decade up to 1e12, then
+# [1e12, inf)
+_MIN_EXPONENT = -12
+_MAX_EXPONENT = 12
+_BINS_PER_DECADE = 200
+_NUM_BINS = (_MAX_EXPONENT - _MIN_EXPONENT) * _BINS_PER_DECADE + 2
+_EDGES = 10.0 ** (_MIN_EXPONENT +
+                  np.arange(_NUM_BINS - 1) / _BINS_PER_DECADE)
+
+
+class NormalizationStats():
+  """Mergeable histogram, mean and variance of the windows.
+
+  Attr:
+    per_channel: Whether the statistics are kept for each channel.
+    count: Number of values of each channel.
+    mean: Mean of each channel.
+    m2: Sum of the squared deviations from the mean of each channel.
+    histogram: [channels, bins] counts of the absolute values.
+  """
+
+  def __init__(self, per_channel=False):
+    self.per_channel = per_channel
+    self.count = None
+    self.mean = None
+    self.m2 = None
+    self.histogram = None
+
+  def _reset(self, num_channels):
+    self.count = np.zeros(num_channels, dtype=np.int64)
+    self.mean = np.zeros(num_channels)
+    self.m2 = np.zeros(num_channels)
+    self.histogram = np.zeros((num_channels, _NUM_BINS), dtype=np.int64)
+
+  def _merge_moments(self, count, mean, m2):
+    total = self.count + count
+    with np.errstate(divide='ignore', invalid='ignore'):
+      delta = mean - self.mean
+      self.mean = np.where(total > 0,
+                           self.mean + delta * count / total, 0.0)
+      self.m2 = np.where(
+          total > 0, self.m2 + m2 + delta ** 2 * self.count * count / total,
+          0.0)
+    self.count = total
+
+  def update(self, data):
+    """Adds the values of a window, of shape [channels, ...] if per channel."""
+    data = np.asarray(data, dtype=np.float64)
+    data = data.reshape((len(data), -1) if self.per_channel else (1, -1))
+    if self.count is None:
+      self._reset(len(data))
+    elif len(data) != len(self.count):
+      raise ValueError('Expected {} channels, got {}.'.format(
+          len(self.count), len(data)))
+
+    count = data.shape[1]
+    mean = data.mean(axis=1)
+    m2 = ((data - mean[:, np.newaxis]) ** 2).sum(axis=1)
+    self._merge_moments(count, mean, m2)
+
+    with np.errstate(divide='ignore'):
+      bins = np.floor(
+          (np.log10(np.abs(data)) - _MIN_EXPONENT) * _BINS_PER_DECADE) + 1
+    bins = np.clip(np.nan_to_num(bins, neginf=0), 0, _NUM_BINS - 1)
+    bins = bins.astype(np.int64) + _NUM_BINS * np.arange(len(data))[:, None]
+    self.histogram += np.bincount(
+        bins.ravel(), minlength=self.histogram.size).reshape(
+            self.histogram.shape)
+
+  def merge(self, other):
+    """Adds the statistics of other windows."""
+    if other.count is None:
+      return
+    if self.count is None:
+      self._reset(len(other.count))
+    self._merge_moments(other.count, other.mean, other.m2)
+    self.histogram += other.histogram
+
+  @property
+  def std(self):
+    """Standard deviation of each channel."""
+    return np.sqrt(self.m2 / self.count)
+
+  def percentile(self, q):
+    """Interpolates the q-th percentile of the absolute values of each
+    channel."""
+    values = np.empty(len(self.histogram))
+    for i, counts in enumerate(self.histogram):
+      cumulative = np.cumsum(counts)
+      target = q / 100 * cumulative[-1]
+      k = min(np.searchsorted(cumulative, target, 'left'), _NUM_BINS - 1)
+      below = cumulative[k] - counts[k]
+      fraction = (target - below) / counts[k] if counts[k] else 0.0
+      if k == 0:
+        values[i] = _EDGES[0] * fraction
+      elif k == _NUM_BINS - 1:
+        values[i] = _EDGES[-1]
+      else:
+        # geometric interpolation within the logarithmic bin
+        values[i] = _EDGES[k - 1] * (_EDGES[k] / _EDGES[k - 1]) ** fraction
+    return values
+
+  def clipped_std(self, clip_values):
+    """Standard deviation of the values of each channel clipped to
+    [-clip, clip].
+
+    The filtered windows have a zero mean, so this is the root mean square of
+    the clipped values, integrated over the histogram with the values spread
+    log-uniformly within each bin, as in `percentile`.
+
+    Args:
+      clip_values: Clip value of each channel.
+    """
+    lower = np.concatenate([[0.0], _EDGES])
+    upper = np.concatenate([_EDGES, [np.inf]])
+    values = np.empty(len(self.histogram))
+    for i, (counts, clip) in enumerate(zip(self.histogram, clip_values)):
+      top = np.minimum(upper, clip)
+      below = (lower < clip) & (top > lower)
+      with np.errstate(divide='ignore', invalid='ignore'):
+        log_ratio = np.log(top / lower)
+        # fraction of each bin below the clip value, and its mean square
+        fraction = np.where(lower > 0, log_ratio / np.log(upper / lower),
+                            top / upper)
+        mean_square = np.where(lower > 0,
+                               (top ** 2 - lower ** 2) / (2 * log_ratio),
+                               top ** 2 / 3)
+      fraction = np.where(below, fraction, 0.0)
+      mean_square = np.where(below, mean_square, 0.0)
+      total = np.sum(counts * (fraction * mean_square +
+                               (1 - fraction) * clip ** 2))
+      values[i] = np.sqrt(total / counts.sum())
+    return values
+
+  def save(self, filename):
+    with ledger.atomic_output(filename) as tmp_file:
+      with open(tmp_file, 'wb') as f:
+        np.savez(f, per_channel=self.per_channel, count=self.count,
+                 mean=self.mean, m2=self.m2, histogram=self.histogram)
+
+  @classmethod
+  def load(cls, filename):
+    with np.load(filename) as f:
+      stats = cls(bool(f['per_channel']))
+      stats.count = f['count']
+      stats.mean = f['mean']
+      stats.m2 = f['m2']
+      stats.histogram = f['histogram']
+    return stats
+
+
+def load_clip_and_std(filename, clip_percentile):
+  """Loads the clip value and the standard deviation of the clipped values
+  from a stats file.
+
+  Returns:
+    (clip values, standard deviations) tuple, with one value per channel if
+    the statistics are per channel, and scalars otherwise.
+  """
+  stats = NormalizationStats.load(filename)
+  clip_values = stats.percentile(clip_percentile)
+  std_values = stats.clipped_std(clip_values)
+  if not stats.per_channel:
+    return float(clip_values[0]), float(std_values[0])
+  return clip_values, std_values
+
+
+def _compute_part(task):
+  entries, per_channel = task
+  reader = window_store.WindowReader()
+  stats = NormalizationStats(per_channel)
+  for entry in entries:
+    if reader.exists(entry):
+      stats.update(reader.read(entry)[0])
+  return stats
+
+
+def compute_stats(entries, per_channel=False, n_workers=1,
+                  start_method=None):
+  """Computes the normalization statistics of windows.
+
+  Args:
+    entries: Window files or `store_file#i` entries. Missing windows are
+      skipped.
+    per_channel: Whether to keep the statistics for each channel.
+    n_workers: Number of processes reading the windows.
+    start_method: Start method of the processes, see
+      `parallel.imap_bounded`.
+
+  Returns:
+    NormalizationStats.
+  """
+  num_parts = max(min(4 * n_workers, len(entries)), 1)
+  tasks = [(list(part), per_channel)
+           for part in np.array_split(entries, num_parts)]
+  stats = NormalizationStats(per_channel)
+  for i, part in enumerate(parallel.imap_bounded(
+      _compute_part, tasks, n_workers, start_method=start_method)):
+    stats.merge(part)
+    logging.info('Computed the statistics of %s of %s parts.', i + 1,
+                 num_parts)
+  return stats
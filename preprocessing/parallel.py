@@ -0,0 +1,80 @@
+"""Parallel execution helpers for the preprocessing scripts."""
+
+import collections
+import concurrent.futures
+import multiprocessing
+
+
+def imap_bounded(func, iterable, n_workers, max_in_flight=None,
+                 start_method=None):
+  """Applies `func` to every item of `iterable` in a process pool.
+
+  Unlike `multiprocessing.Pool.imap`, at most `max_in_flight` tasks are
+  submitted at any time, so the memory held by pending results stays flat
+  regardless of the number of items. Results are yielded in input order.
+
+  Args:
+    func: Picklable function applied to each item.
+    iterable: Items to process.
+    n_workers: Number of worker processes. With a single worker, the items are
+      processed in the calling process.
+    max_in_flight: Maximum number of submitted but not yet consumed tasks.
+      Defaults to four times the number of workers.
+    start_method: Start method of the worker processes, e.g. 'spawn' when the
+      caller imported libraries that are not fork-safe, such as TensorFlow.
+      Defaults to the platform default.
+
+  Yields:
+    The result of `func` for each item, in input order.
+  """
+  if n_workers <= 1:
+    for item in iterable:
+      yield func(item)
+    return
+
+  if max_in_flight is None:
+    max_in_flight = 4 * n_workers
+  max_in_flight = max(max_in_flight, n_workers)
+
+  with multiprocessing.get_context(start_method).Pool(n_workers) as pool:
+    pending = collections.deque()
+    for item in iterable:
+      if len(pending) >= max_in_flight:
+        yield pending.popleft().get()
+      pending.append(pool.apply_async(func, (item,)))
+    while pending:
+      yield pending.popleft().get()
+
+
+def prefetch(func, iterable, n_workers=1, depth=2):
+  """Applies `func` to the next items of `iterable` in background threads.
+
+  Intended for I/O-bound functions, such as reads, that can overlap with the
+  CPU-bound processing of the results by the caller. At most `depth` results
+  are computed ahead of the one being consumed. Results are yielded in input
+  order.
+
+  Args:
+    func: Function applied to each item.
+    iterable: Items to process.
+    n_workers: Number of threads. With no threads, the items are processed in
+      the calling thread when their result is consumed.
+    depth: Maximum number of items processed ahead.
+
+  Yields:
+    The result of `func` for each item, in input order.
+  """
+  if n_workers < 1:
+    for item in iterable:
+      yield func(item)
+    return
+
+  depth = max(depth, 1)
+  with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+    pending = collections.deque()
+    for item in iterable:
+      if len(pending) >= depth:
+        yield pending.popleft().result()
+      pending.append(executor.submit(func, item))
+    while pending:
+      yield pending.popleft().result()
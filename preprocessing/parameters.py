@@ -11,10 +11,23 @@ from config import get_datapath
 num_noise_examples = 30000
 event_catalog = 'catalog/earthquake_catalog.h5'
 noise_catalog = 'catalog/noise_catalog.h5'
+# noise time stamps are at least noise_buffer away from any event, and at
+# least noise_min_spacing away from each other
+noise_buffer = 5 * 60  # seconds
+noise_min_spacing = 0  # seconds
+# set to True to draw the same number of noise time stamps in each hour of
+# the day
+noise_stratify_by_hour = False
+noise_seed = 1337
+# maximum number of concurrent event catalog requests
+catalog_threads = 4
 
 # ---- datapath ---------------------------------------------------------------
 datapath = get_datapath.get_datapath()
 
+# cache of raw event catalog responses, set to None to disable
+catalog_cache_datapath = os.path.join(datapath, 'catalog_cache')
+
 # ---- USGS seismic network parameters ----------------------------------------
 clientcode = "NCEDC"
 
@@ -43,10 +56,31 @@ stations = ['JRSC']
 channels = ['HNE', 'HNN', 'HNZ']
 location = '*'
 
+# 'process' downloads with a multiprocessing pool and the obspy client,
+# 'thread' with a thread pool, retries and rate limiting
+download_engine = 'thread'
+download_threads = 32
+download_max_retries = 5
+download_max_requests_per_second = 10.0
+# number of catalog waveforms per bulk request, with the 'thread' engine
+download_bulk_size = 100
+
 
 # ---- DAS processing parameters ----------------------------------------------
 raw_datapath = os.path.join(datapath, 'raw_data')
 processed_datapath = os.path.join(datapath, 'processed_data')
+# set to True to append the processed windows to one consolidated store per
+# data type instead of writing one file per window
+use_window_store = False
+window_store_file = 'windows.h5'
+# cache of intermediate processing stage outputs, e.g.
+# os.path.join(datapath, 'stage_cache'), None to disable
+stage_cache_datapath = None
+# number of event and noise windows filtered together in single calls, 1 to
+# process the windows one by one. Batches bypass the stage cache. They mostly
+# help the short seismometer traces, whose processing is dominated by the
+# per-call overhead (see benchmarks/benchmark_batch_processing.py).
+window_batch_size = 1
 
 start_channel = 14
 end_channel = 310
@@ -65,9 +99,25 @@ das_dt = 0.02
 das_downsampling_factor = 2
 das_clip_val = 0.024
 das_norm_val = 0.014088576
+# normalization statistics of the DAS training windows, written by the DAS
+# TFRecord converter, used instead of the clip and norm values above if found
+das_stats_file = os.path.join(
+    datapath, 'tfrecords', 'das_high_prob_balanced', 'train_stats.npz')
+das_clip_percentile = 85
+# continuous DAS data is read and processed in chunks, with an overlap on each
+# side of the chunk to absorb the filter edge effects
+das_chunk_window = 60 * 60  # seconds
+das_chunk_overlap = 60  # seconds
+# chunks are read ahead from the DAS archive in background threads
+das_read_workers = 2
+das_prefetch_depth = 4  # chunks
 
 seismometer_dt = 0.01
 seismometer_downsampling_factor = 4
+# continuous records are processed in blocks of raw samples, with an overlap
+# on each side of the block to absorb the filter edge effects
+seismometer_block_size = 360000  # 1 hour
+seismometer_block_overlap = 6000  # 1 minute
 
 channel_subset1 = list(range(13, 301))
 channel_subset2 = list(range(328, 616))
@@ -77,3 +127,5 @@ continuous_starttime = datetime.datetime(2016, 9, 2)
 continuous_endtime = datetime.datetime(2019, 12, 10)
 
 n_threads = 8
+# number of worker processes for processing the event and noise windows
+n_workers = 8
@@ -1,5 +1,8 @@
 """DAS data processing."""
 
+import collections
+import functools
+import itertools
 import logging
 import os
 
@@ -7,7 +10,12 @@ import h5py
 import numpy as np
 from processing_utils import processing_utils as processing
 
+from preprocessing import batch_processing
+from preprocessing import ledger
+from preprocessing import parallel
 from preprocessing import parameters
+from preprocessing import stages
+from preprocessing import window_store
 
 
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +29,15 @@ def _process(data, low_freq, high_freq, dt, q):
   return data
 
 
+# stage functions, called with their parameters by name
+def _bandpass(data, low_freq, high_freq, dt):
+  return processing.bandpass(data, low_freq, high_freq, dt)
+
+
+def _decimate(data, q):
+  return processing.decimate(data, q)
+
+
 def _crop(data, raw_window, detect_window, event_duration, dt):
   sps = 1 // dt
   start_sample = int((raw_window / 2 - (detect_window - event_duration)) * sps)
@@ -37,9 +54,10 @@ def _get_label(filename):
 
 
 def write_hdf5(out_file, data, label):
-  with h5py.File(out_file, 'w') as f:
-    f.create_dataset('input', data=data)
-    f.create_dataset('label', data=label)
+  with ledger.atomic_output(out_file) as tmp_file:
+    with h5py.File(tmp_file, 'w') as f:
+      f.create_dataset('input', data=data)
+      f.create_dataset('label', data=label)
 
 
 def read_hdf5(filename):
@@ -47,27 +65,177 @@ def read_hdf5(filename):
     return f.get('data')[()]
 
 
+def get_stages(raw_window, detect_window, event_duration, low_freq,
+               high_freq, dt, q):
+  """Returns the processing chain of `_process` and `_crop` as stages."""
+  return [
+      stages.Stage('read', read_hdf5, cache=False),
+      stages.Stage('strain_rate', processing.get_strain_rate),
+      stages.Stage('remove_median', processing.remove_median),
+      stages.Stage('bandpass', _bandpass,
+                   dict(low_freq=low_freq, high_freq=high_freq, dt=dt)),
+      stages.Stage('decimate', _decimate, dict(q=q)),
+      stages.Stage('crop', _crop,
+                   dict(raw_window=raw_window, detect_window=detect_window,
+                        event_duration=event_duration, dt=dt * q),
+                   cache=False),
+  ]
+
+
+def _get_out_files(filename, in_dir, out_dir):
+  """Gets the output files of the two channel subsets of a window file."""
+  out_file = filename.replace(in_dir, out_dir)
+  return (out_file.replace('.hdf5', '_1.h5'),
+          out_file.replace('.hdf5', '_2.h5'))
+
+
+def _has_output(filename, in_dir, out_dir, store=None):
+  """Checks whether the windows of a window file were written."""
+  if store is not None:
+    return filename in store
+  return all(os.path.isfile(out_file)
+             for out_file in _get_out_files(filename, in_dir, out_dir))
+
+
+def _write_channel_subsets(filename, data, in_dir, out_dir, channel_subset1,
+                           channel_subset2, return_data=False):
+  """Writes the two channel subsets of a processed window.
+
+  Args:
+    return_data: If True, return the channel subsets instead of writing them.
+
+  Returns:
+    (pid, data) tuple, where pid is the id of the process that handled the
+    file, for progress reporting, and data is None or a list of
+    (data, label, channel_subset) tuples.
+  """
+  label = _get_label(filename)
+  data1 = data[channel_subset1]
+  data2 = data[channel_subset2]
+  data2 = data2[::-1]
+  if return_data:
+    return os.getpid(), [(data1, label, 1), (data2, label, 2)]
+  out_file1, out_file2 = _get_out_files(filename, in_dir, out_dir)
+  os.makedirs(os.path.dirname(out_file1), exist_ok=True)
+  write_hdf5(out_file1, data1, label)
+  write_hdf5(out_file2, data2, label)
+  return os.getpid(), None
+
+
+def _process_file(filename, pipeline, **kwargs):
+  """Processes a single window file and writes its two channel subsets.
+
+  Args:
+    **kwargs: Arguments of `_write_channel_subsets`.
+  """
+  return _write_channel_subsets(filename, pipeline.run(filename), **kwargs)
+
+
+def _process_batch(filenames, raw_window, detect_window, event_duration,
+                   low_freq, high_freq, dt, q, **kwargs):
+  """Processes a batch of window files with `batch_processing.process_das`
+  and writes their two channel subsets.
+
+  Args:
+    **kwargs: Arguments of `_write_channel_subsets`.
+
+  Returns:
+    List of the `_write_channel_subsets` results of the files.
+  """
+  windows = batch_processing.process_das(
+      [read_hdf5(filename) for filename in filenames], low_freq, high_freq,
+      dt, q)
+  return [_write_channel_subsets(
+      filename, _crop(data, raw_window, detect_window, event_duration,
+                      dt * q), **kwargs)
+          for filename, data in zip(filenames, windows)]
+
+
 def process(file_pattern, in_dir, out_dir, raw_window, detect_window,
             event_duration, low_freq, high_freq, dt, q,
-            channel_subset1, channel_subset2):
-  filenames = processing.get_filenames(file_pattern)
+            channel_subset1, channel_subset2, n_workers=1, max_in_flight=None,
+            cache_dir=None, ledger_file=None, store_file=None, batch_size=1):
+  """Processes the DAS event and noise windows.
+
+  Args:
+    n_workers: Number of worker processes. Output file names only depend on
+      the input file names, so the output is the same for any worker count.
+    max_in_flight: Maximum number of files, or batches of files, queued for
+      the workers at any time. Defaults to four times the number of workers.
+    cache_dir: If set, the intermediate stage outputs are cached in this
+      directory, so that a parameter change only recomputes the stages
+      downstream of it.
+    ledger_file: If set, the completed input files are recorded in this
+      ledger, and files already completed with the same parameters whose
+      outputs exist are skipped.
+    store_file: If set, the windows are appended to this consolidated
+      window store instead of being written to two files per window.
+    batch_size: Number of windows processed together with
+      `batch_processing.process_das`. Batches bypass the stage cache, so
+      they cannot be combined with `cache_dir`.
 
-  for i, filename in enumerate(filenames):
+  Raises:
+    ValueError: if both `batch_size` and `cache_dir` are set.
+  """
+  if batch_size > 1 and cache_dir:
+    raise ValueError('Batches cannot be combined with the stage cache.')
+  filenames = list(processing.get_filenames(file_pattern))
+  params = dict(
+      raw_window=raw_window, detect_window=detect_window,
+      event_duration=event_duration, low_freq=low_freq,
+      high_freq=high_freq, dt=dt, q=q, channel_subset1=channel_subset1,
+      channel_subset2=channel_subset2)
+  store = None
+  if store_file:
+    os.makedirs(os.path.dirname(store_file), exist_ok=True)
+    store = window_store.WindowStore(store_file)
+    # windows processed with other parameters are removed, and those of an
+    # interrupted append are processed again
+    store.reset(ledger.fingerprint(params))
+    store.repair()
+  completion_ledger = None
+  if ledger_file:
+    completion_ledger = ledger.CompletionLedger(ledger_file, params)
+    filenames = completion_ledger.filter_incomplete(
+        filenames, functools.partial(_has_output, in_dir=in_dir,
+                                     out_dir=out_dir, store=store))
+  cache = stages.StageCache(cache_dir) if cache_dir else None
+  pipeline = stages.Pipeline(
+      get_stages(raw_window, detect_window, event_duration, low_freq,
+                 high_freq, dt, q),
+      cache=cache)
+  write_params = dict(
+      in_dir=in_dir, out_dir=out_dir, channel_subset1=channel_subset1,
+      channel_subset2=channel_subset2, return_data=store_file is not None)
+  if batch_size > 1:
+    process_batch = functools.partial(
+        _process_batch, raw_window=raw_window, detect_window=detect_window,
+        event_duration=event_duration, low_freq=low_freq,
+        high_freq=high_freq, dt=dt, q=q, **write_params)
+    batches = [filenames[i:i + batch_size]
+               for i in range(0, len(filenames), batch_size)]
+    results = itertools.chain.from_iterable(parallel.imap_bounded(
+        process_batch, batches, n_workers, max_in_flight))
+  else:
+    process_file = functools.partial(_process_file, pipeline=pipeline,
+                                     **write_params)
+    results = parallel.imap_bounded(
+        process_file, filenames, n_workers, max_in_flight)
+  worker_counts = collections.Counter()
+  for i, (filename, (worker, windows)) in enumerate(zip(filenames, results)):
     if i % 1000 == 0:
       logging.info('Processed %s files.', i)
-    data = read_hdf5(filename)
-    data = _process(data, low_freq, high_freq, dt, q)
-    data = _crop(data, raw_window, detect_window, event_duration, dt * q)
-    label = _get_label(filename)
-    out_file = filename.replace(in_dir, out_dir)
-    os.makedirs(os.path.dirname(out_file), exist_ok=True)
-    data1 = data[channel_subset1]
-    data2 = data[channel_subset2]
-    data2 = data2[::-1]
-    out_file1 = out_file.replace('.hdf5', '_1.h5')
-    out_file2 = out_file.replace('.hdf5', '_2.h5')
-    write_hdf5(out_file1, data1, label)
-    write_hdf5(out_file2, data2, label)
+    worker_counts[worker] += 1
+    if store is not None:
+      store.replace(filename, windows)
+      store.flush()
+    if completion_ledger is not None:
+      completion_ledger.record(filename)
+  if store is not None:
+    store.close()
+  logging.info('Processed %s files.', sum(worker_counts.values()))
+  for worker, count in sorted(worker_counts.items()):
+    logging.info('Worker %s processed %s files.', worker, count)
 
 
 def main():
@@ -86,7 +254,15 @@ def main():
       dt=parameters.das_dt,
       q=parameters.das_downsampling_factor,
       channel_subset1=parameters.channel_subset1,
-      channel_subset2=parameters.channel_subset2
+      channel_subset2=parameters.channel_subset2,
+      n_workers=parameters.n_workers,
+      cache_dir=parameters.stage_cache_datapath,
+      batch_size=parameters.window_batch_size,
+      ledger_file=os.path.join(
+          parameters.processed_datapath, datatype, 'ledger.jsonl'),
+      store_file=(os.path.join(parameters.processed_datapath, datatype,
+                               parameters.window_store_file)
+                  if parameters.use_window_store else None),
   )
 
 
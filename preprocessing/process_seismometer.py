@@ -1,5 +1,7 @@
 """DAS data processing."""
 
+import functools
+import itertools
 import logging
 import os
 
@@ -7,18 +9,36 @@ import h5py
 import numpy as np
 from processing_utils import processing_utils as processing
 
+from preprocessing import batch_processing
+from preprocessing import ledger
 from preprocessing import parameters
+from preprocessing import stages
+from preprocessing import window_store
 
 
 logging.basicConfig(level=logging.INFO)
 
 
+_N_SAMPLES = 8640000
+_CHANNEL_KEYS = ['JRSC.HNE', 'JRSC.HNN', 'JRSC.HNZ',
+                 'JSFB.HNE', 'JSFB.HNN', 'JSFB.HNZ']
+
+
 def _process(data, low_freq, high_freq, dt, q):
   data = processing.bandpass(data, low_freq, high_freq, dt)
   data = processing.decimate(data, q)
   return data
 
 
+# stage functions, called with their parameters by name
+def _bandpass(data, low_freq, high_freq, dt):
+  return processing.bandpass(data, low_freq, high_freq, dt)
+
+
+def _decimate(data, q):
+  return processing.decimate(data, q)
+
+
 def _crop(data, raw_window, detect_window, event_duration, dt):
   sps = 1 // dt
   start_sample = int((raw_window / 2 - (detect_window - event_duration)) * sps)
@@ -35,64 +55,264 @@ def _get_label(filename):
 
 
 def write_hdf5(out_file, data, label=None):
-  with h5py.File(out_file, 'w') as f:
-    f.create_dataset('input', data=data)
-    if label is not None:
-      f.create_dataset('label', data=label)
+  with ledger.atomic_output(out_file) as tmp_file:
+    with h5py.File(tmp_file, 'w') as f:
+      f.create_dataset('input', data=data)
+      if label is not None:
+        f.create_dataset('label', data=label)
+
 
+def read_hdf5(filename, low_freq=parameters.low_freq,
+              high_freq=parameters.high_freq, dt=parameters.seismometer_dt,
+              q=parameters.seismometer_downsampling_factor,
+              n_samples=_N_SAMPLES):
+  """Reads, bandpasses and decimates the seismometer channels.
 
-def read_hdf5(filename):
-  channels = []
-  n_samples = 8640000
-  keys = ['JRSC.HNE', 'JRSC.HNN', 'JRSC.HNZ',
-          'JSFB.HNE', 'JSFB.HNN', 'JSFB.HNZ']
+  Args:
+    n_samples: Length to which the channels are zero-padded. If None, the
+      channels are padded to the length of the longest one.
+  """
+  traces = []
   with h5py.File(filename, 'r') as f:
-    for key in keys:
-      channel = np.zeros((n_samples,), dtype=np.float32)
+    for key in _CHANNEL_KEYS:
+      trace = None
       if key in f.keys():
-        tmp = _process(
-            f.get(key)[()], parameters.low_freq, parameters.high_freq,
-            parameters.seismometer_dt,
-            parameters.seismometer_downsampling_factor)
-        channel[:tmp.shape[0]] = tmp
-      channels.append(channel)
-    return np.stack(channels, axis=0)
-  return None
+        trace = _process(f.get(key)[()], low_freq, high_freq, dt, q)
+      traces.append(trace)
+  return _pad_channels(traces, n_samples)
+
+
+def _pad_channels(traces, n_samples):
+  """Stacks the channel traces, zero-padded to `n_samples`, or to the
+  longest trace if None. Missing channels are None and left at zero."""
+  if n_samples is None:
+    n_samples = max(
+        [trace.shape[0] for trace in traces if trace is not None], default=0)
+  channels = np.zeros((len(traces), n_samples), dtype=np.float32)
+  for i, trace in enumerate(traces):
+    if trace is not None:
+      channels[i, :trace.shape[0]] = trace
+  return channels
+
+
+def read_hdf5_batch(filenames, low_freq, high_freq, dt, q, n_samples=None):
+  """Batch version of `read_hdf5`, which processes the channels of all the
+  files with `batch_processing.process_seismometer`.
+
+  Returns:
+    List of the (channels, samples) windows of the files.
+  """
+  raw_traces = []
+  for filename in filenames:
+    with h5py.File(filename, 'r') as f:
+      raw_traces.append([f.get(key)[()] if key in f.keys() else None
+                         for key in _CHANNEL_KEYS])
+  present = [trace for traces in raw_traces for trace in traces
+             if trace is not None]
+  processed = iter(batch_processing.process_seismometer(
+      present, low_freq, high_freq, dt, q))
+  return [_pad_channels([None if trace is None else next(processed)
+                         for trace in traces], n_samples)
+          for traces in raw_traces]
+
+
+def get_stages(raw_window, detect_window, event_duration, low_freq,
+               high_freq, dt, q):
+  """Returns the processing chain of `process_windows` as stages.
+
+  `read_hdf5` already bandpasses and decimates every channel, so the
+  following bandpass and decimation stages with the same parameters are
+  detected as duplicates and skipped by the pipeline. The windows are only
+  padded to their own length, since the crop does not reach beyond it.
+  """
+  bandpass_params = dict(low_freq=low_freq, high_freq=high_freq, dt=dt)
+  decimate_params = dict(q=q)
+  return [
+      stages.Stage('read', read_hdf5,
+                   dict(bandpass_params, q=q, n_samples=None),
+                   provides=[('bandpass', bandpass_params),
+                             ('decimate', decimate_params)]),
+      stages.Stage('bandpass', _bandpass, bandpass_params),
+      stages.Stage('decimate', _decimate, decimate_params),
+      stages.Stage('crop', _crop,
+                   dict(raw_window=raw_window, detect_window=detect_window,
+                        event_duration=event_duration, dt=dt * q),
+                   cache=False),
+  ]
+
+
+def _get_out_file(filename, in_dir, out_dir):
+  """Gets the output file of a window file."""
+  return filename.replace(in_dir, out_dir).replace('.hdf5', '.h5')
+
+
+def _has_output(filename, in_dir, out_dir, store=None):
+  """Checks whether the window of a window file was written."""
+  if store is not None:
+    return filename in store
+  return os.path.isfile(_get_out_file(filename, in_dir, out_dir))
 
 
 def process_windows(file_pattern, in_dir, out_dir, raw_window, detect_window,
-                    event_duration, low_freq, high_freq, dt, q
-                    ):
-  filenames = processing.get_filenames(file_pattern)
+                    event_duration, low_freq, high_freq, dt, q, cache_dir=None,
+                    ledger_file=None, store_file=None, batch_size=1):
+  """Processes the seismometer event and noise windows.
 
-  for i, filename in enumerate(filenames):
+  Args:
+    cache_dir: If set, the intermediate stage outputs are cached in this
+      directory, so that a parameter change only recomputes the stages
+      downstream of it.
+    ledger_file: If set, the completed input files are recorded in this
+      ledger, and files already completed with the same parameters whose
+      output exists are skipped.
+    store_file: If set, the windows are appended to this consolidated
+      window store instead of being written to one file per window.
+    batch_size: Number of windows processed together with
+      `read_hdf5_batch`. Batches bypass the stage cache, so they cannot be
+      combined with `cache_dir`.
+
+  Raises:
+    ValueError: if both `batch_size` and `cache_dir` are set.
+  """
+  if batch_size > 1 and cache_dir:
+    raise ValueError('Batches cannot be combined with the stage cache.')
+  filenames = list(processing.get_filenames(file_pattern))
+  params = dict(
+      raw_window=raw_window, detect_window=detect_window,
+      event_duration=event_duration, low_freq=low_freq,
+      high_freq=high_freq, dt=dt, q=q)
+  store = None
+  if store_file:
+    os.makedirs(os.path.dirname(store_file), exist_ok=True)
+    store = window_store.WindowStore(store_file)
+    # windows processed with other parameters are removed, and those of an
+    # interrupted append are processed again
+    store.reset(ledger.fingerprint(params))
+    store.repair()
+  completion_ledger = None
+  if ledger_file:
+    completion_ledger = ledger.CompletionLedger(ledger_file, params)
+    filenames = completion_ledger.filter_incomplete(
+        filenames, functools.partial(_has_output, in_dir=in_dir,
+                                     out_dir=out_dir, store=store))
+  cache = stages.StageCache(cache_dir) if cache_dir else None
+  pipeline = stages.Pipeline(
+      get_stages(raw_window, detect_window, event_duration, low_freq,
+                 high_freq, dt, q),
+      cache=cache)
+  if batch_size > 1:
+    windows = itertools.chain.from_iterable(
+        read_hdf5_batch(filenames[i:i + batch_size], low_freq, high_freq, dt,
+                        q)
+        for i in range(0, len(filenames), batch_size))
+    windows = (_crop(data, raw_window, detect_window, event_duration, dt * q)
+               for data in windows)
+  else:
+    windows = map(pipeline.run, filenames)
+  for i, (filename, data) in enumerate(zip(filenames, windows)):
     if i % 1000 == 0:
       logging.info('Processed %s files.', i)
-    data = read_hdf5(filename)
-    if data is not None:
-      data = _process(data, low_freq, high_freq, dt, q)
-      data = _crop(data, raw_window, detect_window, event_duration, dt * q)
-      label = _get_label(filename)
-      out_file = filename.replace(in_dir, out_dir)
+    label = _get_label(filename)
+    if store is not None:
+      store.replace(filename, [(data, label, 0)])
+      store.flush()
+    else:
+      out_file = _get_out_file(filename, in_dir, out_dir)
       os.makedirs(os.path.dirname(out_file), exist_ok=True)
-      out_file = out_file.replace('.hdf5', '.h5')
       write_hdf5(out_file, data, label)
+    if completion_ledger is not None:
+      completion_ledger.record(filename)
+  if store is not None:
+    store.close()
+
+
+def _process_channel_in_blocks(dataset, out, column, low_freq, high_freq, dt,
+                               q, block_size, block_overlap):
+  """Processes a channel block by block and writes it to column `column`.
+
+  Each block is read with `block_overlap` extra samples on both sides so that
+  the filter transients at the block edges are cropped out. The transients
+  decay exponentially, so the output only approximately matches processing
+  the full channel at once: with the default one-minute overlap, the
+  difference is below 1e-12 of the peak amplitude, under the float32
+  rounding of the output, but without an overlap it is of the order of the
+  signal at the block edges.
+  """
+  n_samples = dataset.shape[0]
+  block_size = max(block_size // q, 1) * q
+  block_overlap = -(-block_overlap // q) * q
+  for start in range(0, n_samples, block_size):
+    end = min(start + block_size, n_samples)
+    padded_start = max(start - block_overlap, 0)
+    padded_end = min(end + block_overlap, n_samples)
+    block = _process(dataset[padded_start:padded_end], low_freq, high_freq,
+                     dt, q)
+    offset = (start - padded_start) // q
+    count = -(-(end - start) // q)
+    out[start // q:start // q + count, column] = (
+        block[offset:offset + count])
+
+
+def write_hdf5_streaming(out_file, filename, low_freq, high_freq, dt, q,
+                         block_size, block_overlap):
+  """Streaming version of `read_hdf5` followed by `write_hdf5`.
+
+  The channels are processed in blocks of `block_size` raw samples and
+  appended to a chunked output dataset, so that peak memory depends on the
+  block size rather than on the length of the record.
+  """
+  with ledger.atomic_output(out_file) as tmp_file, \
+          h5py.File(filename, 'r') as f_in, h5py.File(tmp_file, 'w') as f_out:
+    chunk_rows = min(max(block_size // q, 1), _N_SAMPLES)
+    out = f_out.create_dataset(
+        'input', shape=(_N_SAMPLES, len(_CHANNEL_KEYS)), dtype=np.float32,
+        chunks=(chunk_rows, 1), fillvalue=0)
+    for column, key in enumerate(_CHANNEL_KEYS):
+      if key in f_in.keys():
+        _process_channel_in_blocks(
+            f_in.get(key), out, column, low_freq, high_freq, dt, q,
+            block_size, block_overlap)
 
 
 def process_continuous(file_pattern, in_dir, out_dir, raw_window, low_freq,
-                       high_freq, dt, q):
-  filenames = processing.get_filenames(file_pattern)
+                       high_freq, dt, q, block_size=None, block_overlap=6000,
+                       ledger_file=None):
+  """Processes the continuous seismometer records.
+
+  Args:
+    block_size: If set, process each channel in blocks of `block_size` raw
+      samples instead of loading full records into memory.
+    block_overlap: Number of raw samples read on each side of a block to
+      absorb filter edge effects in block mode.
+    ledger_file: If set, the completed input files are recorded in this
+      ledger, and files already completed with the same parameters whose
+      output exists are skipped. Otherwise, files with an existing output
+      are skipped.
+  """
+  filenames = list(processing.get_filenames(file_pattern))
+  completion_ledger = None
+  if ledger_file:
+    completion_ledger = ledger.CompletionLedger(ledger_file, dict(
+        low_freq=low_freq, high_freq=high_freq, dt=dt, q=q))
+    filenames = completion_ledger.filter_incomplete(
+        filenames, lambda filename: os.path.exists(
+            filename.replace(in_dir, out_dir)))
 
   for i, filename in enumerate(filenames):
     if i % 1000 == 0:
       logging.info('Processed %s files.', i)
     out_file = filename.replace(in_dir, out_dir)
-    if not os.path.exists(out_file):
-      data = read_hdf5(filename)
-      if data is not None:
-        data = data.T
-        os.makedirs(os.path.dirname(out_file), exist_ok=True)
-        write_hdf5(out_file, data)
+    if completion_ledger is None and os.path.exists(out_file):
+      continue
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    if block_size:
+      write_hdf5_streaming(out_file, filename, low_freq, high_freq, dt, q,
+                           block_size, block_overlap)
+    else:
+      data = read_hdf5(filename, low_freq, high_freq, dt, q)
+      write_hdf5(out_file, data.T)
+    if completion_ledger is not None:
+      completion_ledger.record(filename)
 
 
 def main():
@@ -110,6 +330,13 @@ def main():
       high_freq=parameters.high_freq,
       dt=parameters.seismometer_dt,
       q=parameters.seismometer_downsampling_factor,
+      cache_dir=parameters.stage_cache_datapath,
+      batch_size=parameters.window_batch_size,
+      ledger_file=os.path.join(
+          parameters.processed_datapath, datatype, 'ledger.jsonl'),
+      store_file=(os.path.join(parameters.processed_datapath, datatype,
+                               parameters.window_store_file)
+                  if parameters.use_window_store else None),
   )
   file_pattern = os.path.join(datapath, 'continuous/*')
   process_continuous(
@@ -121,6 +348,10 @@ def main():
       high_freq=parameters.high_freq,
       dt=parameters.seismometer_dt,
       q=parameters.seismometer_downsampling_factor,
+      block_size=parameters.seismometer_block_size,
+      block_overlap=parameters.seismometer_block_overlap,
+      ledger_file=os.path.join(
+          parameters.processed_datapath, datatype, 'continuous_ledger.jsonl'),
   )
 
 
@@ -1,10 +1,14 @@
-import datetime as dt
+import datetime
+import functools
 import logging
 import os
+import threading
 
 import numpy as np
 
 from das_reader.reader import Reader
+from preprocessing import normalization_stats
+from preprocessing import parallel
 from preprocessing import parameters
 from processing_utils import processing_utils as processing
 
@@ -19,17 +23,91 @@ def process(raw_data, low_freq, high_freq, dt, q, clip_val, norm_val):
   return data
 
 
-def pull_das_data(reader, starttime, window, low_freq, high_freq, dt, q,
-    clip_val, norm_val):
-  raw_data = reader.readData(starttime, window)
-  if raw_data is not None:
-    data = process(raw_data, low_freq, high_freq, dt, q, clip_val, norm_val)
-    return data
-  return None
-
-
-def pull_continuous_data(reader, datapath, starttime, endtime, window, low_freq,
-    high_freq, dt, q, clip_val, norm_val,):
+def _to_samples(seconds, dt):
+  return int(round(seconds / dt))
+
+
+def load_continuous(filename):
+  """Opens a continuous data file without loading it into memory.
+
+  Any time slice, e.g. `load_continuous(filename)[:, start:end]`, is only read
+  from disk when accessed.
+  """
+  return np.load(filename, mmap_mode='r')
+
+
+def _get_chunks(n_samples, chunk_size, overlap):
+  """Splits a window into chunks, each padded with `overlap` samples on both
+  sides.
+
+  Yields:
+    (start, end, padded_start, padded_end) sample indices.
+  """
+  for start in range(0, n_samples, chunk_size):
+    end = min(start + chunk_size, n_samples)
+    yield start, end, max(start - overlap, 0), min(end + overlap, n_samples)
+
+
+class _ContinuousFileWriter():
+  """Fills a memory-mapped `.npy` file with processed chunks of a window.
+
+  The file is written under a temporary name and renamed on `close`, and only
+  created once a first chunk of data is available.
+  """
+
+  def __init__(self, filename, timestamp, n_samples):
+    self.filename = filename
+    self.timestamp = timestamp
+    self.n_samples = n_samples
+    self.num_missing = 0
+    self._tmp_filename = '{}.tmp.npy'.format(filename[:-len('.npy')])
+    self._out = None
+
+  def write(self, start, data):
+    if self._out is None:
+      self._out = np.lib.format.open_memmap(
+          self._tmp_filename, mode='w+', dtype=np.float32,
+          shape=(data.shape[0], self.n_samples))
+    self._out[:, start:start + data.shape[1]] = data
+    self._out.flush()
+
+  def close(self):
+    if self._out is None:
+      logging.info('No available DAS data for %s.', self.timestamp)
+      return
+    if self.num_missing:
+      logging.warning('No available DAS data for %s of the chunks from %s.',
+                      self.num_missing, self.timestamp)
+    self._out = None
+    os.replace(self._tmp_filename, self.filename)
+
+
+def pull_continuous_data(make_reader, datapath, starttime, endtime, window,
+                         low_freq, high_freq, dt, q, clip_val, norm_val,
+                         chunk_window=None, chunk_overlap=60, n_workers=1,
+                         prefetch_depth=2):
+  """Pulls and processes continuous data into one `.npy` file per window.
+
+  Each window is read and processed in chunks, which are written into a
+  memory-mapped `.npy` file, so only a few chunks of data are held in memory.
+  Each chunk is read with `chunk_overlap` extra seconds on both sides, which
+  are cropped after processing to remove the filter edge effects.
+
+  The next chunks are read from the DAS archive in background threads while
+  the current chunk is processed. The DAS reader is not known to be
+  thread-safe, so each thread reads through its own reader.
+
+  Args:
+    make_reader: Function creating a DAS `Reader`, called once per reading
+      thread.
+    chunk_window: Length of the chunks in which each window is read and
+      processed (seconds). Defaults to the full window.
+    chunk_overlap: Overlap on each side of the chunks (seconds).
+    n_workers: Number of threads reading ahead. With no threads, reading and
+      processing run in sequence.
+    prefetch_depth: Maximum number of chunks read ahead of the one being
+      processed.
+  """
   logging.info('Downloading continuous data...')
   datapath = os.path.join(datapath, 'continuous')
   os.makedirs(datapath, exist_ok=True)
@@ -37,27 +115,60 @@ def pull_continuous_data(reader, datapath, starttime, endtime, window, low_freq,
 
   starttimes = [starttime, ]
   while starttimes[-1] < endtime:
-    starttimes.append(starttimes[-1] + dt.timedelta(seconds=window))
-
-  for timestamp in starttimes:
-    data, headers = pull_das_data(reader, timestamp, window, low_freq,
-        high_freq, dt, q, clip_val, norm_val)
-    if data is not None:
+    starttimes.append(starttimes[-1] + datetime.timedelta(seconds=window))
+
+  n_samples = _to_samples(window, dt)
+  chunk_size = max(_to_samples(chunk_window or window, dt) // q, 1) * q
+  overlap = -(-_to_samples(chunk_overlap, dt) // q) * q
+  chunks = [(timestamp, chunk) for timestamp in starttimes
+            for chunk in _get_chunks(n_samples, chunk_size, overlap)]
+
+  local = threading.local()
+
+  def read_chunk(item):
+    if not hasattr(local, 'reader'):
+      local.reader = make_reader()
+    timestamp, (_, _, padded_start, padded_end) = item
+    return local.reader.readData(
+        timestamp + datetime.timedelta(seconds=padded_start * dt),
+        round((padded_end - padded_start) * dt, 6))
+
+  writer = None
+  raw_chunks = parallel.prefetch(read_chunk, chunks, n_workers, prefetch_depth)
+  for (timestamp, chunk), raw_data in zip(chunks, raw_chunks):
+    start, end, padded_start, _ = chunk
+    if start == 0:
+      if writer is not None:
+        writer.close()
       filename = os.path.join(
           datapath, 'data_{}.npy'.format(timestamp.strftime('%Y%m%d_%H%M%S')))
-      np.save(filename, data)
-    else:
-      logging.info('No available DAS data for %s.', timestamp)
+      writer = _ContinuousFileWriter(filename, timestamp, -(-n_samples // q))
+    if raw_data is None:
+      writer.num_missing += 1
+      continue
+    data = process(raw_data, low_freq, high_freq, dt, q, clip_val, norm_val)
+    offset = (start - padded_start) // q
+    count = -(-(end - start) // q)
+    writer.write(start // q, data[:, offset:offset + count])
+  if writer is not None:
+    writer.close()
 
 
 def main():
-  channels = parameters.channel_subset1
+  make_reader = functools.partial(
+      Reader, channels=parameters.channel_subset1,
+      sampling=parameters.passive_das_sampling)
 
-  reader = Reader(channels=channels, sampling=parameters.passive_das_sampling)
+  clip_val, norm_val = parameters.das_clip_val, parameters.das_norm_val
+  if parameters.das_stats_file and os.path.exists(parameters.das_stats_file):
+    clip_val, norm_val = normalization_stats.load_clip_and_std(
+        parameters.das_stats_file, parameters.das_clip_percentile)
+    logging.info('Using the normalization statistics of %s.',
+                 parameters.das_stats_file)
 
   logging.info('Pulling continuous DAS data...')
   pull_continuous_data(
-      reader=reader,
+      make_reader=make_reader,
       datapath=os.path.join(parameters.raw_datapath, 'das'),
       starttime=parameters.continuous_starttime,
       endtime=parameters.continuous_endtime,
@@ -66,8 +177,12 @@ def main():
       high_freq=parameters.high_freq,
       dt=parameters.das_dt,
       q=parameters.das_downsampling_factor,
-      clip_val=parameters.das_clip_val, 
-      norm_val=parameters.das_norm_val,
+      clip_val=clip_val,
+      norm_val=norm_val,
+      chunk_window=parameters.das_chunk_window,
+      chunk_overlap=parameters.das_chunk_overlap,
+      n_workers=parameters.das_read_workers,
+      prefetch_depth=parameters.das_prefetch_depth,
   )
 
 
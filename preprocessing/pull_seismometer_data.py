@@ -10,35 +10,62 @@ from typing import List, Text
 
 import h5py
 import numpy as np
-import pandas as pd
 from obspy import UTCDateTime
 from obspy.clients.fdsn import Client
 
+from preprocessing import catalog_store
+from preprocessing import fdsn_download
 from preprocessing import parameters
 
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
 
+_FAILURE_FILE = 'failures.jsonl'
+
+
 class WaveformDownloader():
   """Class for downloading waveforms from the seismic network.
 
   Attr:
-    client: Seismic network client.
+    client: Seismic network client, used by the 'process' engine.
+    session: FDSN session, used by the 'thread' engine.
     network: Network code.
     stations: Seismic stations for which to download the data.
     channels: Channels for which to download the data.
     location: Location for which to download the data.
     datapath: Path to where to write the data.
+    engine: 'process' to download with a multiprocessing pool and the obspy
+      client, or 'thread' to download with a thread pool, retries and rate
+      limiting.
     """
 
   def __init__(
       self, clientcode: Text, network: Text, stations: List[Text],
       channels: List[Text], location: Text, datapath: Text,
+      engine: Text = 'process', max_retries: int = 5,
+      max_requests_per_second: float = 10.0,
   ):
-    """Initialization."""
+    """Initialization.
+
+    Args:
+      clientcode: Obspy client code, or base URL of an FDSN service.
+      max_retries: Maximum number of retries of a failed request, for the
+        'thread' engine.
+      max_requests_per_second: Maximum request rate, for the 'thread' engine.
+    """
+    if engine not in ('process', 'thread'):
+      raise ValueError("engine should be 'process' or 'thread'.")
+    self.engine = engine
     # Seismic network parameters
-    self.client = Client(clientcode)
+    self.client = None
+    self.session = None
+    if engine == 'process':
+      self.client = Client(clientcode)
+    else:
+      self.session = fdsn_download.FDSNSession(
+          clientcode, max_retries=max_retries,
+          max_requests_per_second=max_requests_per_second)
     self.network = network
     self.stations = ','.join(stations)
     self.channels = ','.join(channels)
@@ -48,7 +75,8 @@ class WaveformDownloader():
     self.datapath = datapath
 
   def get_catalog_waveforms(self, catalog: Text, prefix: Text, window: int,
-                            batch: int = 1000, n_threads: int = 8):
+                            batch: int = 1000, n_threads: int = 8,
+                            bulk_size: int = 1):
     """Gets the waveforms corresponding to the time stamps in the catalog.
 
     The waveforms are downloaded from the seismic network client.
@@ -61,11 +89,21 @@ class WaveformDownloader():
       batch: Organize the files into subdirectories with `batch` number of
         files.
       n_threads: Number of threads to use.
+      bulk_size: Number of waveforms downloaded per request, for the 'thread'
+        engine. Overlapping time windows within a request are coalesced.
     """
     logging.info('Downloading %s waveforms...', prefix)
     datapath = os.path.join(self.datapath, 'seismometer/{}'.format(prefix))
     logging.info('Writing waveforms to %s', datapath)
-    df = pd.read_hdf(catalog, 'df')
+    df = catalog_store.load_catalog(catalog, columns=['datetime'])
+    if self.engine == 'thread':
+      tasks = [
+          _get_catalog_task(i, eventtime, window, datapath, prefix, batch)
+          for i, eventtime in enumerate(df['datetime'])]
+      fdsn_download.download(
+          self._download, fdsn_download.make_batches(tasks, bulk_size),
+          n_threads, os.path.join(datapath, _FAILURE_FILE))
+      return
     with multiprocessing.Pool(n_threads) as pool:
       pool.starmap(
           partial(
@@ -103,6 +141,13 @@ class WaveformDownloader():
     for timestamp in starttimes:
       filenames.append(os.path.join(
           datapath, 'data_{}.h5'.format(timestamp.strftime('%Y%m%d_%H%M%S'))))
+    if self.engine == 'thread':
+      tasks = [fdsn_download.DownloadTask(filename, timestamp, window)
+               for filename, timestamp in zip(filenames, starttimes)]
+      fdsn_download.download(
+          self._download, fdsn_download.make_batches(tasks, 1), n_threads,
+          os.path.join(datapath, _FAILURE_FILE))
+      return
     n_threads = min(n_threads, len(starttimes))
     with multiprocessing.Pool(n_threads) as pool:
       pool.starmap(
@@ -114,6 +159,82 @@ class WaveformDownloader():
           zip(filenames, starttimes)
       )
 
+  def retry_failures(self, failure_file: Text, n_threads: int = 8,
+                     bulk_size: int = 1):
+    """Downloads the waveforms listed in a failure manifest.
+
+    The manifest is rewritten with the downloads that failed again.
+
+    Args:
+      failure_file: Failure manifest written by a previous download.
+      n_threads: Number of concurrent downloads.
+      bulk_size: Number of waveforms downloaded per request.
+    """
+    if self.engine != 'thread':
+      raise ValueError("Retrying failures requires the 'thread' engine.")
+    tasks = fdsn_download.read_failures(failure_file)
+    logging.info('Retrying %s failed downloads...', len(tasks))
+    fdsn_download.download(
+        self._download, fdsn_download.make_batches(tasks, bulk_size),
+        n_threads, failure_file)
+
+  def _download(self, tasks: List[fdsn_download.DownloadTask]):
+    """Downloads a batch of waveforms with the FDSN session.
+
+    A single waveform is downloaded with a GET request. Several waveforms are
+    downloaded with a bulk request for their coalesced time windows, and the
+    returned stream is split back into one file per waveform.
+
+    Raises:
+      fdsn_download.DownloadError: The download failed.
+    """
+    if len(tasks) == 1:
+      starttime, endtime = fdsn_download.get_time_window(tasks[0])
+      st = self.session.get_waveforms(
+          network=self.network, station=self.stations,
+          location=self.location, channel=self.channels, starttime=starttime,
+          endtime=endtime)
+    else:
+      time_windows = fdsn_download.coalesce(
+          [fdsn_download.get_time_window(task) for task in tasks])
+      bulk = [(self.network, station, self.location, channel, starttime,
+               endtime)
+              for starttime, endtime in time_windows
+              for station in self.stations.split(',')
+              for channel in self.channels.split(',')]
+      st = self.session.get_waveforms_bulk(bulk)
+
+    for task in tasks:
+      task_st = st
+      if st is not None and len(tasks) > 1:
+        task_st = st.slice(*fdsn_download.get_time_window(task))
+      if not task_st:
+        logging.warning('No data available for %s.',
+                        os.path.basename(task.filename))
+        continue
+      _write_waveform(task.filename, task_st)
+
+
+def _get_catalog_task(
+        i: int, eventtime: dt.datetime, window: int, datapath: Text,
+        prefix: Text, batch: int,
+) -> fdsn_download.DownloadTask:
+  """Gets the file name and time window of a catalog waveform.
+
+  Args:
+    i: Event ID number.
+    eventtime: Time of the event.
+    window: Length of the data window (seconds).
+    datapath: Path to where to write the data.
+    prefix: Label for identifying the type of waveforms.
+    batch: Divide the files into subdirectories with `batch` number of files.
+  """
+  subfolder = os.path.join(datapath, '{:05d}'.format(i // batch * batch))
+  os.makedirs(subfolder, exist_ok=True)
+  starttime = eventtime - dt.timedelta(seconds=window//2)
+  filename = os.path.join(subfolder, '{}_{:05d}.h5'.format(prefix, i))
+  return fdsn_download.DownloadTask(filename, starttime, window)
+
 
 def _get_catalog_waveform(
         i: int, eventtime: dt.datetime, client: Client, network: Text,
@@ -138,10 +259,8 @@ def _get_catalog_waveform(
     prefix: Label for identifying the type of waveforms.
     batch: Divide the files into subdirectories with `batch` number of files.
   """
-  subfolder = os.path.join(datapath, '{:05d}'.format(i // batch * batch))
-  os.makedirs(subfolder, exist_ok=True)
-  starttime = eventtime - dt.timedelta(seconds=window//2)
-  filename = os.path.join(subfolder, '{}_{:05d}.h5'.format(prefix, i))
+  filename, starttime, _ = _get_catalog_task(
+      i, eventtime, window, datapath, prefix, batch)
   _get_waveform(
       filename=filename, starttime=starttime, window=window, client=client,
       network=network, stations=stations, channels=channels, location=location,
@@ -178,30 +297,37 @@ def _get_waveform(
     st = None
 
   if st is not None:
-    if not os.path.isfile(filename):
-      f = h5py.File(filename, 'w')
-    else:
-      f = h5py.File(filename, 'a')
-    for tr in st:
-      dataset_name = '{}.{}'.format(tr.stats.station, tr.stats.channel)
-      if dataset_name not in f.keys():
-        waveform = np.asarray(tr, dtype=np.float32)
-        f.create_dataset(dataset_name, data=waveform)
-    f.close()
+    _write_waveform(filename, st)
   else:
     logging.warning('Could not download data for %s.',
                     os.path.basename(filename))
 
 
+def _write_waveform(filename: Text, st):
+  """Writes the traces of a stream to an HDF5 file, one dataset per
+  station and channel. Traces already in the file are not overwritten."""
+  if not os.path.isfile(filename):
+    f = h5py.File(filename, 'w')
+  else:
+    f = h5py.File(filename, 'a')
+  for tr in st:
+    dataset_name = '{}.{}'.format(tr.stats.station, tr.stats.channel)
+    if dataset_name not in f.keys():
+      waveform = np.asarray(tr, dtype=np.float32)
+      f.create_dataset(dataset_name, data=waveform)
+  f.close()
+
+
 def parse_args():
   """Parse arguments."""
-  available_options = ['all', 'event', 'noise', 'continuous']
+  available_options = ['all', 'event', 'noise', 'continuous', 'retry']
 
   option = 'all'
   if len(sys.argv) > 1:
     option = sys.argv[1]
     if option not in available_options:
-      print("Argument should be 'all', 'event', 'noise', or 'continuous'")
+      print("Argument should be 'all', 'event', 'noise', 'continuous', or "
+            "'retry'")
       sys.exit()
   return option
 
@@ -212,24 +338,45 @@ def main():
       clientcode=parameters.clientcode, network=parameters.network,
       stations=parameters.stations, channels=parameters.channels,
       location=parameters.location, datapath=parameters.raw_datapath,
+      engine=parameters.download_engine,
+      max_retries=parameters.download_max_retries,
+      max_requests_per_second=parameters.download_max_requests_per_second,
   )
   option = parse_args()
+  if option == 'retry':
+    for prefix in ['event', 'noise', 'continuous']:
+      failure_file = os.path.join(
+          parameters.raw_datapath, 'seismometer', prefix, _FAILURE_FILE)
+      if os.path.isfile(failure_file):
+        # one continuous waveform per request, as in get_continuous_waveforms
+        bulk_size = parameters.download_bulk_size
+        if prefix == 'continuous':
+          bulk_size = 1
+        waveform_downloader.retry_failures(
+            failure_file, n_threads=parameters.download_threads,
+            bulk_size=bulk_size)
+    return
+  n_threads = parameters.n_threads
+  if parameters.download_engine == 'thread':
+    n_threads = parameters.download_threads
   if option in ['all', 'event']:
     waveform_downloader.get_catalog_waveforms(
         parameters.event_catalog, 'event', window=parameters.raw_window_length,
-        batch=parameters.batch, n_threads=parameters.n_threads
+        batch=parameters.batch, n_threads=n_threads,
+        bulk_size=parameters.download_bulk_size
     )
   if option in ['all', 'noise']:
     waveform_downloader.get_catalog_waveforms(
         parameters.noise_catalog, 'noise', window=parameters.raw_window_length,
-        batch=parameters.batch, n_threads=parameters.n_threads
+        batch=parameters.batch, n_threads=n_threads,
+        bulk_size=parameters.download_bulk_size
     )
   if option in ['all', 'continuous']:
     waveform_downloader.get_continuous_waveforms(
         starttime=parameters.continuous_starttime,
         endtime=parameters.continuous_endtime,
         window=parameters.continuous_window,
-        n_threads=parameters.n_threads
+        n_threads=n_threads
     )
 
 
@@ -0,0 +1,132 @@
+"""Processing stages with a content-addressed cache of their outputs.
+
+A processing chain is modeled as a list of `Stage`s. The cache key of a stage
+output is derived from the hash of the input file and the names and
+parameters of all the stages up to and including that stage, so changing a
+parameter only invalidates the outputs of the stages downstream of it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+
+def _signature(name, params):
+  return '{}:{}'.format(name, json.dumps(params, sort_keys=True, default=str))
+
+
+def file_hash(filename, block_size=1 << 20):
+  """Computes the SHA-256 hash of a file's content."""
+  sha = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+
+class Stage():
+  """A processing step and the parameters that determine its output.
+
+  Attr:
+    name: Stage name.
+    func: Function called as `func(data, **params)`.
+    params: Keyword parameters passed to `func`.
+    provides: (name, params) pairs of the operations that `func` already
+      applies internally, e.g. a reader that also filters the data.
+    cache: Whether to cache the stage output.
+  """
+
+  def __init__(self, name, func, params=None, provides=(), cache=True):
+    self.name = name
+    self.func = func
+    self.params = params or {}
+    self.provides = provides
+    self.cache = cache
+
+  @property
+  def signature(self):
+    return _signature(self.name, self.params)
+
+  def __call__(self, data):
+    return self.func(data, **self.params)
+
+
+class StageCache():
+  """On-disk cache of stage outputs, stored as `.npy` files by key."""
+
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir, key[:2], '{}.npy'.format(key))
+
+  def load(self, key):
+    path = self._path(key)
+    if os.path.isfile(path):
+      return np.load(path)
+    return None
+
+  def save(self, key, data):
+    path = self._path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      np.save(f, data)
+    os.replace(tmp_path, path)
+
+
+class Pipeline():
+  """Runs a chain of stages on an input file, reusing cached outputs.
+
+  Stages whose name and parameters match an operation already applied earlier
+  in the chain are skipped.
+  """
+
+  def __init__(self, stages, cache=None):
+    applied = set()
+    self.stages = []
+    for stage in stages:
+      if stage.signature in applied:
+        logging.warning('Skipping duplicate stage %s.', stage.signature)
+        continue
+      applied.add(stage.signature)
+      applied.update(_signature(name, params)
+                     for name, params in stage.provides)
+      self.stages.append(stage)
+    self.cache = cache
+
+  def _keys(self, filename):
+    keys = []
+    key = file_hash(filename)
+    for stage in self.stages:
+      key = hashlib.sha256(
+          '{}/{}'.format(key, stage.signature).encode()).hexdigest()
+      keys.append(key)
+    return keys
+
+  def run(self, filename):
+    """Runs the pipeline on `filename` and returns the last stage output."""
+    if self.cache is None:
+      data = filename
+      for stage in self.stages:
+        data = stage(data)
+      return data
+
+    keys = self._keys(filename)
+    data = filename
+    first = 0
+    for i in reversed(range(len(self.stages))):
+      if self.stages[i].cache:
+        cached = self.cache.load(keys[i])
+        if cached is not None:
+          data = cached
+          first = i + 1
+          break
+    for stage, key in zip(self.stages[first:], keys[first:]):
+      data = stage(data)
+      if stage.cache:
+        self.cache.save(key, data)
+    return data
@@ -0,0 +1,267 @@
+"""Consolidated storage of processed windows in a single HDF5 file.
+
+Instead of one small HDF5 file per window, the windows are appended to
+chunked datasets:
+  - `input`: (N, channels, samples) window data, one chunk per window.
+  - `label`: (N,) labels.
+  - `index/source_file`, `index/event_id`, `index/channel_subset`: (N,) index
+    table mapping each window back to its raw data file.
+
+Windows are referenced elsewhere, e.g. in TFRecord manifests, with entries of
+the form `store_file#i`.
+
+The store keeps the fingerprint of the processing parameters of its windows,
+and is emptied when it is reopened with other parameters. The windows of a
+source file that is processed again, e.g. because it was modified or because
+a run was killed before recording it as complete, are written in place of its
+previous windows, so the indices of the other windows do not change.
+"""
+
+import logging
+import os
+import re
+import threading
+
+import h5py
+import numpy as np
+
+
+_ENTRY_SEPARATOR = '#'
+_DATASETS = ['input', 'label', 'index/source_file', 'index/event_id',
+             'index/channel_subset']
+
+
+def get_event_id(filename):
+  """Parses the event or noise number from a window file name."""
+  match = re.search(r'(\d+)\.\w+$', os.path.basename(filename))
+  return int(match.group(1)) if match else -1
+
+
+def make_entry(store_file, i):
+  return '{}{}{}'.format(store_file, _ENTRY_SEPARATOR, i)
+
+
+def parse_entry(entry):
+  """Splits a `store_file#i` entry.
+
+  Returns:
+    (store_file, i) tuple, where i is None if the entry is a plain file.
+  """
+  store_file, separator, i = entry.rpartition(_ENTRY_SEPARATOR)
+  if not separator or not i.isdigit():
+    return entry, None
+  return store_file, int(i)
+
+
+def list_entries(store_file):
+  """Lists the entries of all the windows in a store."""
+  with WindowStore(store_file, 'r') as store:
+    return [make_entry(store_file, i) for i in range(len(store))]
+
+
+class WindowStore():
+  """Reads and appends windows to a consolidated HDF5 store.
+
+  Attr:
+    filename: Store file.
+  """
+
+  def __init__(self, filename, mode='a'):
+    """Initialization.
+
+    Args:
+      filename: Store file.
+      mode: h5py file mode.
+    """
+    self.filename = filename
+    self._file = h5py.File(filename, mode)
+    # source file -> indices of its windows, read on first use
+    self._sources = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    if 'label' not in self._file:
+      return 0
+    return self._file['label'].shape[0]
+
+  def close(self):
+    self._file.close()
+
+  def flush(self):
+    self._file.flush()
+
+  def repair(self):
+    """Removes the last window if an interrupted append left it partially
+    written, i.e. left datasets of different lengths."""
+    if 'input' not in self._file:
+      return
+    length = min(self._file[name].shape[0] for name in _DATASETS)
+    for name in _DATASETS:
+      self._file[name].resize(length, axis=0)
+    self._sources = None
+
+  def reset(self, fingerprint):
+    """Empties the store if its windows were processed with parameters of
+    another fingerprint.
+
+    Args:
+      fingerprint: Fingerprint of the current processing parameters.
+    """
+    if self._file.attrs.get('fingerprint') == fingerprint:
+      return
+    if len(self):
+      logging.warning('Removing %s windows processed with other parameters '
+                      'from %s.', len(self), self.filename)
+    for name in list(self._file):
+      del self._file[name]
+    self._file.attrs['fingerprint'] = fingerprint
+    self._sources = None
+
+  def _get_sources(self):
+    if self._sources is None:
+      self._sources = {}
+      for i, source_file in enumerate(self.read_index()[0]):
+        self._sources.setdefault(source_file, []).append(i)
+    return self._sources
+
+  def __contains__(self, source_file):
+    """Checks whether the store has windows of `source_file`."""
+    return source_file in self._get_sources()
+
+  def _create_datasets(self, shape, dtype):
+    f = self._file
+    f.create_dataset('input', shape=(0,) + shape, maxshape=(None,) + shape,
+                     chunks=(1,) + shape, dtype=dtype)
+    f.create_dataset('label', shape=(0,), maxshape=(None,), dtype=np.float32)
+    f.create_dataset('index/source_file', shape=(0,), maxshape=(None,),
+                     dtype=h5py.string_dtype())
+    f.create_dataset('index/event_id', shape=(0,), maxshape=(None,),
+                     dtype=np.int64)
+    f.create_dataset('index/channel_subset', shape=(0,), maxshape=(None,),
+                     dtype=np.int8)
+
+  def _write(self, i, data, label, source_file, channel_subset):
+    values = {
+        'input': data,
+        'label': np.asarray(label).item(),
+        'index/source_file': source_file,
+        'index/event_id': get_event_id(source_file),
+        'index/channel_subset': channel_subset,
+    }
+    for name, value in values.items():
+      dataset = self._file[name]
+      if i >= dataset.shape[0]:
+        dataset.resize(i + 1, axis=0)
+      dataset[i] = value
+
+  def append(self, data, label, source_file, channel_subset=0):
+    """Appends a window to the store.
+
+    Args:
+      data: (channels, samples) window data.
+      label: Window label.
+      source_file: Raw data file from which the window was processed.
+      channel_subset: Channel subset identifier, 0 if not applicable.
+
+    Returns:
+      int: Index of the window in the store.
+    """
+    if 'input' not in self._file:
+      self._create_datasets(data.shape, data.dtype)
+    i = len(self)
+    self._write(i, data, label, source_file, channel_subset)
+    if self._sources is not None:
+      self._sources.setdefault(source_file, []).append(i)
+    return i
+
+  def remove(self, indices):
+    """Removes windows, moving the following windows down."""
+    keep = np.setdiff1d(np.arange(len(self)), indices)
+    for name in _DATASETS:
+      dataset = self._file[name]
+      for j, i in enumerate(keep):
+        if i != j:
+          dataset[j] = dataset[i]
+      dataset.resize(len(keep), axis=0)
+    self._sources = None
+
+  def replace(self, source_file, windows):
+    """Writes the windows of a source file in place of its previous windows.
+
+    The windows are written at the indices of the previous windows if there
+    are as many, and appended otherwise, after removing the previous windows.
+
+    Args:
+      source_file: Raw data file from which the windows were processed.
+      windows: List of (data, label, channel_subset) tuples.
+
+    Returns:
+      list of int: Indices of the windows in the store.
+    """
+    indices = self._get_sources().get(source_file, [])
+    if len(indices) == len(windows):
+      for i, (data, label, channel_subset) in zip(indices, windows):
+        self._write(i, data, label, source_file, channel_subset)
+      return list(indices)
+    if indices:
+      self.remove(indices)
+    return [self.append(data, label, source_file, channel_subset)
+            for data, label, channel_subset in windows]
+
+  def read_index(self):
+    """Reads the index table.
+
+    Returns:
+      (source_files, event_ids, channel_subsets) tuple of (N,) arrays.
+    """
+    if 'index' not in self._file:
+      return np.array([], dtype=str), np.array([]), np.array([])
+    index = self._file['index']
+    return (index['source_file'].asstr()[()], index['event_id'][()],
+            index['channel_subset'][()])
+
+  def read(self, i):
+    """Reads a window.
+
+    Returns:
+      (data, label) tuple, in the same format as the per-window files.
+    """
+    data = self._file['input'][i]
+    label = self._file['label'][i:i + 1]
+    return data, label
+
+
+class WindowReader():
+  """Reads windows from per-window files or `store_file#i` entries.
+
+  Store files are opened once and kept open, so reading many windows from a
+  store does not reopen a file per window. Windows can be read from several
+  threads.
+  """
+
+  def __init__(self):
+    self._stores = {}
+    self._lock = threading.Lock()
+
+  def read(self, entry):
+    """Reads the `input` and `label` of a window.
+
+    Returns:
+      (data, label) tuple.
+    """
+    store_file, i = parse_entry(entry)
+    if i is None:
+      with h5py.File(entry, 'r') as f:
+        return f.get('input')[()], f.get('label')[()]
+    with self._lock:
+      if store_file not in self._stores:
+        self._stores[store_file] = WindowStore(store_file, 'r')
+    return self._stores[store_file].read(i)
+
+  def exists(self, entry):
+    return os.path.isfile(parse_entry(entry)[0])
@@ -0,0 +1,50 @@
+"""Stand-in for the processing_utils package in the tests.
+
+The processing scripts import processing_utils, which is not always
+installed. `import_module` imports a script with this module standing in for
+the package if it is missing. The filters follow the same conventions as
+processing_utils: time is the last axis, and the bandpass is zero phase.
+"""
+
+import glob
+import importlib
+import sys
+import types
+
+import numpy as np
+from scipy import signal
+
+
+def get_filenames(file_pattern):
+  return sorted(glob.glob(file_pattern))
+
+
+def get_strain_rate(data):
+  return np.gradient(data, axis=-1)
+
+
+def remove_median(data):
+  return data - np.median(data, axis=0)
+
+
+def bandpass(data, low_freq, high_freq, dt):
+  sos = signal.butter(4, [low_freq, high_freq], btype='bandpass', fs=1 / dt,
+                      output='sos')
+  return signal.sosfiltfilt(sos, data, axis=-1)
+
+
+def decimate(data, q):
+  return signal.decimate(data, q, axis=-1)
+
+
+def import_module(name):
+  """Imports a module, with this stand-in for processing_utils if the
+  package is not installed."""
+  try:
+    importlib.import_module('processing_utils.processing_utils')
+  except ImportError:
+    package = types.ModuleType('processing_utils')
+    package.processing_utils = sys.modules[__name__]
+    sys.modules['processing_utils'] = package
+    sys.modules['processing_utils.processing_utils'] = sys.modules[__name__]
+  return importlib.import_module(name)
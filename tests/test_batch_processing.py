@@ -0,0 +1,147 @@
+"""Tests that the batched window processing matches the per-window
+processing.
+
+Usage:
+  python -m unittest tests.test_batch_processing
+"""
+
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from preprocessing import window_store
+from tests import processing_stub
+
+batch_processing = processing_stub.import_module(
+    'preprocessing.batch_processing')
+process_das = processing_stub.import_module('preprocessing.process_das')
+process_seismometer = processing_stub.import_module(
+    'preprocessing.process_seismometer')
+
+
+_PARAMS = dict(raw_window=60, detect_window=20.48, event_duration=12,
+               low_freq=1.0, high_freq=12.0)
+
+
+def _read_store(store_file):
+  with window_store.WindowStore(store_file, 'r') as store:
+    return (list(store.read_index()[0]),
+            np.stack([store.read(i)[0] for i in range(len(store))]))
+
+
+class BatchProcessingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rng = np.random.default_rng(0)
+
+  def test_apply_to_traces(self):
+    windows = [self.rng.normal(size=shape)
+               for shape in [(3, 100), (100,), (3, 100), (2, 50)]]
+    results = batch_processing.apply_to_traces(
+        lambda traces, q: traces[:, ::q], windows, 2)
+    self.assertEqual(len(results), len(windows))
+    for result, window in zip(results, windows):
+      np.testing.assert_array_equal(result, window[..., ::2])
+
+  def test_process_das(self):
+    windows = [self.rng.normal(size=(8, 3000)) for _ in range(4)]
+    windows.append(self.rng.normal(size=(8, 2000)))
+    results = batch_processing.process_das(windows, 1.0, 12.0, 0.02, 2)
+    for result, window in zip(results, windows):
+      np.testing.assert_allclose(
+          result, process_das._process(window, 1.0, 12.0, 0.02, 2),  # pylint: disable=protected-access
+          rtol=0, atol=1e-12)
+
+  def test_process_seismometer(self):
+    traces = [self.rng.normal(size=6000) for _ in range(5)]
+    traces.append(self.rng.integers(-100, 100, size=6000, dtype=np.int32))
+    results = batch_processing.process_seismometer(traces, 1.0, 12.0, 0.01,
+                                                   4)
+    for result, trace in zip(results, traces):
+      np.testing.assert_allclose(
+          result, process_seismometer._process(trace, 1.0, 12.0, 0.01, 4),  # pylint: disable=protected-access
+          rtol=0, atol=1e-12)
+
+
+class BatchedScriptsTest(unittest.TestCase):
+  """Tests the processing scripts with and without batches."""
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.path = self._tmp_dir.name
+    self.raw_path = os.path.join(self.path, 'raw')
+    self.rng = np.random.default_rng(0)
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def _make_file(self, datatype, name, datasets):
+    filename = os.path.join(self.raw_path, datatype, name.split('_')[0],
+                            name + '.hdf5')
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with h5py.File(filename, 'w') as f:
+      for key, data in datasets.items():
+        f.create_dataset(key, data=data)
+
+  def test_process_das(self):
+    for i in range(5):
+      self._make_file('das', 'event_{:05d}'.format(i),
+                      {'data': self.rng.normal(size=(12, 3000))})
+    self._make_file('das', 'noise_00000', {'data': self.rng.normal(
+        size=(12, 3000))})
+
+    def process(name, batch_size):
+      store_file = os.path.join(self.path, name, 'windows.h5')
+      process_das.process(
+          os.path.join(self.raw_path, 'das', '*', '*'), in_dir=self.raw_path,
+          out_dir=os.path.join(self.path, name), dt=0.02, q=2,
+          channel_subset1=list(range(0, 5)),
+          channel_subset2=list(range(6, 11)), store_file=store_file,
+          batch_size=batch_size, **_PARAMS)
+      return _read_store(store_file)
+
+    source_files, windows = process('per_window', 1)
+    batched_source_files, batched_windows = process('batched', 4)
+    self.assertEqual(batched_source_files, source_files)
+    np.testing.assert_allclose(batched_windows, windows, rtol=0, atol=1e-6)
+
+  def test_process_seismometer(self):
+    keys = ['JRSC.HNE', 'JRSC.HNN', 'JRSC.HNZ']
+    for i in range(4):
+      self._make_file('seismometer', 'event_{:05d}'.format(i), {
+          key: self.rng.normal(size=6000) for key in keys})
+    # a missing channel, a shorter channel and integer counts
+    self._make_file('seismometer', 'event_00004', {
+        key: self.rng.normal(size=6000) for key in keys[:2]})
+    self._make_file('seismometer', 'event_00005', {
+        keys[0]: self.rng.normal(size=5000),
+        keys[1]: self.rng.normal(size=6000),
+        keys[2]: self.rng.integers(-100, 100, size=6000, dtype=np.int32)})
+
+    def process(name, batch_size):
+      store_file = os.path.join(self.path, name, 'windows.h5')
+      process_seismometer.process_windows(
+          os.path.join(self.raw_path, 'seismometer', '*', '*'),
+          in_dir=self.raw_path, out_dir=os.path.join(self.path, name),
+          dt=0.01, q=4, store_file=store_file, batch_size=batch_size,
+          **_PARAMS)
+      return _read_store(store_file)
+
+    source_files, windows = process('per_window', 1)
+    batched_source_files, batched_windows = process('batched', 4)
+    self.assertEqual(batched_source_files, source_files)
+    np.testing.assert_allclose(batched_windows, windows, rtol=0, atol=1e-6)
+
+  def test_cache_and_batches(self):
+    with self.assertRaises(ValueError):
+      process_das.process(
+          os.path.join(self.raw_path, 'das', '*', '*'), in_dir=self.raw_path,
+          out_dir=self.path, dt=0.02, q=2, channel_subset1=[0],
+          channel_subset2=[1], cache_dir=self.path, batch_size=4, **_PARAMS)
+
+
+if __name__ == '__main__':
+  unittest.main()
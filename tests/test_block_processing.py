@@ -0,0 +1,101 @@
+"""Tests that the block processing of the continuous seismometer records
+matches the whole-record processing.
+
+The blocks are processed with `block_overlap` extra raw samples on each side,
+which are cropped out. The filter transients decay exponentially, so the
+cropped blocks only match the whole record approximately: with the default
+one-minute overlap, the difference is at the level of the float64 rounding,
+below 1e-12 of the peak amplitude, and the float32 outputs differ by at most
+one rounding step. The tests compare within 1e-6 of the peak amplitude, and
+check that without an overlap the block edges are off by far more.
+
+Usage:
+  python -m unittest tests.test_block_processing
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import h5py
+import numpy as np
+
+from tests import processing_stub
+
+process_seismometer = processing_stub.import_module(
+    'preprocessing.process_seismometer')
+
+
+_PARAMS = dict(low_freq=1.0, high_freq=12.0, dt=0.01, q=4)
+_NUM_SAMPLES = 120000  # 20 minutes
+_BLOCK_OVERLAP = 6000  # 1 minute, as in parameters.py
+_RTOL = 1e-6
+
+
+def _make_trace(rng, num_samples=_NUM_SAMPLES, dt=0.01):
+  """Creates a trace with tones in and out of the passband, and noise."""
+  t = np.arange(num_samples) * dt
+  return (np.sin(2 * np.pi * 3 * t) + 0.5 * np.sin(2 * np.pi * 0.2 * t) +
+          rng.normal(size=num_samples))
+
+
+def _process_in_blocks(trace, block_size, block_overlap):
+  out = np.zeros((-(-len(trace) // _PARAMS['q']), 1))
+  process_seismometer._process_channel_in_blocks(  # pylint: disable=protected-access
+      trace, out, 0, block_size=block_size, block_overlap=block_overlap,
+      **_PARAMS)
+  return out[:, 0]
+
+
+class BlockProcessingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rng = np.random.default_rng(0)
+    self.trace = _make_trace(self.rng)
+    self.whole = process_seismometer._process(self.trace, **_PARAMS)  # pylint: disable=protected-access
+    self.atol = _RTOL * np.abs(self.whole).max()
+
+  def test_blocks(self):
+    # block sizes that divide the record, that do not, that are not a
+    # multiple of q, and a single block
+    for block_size in (10000, 25000, 36001, 2 * _NUM_SAMPLES):
+      with self.subTest(block_size=block_size):
+        np.testing.assert_allclose(
+            _process_in_blocks(self.trace, block_size, _BLOCK_OVERLAP),
+            self.whole, rtol=0, atol=self.atol)
+
+  def test_no_overlap(self):
+    blocks = _process_in_blocks(self.trace, 10000, 0)
+    self.assertGreater(np.abs(blocks - self.whole).max(), 100 * self.atol)
+
+  def test_streaming(self):
+    num_rows = _NUM_SAMPLES // _PARAMS['q']
+    keys = process_seismometer._CHANNEL_KEYS  # pylint: disable=protected-access
+    with tempfile.TemporaryDirectory() as path:
+      filename = os.path.join(path, 'continuous.hdf5')
+      out_file = os.path.join(path, 'continuous_out.hdf5')
+      with h5py.File(filename, 'w') as f:
+        # one channel is missing, and one is shorter than the others
+        for i, key in enumerate(keys):
+          if i != 2:
+            f.create_dataset(key, data=_make_trace(
+                self.rng, 90000 if i == len(keys) - 1 else _NUM_SAMPLES))
+      whole = process_seismometer.read_hdf5(filename, n_samples=num_rows,
+                                            **_PARAMS).T
+      with mock.patch.object(process_seismometer, '_N_SAMPLES', num_rows):
+        process_seismometer.write_hdf5_streaming(
+            out_file, filename, block_size=10000,
+            block_overlap=_BLOCK_OVERLAP, **_PARAMS)
+      with h5py.File(out_file, 'r') as f:
+        blocks = f['input'][()]
+    self.assertEqual(blocks.shape, whole.shape)
+    self.assertEqual(blocks.dtype, np.float32)
+    self.assertFalse(blocks[:, 2].any())
+    self.assertFalse(blocks[90000 // _PARAMS['q']:, -1].any())
+    np.testing.assert_allclose(blocks, whole, rtol=0,
+                               atol=_RTOL * np.abs(whole).max())
+
+
+if __name__ == '__main__':
+  unittest.main()
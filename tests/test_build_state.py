@@ -0,0 +1,150 @@
+"""Tests of the incremental rebuilds of the TFRecord converters.
+
+Usage:
+  python -m unittest tests.test_build_state
+"""
+
+import glob
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import h5py
+import numpy as np
+
+from tfrecords import build_state
+
+try:
+  import tensorflow as tf
+except ImportError:
+  tf = None
+
+
+def _flatten(plans):
+  return [entry for plan in plans for entry in plan.entries]
+
+
+class PlanTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.shard_files = []
+    for i in range(3):
+      self.shard_files.append(os.path.join(self._tmp_dir.name, str(i)))
+      open(self.shard_files[-1], 'w').close()
+    shard_entries = [['a', 'b'], ['c', 'd'], ['e', 'f']]
+    inputs = {entry: {'hash': entry, 'size': 1, 'mtime': 1}
+              for entries in shard_entries for entry in entries}
+    self.state = build_state.BuildState('fingerprint')
+    self.state.record(self.shard_files, shard_entries, inputs)
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def _plan(self, entries, changed=()):
+    inputs = {entry: {'hash': entry + '*' if entry in changed else entry}
+              for entry in entries}
+    return self.state.plan(entries, inputs)
+
+  def test_unchanged(self):
+    plans = self._plan(list('abcdef'))
+    self.assertEqual([plan.file for plan in plans], self.shard_files)
+
+  def test_insertion(self):
+    entries = list('abcxdef')
+    plans = self._plan(entries)
+    self.assertEqual(_flatten(plans), entries)
+    self.assertEqual([plan.file for plan in plans],
+                     [self.shard_files[0], None, None, self.shard_files[2]])
+
+  def test_reordering(self):
+    entries = list('efabcd')
+    plans = self._plan(entries)
+    self.assertEqual(_flatten(plans), entries)
+    self.assertEqual([plan.file for plan in plans],
+                     [None, self.shard_files[0], self.shard_files[1]])
+
+  def test_changed_and_removed(self):
+    entries = list('abdef')
+    plans = self._plan(entries, changed='e')
+    self.assertEqual(_flatten(plans), entries)
+    self.assertEqual([plan.file for plan in plans],
+                     [self.shard_files[0], None, None])
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class RebuildTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.datapath = self._tmp_dir.name
+    self.rng = np.random.default_rng(0)
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def _add_window(self, name):
+    filename = os.path.join(self.datapath, name + '.h5')
+    data = self.rng.standard_normal((4, 5)) * 0.01
+    with h5py.File(filename, 'w') as f:
+      f.create_dataset('input', data=data)
+      f.create_dataset('label', data=np.ones(1, dtype=np.float32))
+    return filename
+
+  def _convert(self, entries, *args):
+    from tfrecords import convert_tfrecords_das
+    from tfrecords import serialization
+    with open(os.path.join(self.datapath, 'manifest.txt'), 'w') as f:
+      f.write(''.join(entry + '\n' for entry in entries))
+    params, _ = convert_tfrecords_das.ArgumentParser().parse_known_args([
+        '--manifest_file', 'manifest.txt', '--output_file_prefix', 'out/x',
+        '--num_shards', '3', '--read_workers', '0'] + list(args))
+    with mock.patch.object(convert_tfrecords_das.get_datapath, 'get_datapath',
+                           return_value=self.datapath):
+      convert_tfrecords_das.convert_to_tfrecords(params)
+
+    files = sorted(glob.glob(os.path.join(self.datapath, 'out', 'x-*')))
+    data_loader = convert_tfrecords_das.DataLoader(0.0, 1.0)
+    records = tf.data.TFRecordDataset(
+        files, compression_type=params.compression_type.value)
+    for entry, record in zip(entries, records.as_numpy_iterator()):
+      inputs = np.frombuffer(serialization.parse_example(record)['inputs'],
+                             dtype=np.float32)
+      np.testing.assert_array_equal(
+          inputs, data_loader.read(entry)[0].ravel())
+    self.assertEqual(sum(1 for _ in records), len(entries))
+    return files
+
+  def test_insertion(self):
+    entries = [self._add_window('w{:02d}'.format(i)) for i in range(12)]
+    files = self._convert(entries)
+    first_shard = open(files[0], 'rb').read()
+
+    entries.insert(6, self._add_window('new'))
+    files = self._convert(entries)
+    self.assertEqual(open(files[0], 'rb').read(), first_shard)
+
+  def test_stale_shards(self):
+    entries = [self._add_window('w{:02d}'.format(i)) for i in range(12)]
+    self._convert(entries)
+    files = self._convert(entries, '--num_shards', '2')
+    self.assertEqual([os.path.basename(filename) for filename in files],
+                     ['x-0000-of-0002.tfrecord.gz',
+                      'x-0001-of-0002.tfrecord.gz'])
+
+  def test_target_shard_bytes(self):
+    entries = [self._add_window('w{:02d}'.format(i)) for i in range(12)]
+    files = self._convert(entries, '--target_shard_bytes', '1000',
+                          '--compression_type', '')
+    sizes = [os.path.getsize(filename) for filename in files]
+    record_bytes = sum(sizes) // len(entries)
+    self.assertEqual(sum(sizes), len(entries) * record_bytes)
+    self.assertGreater(len(sizes), 1)
+    for size in sizes[:-1]:
+      self.assertGreaterEqual(size, 1000)
+      self.assertLess(size, 1000 + record_bytes)
+
+
+if __name__ == '__main__':
+  unittest.main()
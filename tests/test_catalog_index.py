@@ -0,0 +1,174 @@
+"""Tests of the catalog index and of the catalog queries that read it.
+
+Usage:
+  python -m unittest tests.test_catalog_index
+"""
+
+import datetime as dt
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from postprocessing import match_detections
+from preprocessing import catalog_index
+from preprocessing import catalog_store
+from preprocessing import create_noise_catalog
+
+
+def _make_catalog(num_events, seed=0):
+  """Creates a catalog with unsorted times, duplicates and missing values."""
+  rng = np.random.default_rng(seed)
+  start = pd.Timestamp('2020-01-01').value
+  times = start + rng.integers(0, 10 * 86400, num_events) * 10**9
+  times[1] = times[0]
+  datetime = pd.to_datetime(times)
+  datetime = datetime.where(np.arange(num_events) % 17 != 3)
+  distance = rng.uniform(0, 100000, num_events)
+  distance[5] = np.nan
+  return pd.DataFrame({
+      'datetime': datetime,
+      'focal_time': datetime - pd.Timedelta(seconds=5),
+      'distance': distance,
+  })
+
+
+class CatalogIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.catalog = _make_catalog(500)
+    self.catalog_file = os.path.join(self._tmp_dir.name, 'catalog.h5')
+    catalog_store.save_catalog(self.catalog, self.catalog_file)
+    self.times = self.catalog['datetime'].to_numpy(
+        dtype='datetime64[ns]').astype(np.int64)
+    self.valid = ~np.isnat(self.catalog['datetime'].to_numpy())
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def test_query_intervals(self):
+    index = catalog_index.CatalogIndex.load_or_build(self.catalog_file)
+    self.assertEqual(len(index), self.valid.sum())
+    rng = np.random.default_rng(1)
+    starts = rng.choice(self.times[self.valid], 50)
+    ends = starts + rng.integers(-3600, 86400, 50) * 10**9
+    offsets, rows = index.query_intervals(starts, ends)
+    counts = index.count_intervals(starts, ends)
+    np.testing.assert_array_equal(np.diff(offsets), counts)
+    for i, (start, end) in enumerate(zip(starts, ends)):
+      expected = np.flatnonzero(self.valid & (self.times >= start) &
+                                (self.times <= end))
+      result = rows[offsets[i]:offsets[i + 1]]
+      self.assertEqual(sorted(result), list(expected))
+      self.assertTrue(np.all(np.diff(self.times[result]) >= 0))
+
+  def test_get_times(self):
+    index = catalog_index.CatalogIndex.load_or_build(self.catalog_file)
+    np.testing.assert_array_equal(index.get_times(),
+                                  np.sort(self.times[self.valid]))
+    start = pd.Timestamp('2020-01-03')
+    end = pd.Timestamp('2020-01-05')
+    distance = self.catalog['distance'].to_numpy()
+    mask = (self.valid & (self.times >= start.value) &
+            (self.times <= end.value))
+    np.testing.assert_array_equal(index.get_times(start, end),
+                                  np.sort(self.times[mask]))
+    mask &= (distance >= 20000) & (distance <= 50000)
+    np.testing.assert_array_equal(
+        index.get_times(start, end, min_distance=20000, max_distance=50000),
+        np.sort(self.times[mask]))
+    self.assertEqual(len(index.get_times(end, start)), 0)
+
+  def test_time_column(self):
+    index = catalog_index.CatalogIndex.load_or_build(
+        self.catalog_file, time_column='focal_time')
+    np.testing.assert_array_equal(
+        index.get_times(),
+        np.sort(self.times[self.valid]) - 5 * 10**9)
+
+  def test_load_or_build(self):
+    index = catalog_index.CatalogIndex.load_or_build(self.catalog_file)
+    self.assertTrue(os.path.isfile(
+        catalog_index.get_index_file(self.catalog_file)))
+    with mock.patch.object(catalog_index.CatalogIndex, 'from_catalog') as f:
+      loaded = catalog_index.CatalogIndex.load_or_build(self.catalog_file)
+      f.assert_not_called()
+    for name in ('times', 'rows', 'distance'):
+      np.testing.assert_array_equal(getattr(loaded, name),
+                                    getattr(index, name))
+    # a modified catalog is indexed again
+    catalog_store.save_catalog(self.catalog.iloc[:100], self.catalog_file)
+    index = catalog_index.CatalogIndex.load_or_build(self.catalog_file)
+    self.assertEqual(len(index), self.valid[:100].sum())
+
+
+class CatalogQueriesTest(unittest.TestCase):
+  """Tests the catalog queries that read the index."""
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.catalog = _make_catalog(200)
+    self.catalog_file = os.path.join(self._tmp_dir.name, 'catalog.h5')
+    catalog_store.save_catalog(self.catalog, self.catalog_file)
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def test_noise_catalog(self):
+    builder = create_noise_catalog.NoiseCatalogBuilder(
+        self.catalog_file, num_entries=100, buffer=dt.timedelta(minutes=5))
+    self.assertTrue(os.path.isfile(
+        catalog_index.get_index_file(self.catalog_file)))
+    builder.create_noise_catalog()
+    event_times = np.sort(self.catalog['datetime'].dropna().to_numpy(
+        dtype='datetime64[ns]').astype(np.int64))
+    noise_times = builder.catalog['datetime'].to_numpy(
+        dtype='datetime64[ns]').astype(np.int64)
+    self.assertEqual(len(noise_times), 100)
+    self.assertTrue(np.all(noise_times >= event_times[0]))
+    self.assertTrue(np.all(noise_times <= event_times[-1]))
+    gaps = np.abs(noise_times[:, None] - event_times[None]).min(axis=1)
+    self.assertTrue(np.all(gaps >= 5 * 60 * 10**9))
+
+  def test_match_detections(self):
+    events = self.catalog.dropna(subset=['datetime']).sort_values(
+        'datetime', kind='stable')
+    event_times = events['datetime'].to_numpy(
+        dtype='datetime64[ns]').astype(np.int64)
+    # one day of continuous data, with high scores on windows holding an
+    # event
+    file_start = pd.Timestamp('2020-01-04')
+    window_starts = file_start.value + np.arange(86400 // 10) * 10 * 10**9
+    covered = np.searchsorted(event_times, window_starts, 'left') < (
+        np.searchsorted(event_times, window_starts + 10 * 10**9, 'right'))
+    logits_file = os.path.join(
+        self._tmp_dir.name,
+        'data_{}_logits.npy'.format(file_start.strftime('%Y%m%d_%H%M%S')))
+    np.save(logits_file, covered.astype(np.float32))
+    output_file = os.path.join(self._tmp_dir.name, 'results.csv')
+    argv = ['match_detections', '--logits_pattern', logits_file,
+            '--catalog', self.catalog_file, '--window_length', '10',
+            '--num_thresholds', '2', '--output_file', output_file]
+    day = (event_times >= window_starts[0]) & (
+        event_times <= window_starts[-1] + 10 * 10**9)
+    close = events['distance'].to_numpy() <= 50000
+
+    with mock.patch.object(sys, 'argv', argv):
+      match_detections.main()
+    results = pd.read_csv(output_file)
+    self.assertEqual(results['matched_events'].iloc[-1], day.sum())
+    self.assertEqual(results['false_alarms'].iloc[-1], 0)
+
+    with mock.patch.object(sys, 'argv', argv + ['--max_distance', '50000']):
+      match_detections.main()
+    results = pd.read_csv(output_file)
+    self.assertEqual(results['matched_events'].iloc[-1], (day & close).sum())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,195 @@
+"""Tests of the concurrent, cached and incremental event catalog pulls against
+a local stand-in for the FDSN event service.
+
+Usage:
+  python -m unittest tests.test_event_catalog
+"""
+
+import datetime as dt
+import http.server
+import io
+import os
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+import numpy as np
+from obspy import UTCDateTime
+from obspy.clients.fdsn import Client
+from obspy.core.event import Catalog
+from obspy.core.event import Event
+from obspy.core.event import Origin
+from obspy.core.event import Pick
+from obspy.core.event import WaveformStreamID
+import pandas as pd
+
+from preprocessing import catalog_store
+from preprocessing import create_earthquake_catalog
+from preprocessing import parameters
+
+
+_STARTTIME = dt.datetime(2017, 1, 1)
+_MIDTIME = dt.datetime(2018, 1, 1)
+_ENDTIME = dt.datetime(2019, 1, 1)
+
+
+def _make_event(i, time):
+  """Creates a synthetic event with a pick at the reference station."""
+  waveform_id = WaveformStreamID(network_code='NC',
+                                 station_code=parameters.closest_station,
+                                 channel_code=parameters.reference_channel)
+  origin = Origin(time=UTCDateTime(time),
+                  latitude=parameters.stanford_latitude + 0.01 * (i % 20),
+                  longitude=parameters.stanford_longitude, depth=5000.0)
+  event = Event(
+      resource_id='quakeml:nc.anss.org/Event/NC/{}'.format(1000 + i),
+      event_type='quarry blast' if i % 5 == 0 else 'earthquake',
+      origins=[origin],
+      picks=[Pick(time=origin.time + 2 + 0.05 * (i % 20),
+                  waveform_id=waveform_id, onset='impulsive',
+                  evaluation_mode='manual')],
+  )
+  event.preferred_origin_id = origin.resource_id
+  return event
+
+
+class _FakeEventHandler(http.server.BaseHTTPRequestHandler):
+  """Serves the events of `server.events` in the requested time window."""
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+    starttime = UTCDateTime(query['starttime'][0])
+    endtime = UTCDateTime(query['endtime'][0])
+    with self.server.lock:
+      self.server.num_requests += 1
+    events = [event for event in self.server.events
+              if starttime <= event.preferred_origin().time <= endtime]
+    if not events:
+      self.send_response(204)
+      self.end_headers()
+      return
+    buffer = io.BytesIO()
+    Catalog(events).write(buffer, format='QUAKEML')
+    content = buffer.getvalue()
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass
+
+
+class EventCatalogTest(unittest.TestCase):
+
+  def setUp(self):
+    # events every 5 days
+    times = pd.date_range(_STARTTIME + dt.timedelta(days=1),
+                          _ENDTIME - dt.timedelta(days=1), freq='5D')
+    self.events = [_make_event(i, time) for i, time in enumerate(times)]
+    self.server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), _FakeEventHandler)
+    self.server.lock = threading.Lock()
+    self.server.num_requests = 0
+    self.server.events = self.events
+    self._thread = threading.Thread(target=self.server.serve_forever)
+    self._thread.start()
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.cache_dir = os.path.join(self._tmp_dir.name, 'cache')
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self._thread.join()
+    self._tmp_dir.cleanup()
+
+  def _get_builder(self):
+    builder = create_earthquake_catalog.EventCatalogBuilder(
+        clientcode=None,
+        reference_coordinates=(parameters.stanford_latitude,
+                               parameters.stanford_longitude,
+                               parameters.stanford_elevation),
+        reference_station=parameters.closest_station,
+        reference_channel=parameters.reference_channel)
+    builder.client = Client(
+        'http://127.0.0.1:{}'.format(self.server.server_port),
+        _discover_services=False)
+    return builder
+
+  def _create(self, endtime, cache_dir=None):
+    builder = self._get_builder()
+    builder.create_event_catalog(_STARTTIME, endtime, maxradius=1.0,
+                                 n_threads=4, cache_dir=cache_dir)
+    return builder.catalog
+
+  def _num_events(self, endtime):
+    return sum(event.preferred_origin().time <= UTCDateTime(endtime)
+               for event in self.events)
+
+  def test_create_concurrent(self):
+    catalog = self._create(_ENDTIME)
+    # the two years are pulled in 6-month windows
+    self.assertEqual(self.server.num_requests, 5)
+    self.assertEqual(len(catalog), len(self.events))
+    self.assertTrue(catalog['focal_time'].is_monotonic_increasing)
+    self.assertEqual(list(catalog.index), list(range(len(catalog))))
+    self.assertFalse(catalog['distance'].isna().any())
+    self.assertFalse(catalog['datetime'].isna().any())
+
+  def test_cache(self):
+    catalog = self._create(_ENDTIME, self.cache_dir)
+    num_requests = self.server.num_requests
+    cached_catalog = self._create(_ENDTIME, self.cache_dir)
+    self.assertEqual(self.server.num_requests, num_requests)
+    pd.testing.assert_frame_equal(cached_catalog, catalog)
+
+  def test_update(self):
+    catalog = self._create(_MIDTIME)
+    self.assertEqual(len(catalog), self._num_events(_MIDTIME))
+    # columns added to the saved catalog after it was pulled
+    catalog['has_das_data'] = True
+    catalog['has_geophone_data'] = np.arange(len(catalog)) % 2 == 0
+    catalog['local_amplitude'] = np.arange(len(catalog), dtype=np.float32)
+    filename = os.path.join(self._tmp_dir.name, 'catalog.h5')
+    catalog_store.save_catalog(catalog, filename)
+    existing = catalog_store.load_catalog(filename)
+
+    builder = self._get_builder()
+    builder.update_event_catalog(existing, _ENDTIME, maxradius=1.0,
+                                 n_threads=4)
+    updated = builder.catalog
+    self.assertEqual(len(updated), len(self.events))
+    self.assertTrue(updated['focal_time'].is_monotonic_increasing)
+    # the categoricals are converted back when saving
+    categoricals = [name for name, dtype in existing.dtypes.items()
+                    if isinstance(dtype, pd.CategoricalDtype)]
+    pd.testing.assert_series_equal(updated.dtypes.drop(categoricals),
+                                   existing.dtypes.drop(categoricals))
+    # the existing events are unchanged, except the last one, which is
+    # pulled again and keeps the values of the columns that are not pulled
+    num_existing = len(existing)
+    pd.testing.assert_frame_equal(
+        updated.iloc[:num_existing - 1].drop(columns=categoricals),
+        existing.iloc[:-1].drop(columns=categoricals))
+    extra_columns = ['has_das_data', 'has_geophone_data', 'local_amplitude']
+    pd.testing.assert_series_equal(
+        updated[extra_columns].iloc[num_existing - 1],
+        existing[extra_columns].iloc[-1])
+    new = updated.iloc[num_existing:]
+    self.assertFalse(new['has_das_data'].any())
+    self.assertFalse(new['has_geophone_data'].any())
+    self.assertTrue(new['local_amplitude'].isna().all())
+    # the pulled rows match a full pull
+    full = self._create(_ENDTIME)
+    np.testing.assert_allclose(new['distance'],
+                               full['distance'].iloc[num_existing:],
+                               rtol=1e-6)
+
+    catalog_store.save_catalog(updated, filename)
+    self.assertEqual(len(catalog_store.load_catalog(filename)),
+                     len(self.events))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,179 @@
+"""Tests of the thread-based FDSN download engine against a local stand-in
+for the FDSN dataselect service.
+
+Usage:
+  python -m unittest tests.test_fdsn_download
+"""
+
+import http.server
+import io
+import os
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+import h5py
+import numpy as np
+import obspy
+from obspy import UTCDateTime
+
+from preprocessing import fdsn_download
+from preprocessing import pull_seismometer_data
+
+
+_SAMPLING_RATE = 10.0
+
+
+def _make_mseed(traces):
+  """Serializes (station, channel, starttime, endtime) traces of synthetic
+  data to MiniSEED."""
+  stream = obspy.Stream()
+  for station, channel, starttime, endtime in traces:
+    starttime = UTCDateTime(starttime)
+    npts = int(round((UTCDateTime(endtime) - starttime) * _SAMPLING_RATE))
+    stream.append(obspy.Trace(
+        data=np.arange(npts, dtype=np.float32),
+        header=dict(network='NC', station=station, channel=channel,
+                    starttime=starttime, sampling_rate=_SAMPLING_RATE)))
+  buffer = io.BytesIO()
+  stream.write(buffer, format='MSEED')
+  return buffer.getvalue()
+
+
+class _FakeFDSNHandler(http.server.BaseHTTPRequestHandler):
+  """Serves synthetic waveforms for the requested time windows.
+
+  The first `server.num_errors` requests fail with HTTP 503, and all the
+  requests return HTTP 204 if `server.no_data` is set.
+  """
+
+  def _reply(self, traces):
+    server = self.server
+    with server.lock:
+      server.num_requests += 1
+      fail = server.num_errors > 0
+      server.num_errors -= 1
+    if fail:
+      self.send_response(503)
+      self.end_headers()
+      return
+    if server.no_data:
+      self.send_response(204)
+      self.end_headers()
+      return
+    content = _make_mseed(traces)
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+    self._reply([
+        (station, channel, query['starttime'][0], query['endtime'][0])
+        for station in query['station'][0].split(',')
+        for channel in query['channel'][0].split(',')])
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+    traces = []
+    for line in body.splitlines():
+      _, station, _, channel, starttime, endtime = line.split()
+      traces.append((station, channel, starttime, endtime))
+    self._reply(traces)
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass
+
+
+class FDSNDownloadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), _FakeFDSNHandler)
+    self.server.lock = threading.Lock()
+    self.server.num_requests = 0
+    self.server.num_errors = 0
+    self.server.no_data = False
+    self._thread = threading.Thread(target=self.server.serve_forever)
+    self._thread.start()
+    self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.path = self._tmp_dir.name
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self._thread.join()
+    self._tmp_dir.cleanup()
+
+  def _get_session(self, max_retries=2):
+    return fdsn_download.FDSNSession(
+        self.url, max_retries=max_retries, backoff=0.0,
+        max_requests_per_second=1000.0, timeout=10.0)
+
+  def _get_waveforms(self, session):
+    return session.get_waveforms('NC', 'JRSC', '*', 'HNE',
+                                 UTCDateTime(2020, 1, 1),
+                                 UTCDateTime(2020, 1, 1, 0, 1))
+
+  def test_get_waveforms(self):
+    stream = self._get_waveforms(self._get_session())
+    self.assertEqual(len(stream), 1)
+    self.assertEqual(stream[0].stats.starttime, UTCDateTime(2020, 1, 1))
+    self.assertEqual(stream[0].stats.npts, 60 * _SAMPLING_RATE)
+
+  def test_retry(self):
+    self.server.num_errors = 2
+    self.assertIsNotNone(self._get_waveforms(self._get_session()))
+    self.assertEqual(self.server.num_requests, 3)
+
+  def test_no_data(self):
+    self.server.no_data = True
+    self.assertIsNone(self._get_waveforms(self._get_session()))
+    self.assertEqual(self.server.num_requests, 1)
+
+  def test_failure_manifest(self):
+    self.server.num_errors = 100
+    session = self._get_session(max_retries=1)
+    tasks = [fdsn_download.DownloadTask(
+        os.path.join(self.path, 'event_{:05d}.h5'.format(i)),
+        UTCDateTime(2020, 1, 1, i), 60) for i in range(3)]
+    failure_file = os.path.join(self.path, 'failures.jsonl')
+
+    def download_batch(batch):
+      for task in batch:
+        if self._get_waveforms(session) is None:
+          raise fdsn_download.DownloadError('No data.')
+
+    failures = fdsn_download.download(
+        download_batch, fdsn_download.make_batches(tasks, 1), 2,
+        failure_file)
+    self.assertEqual(failures, tasks)
+    self.assertEqual(fdsn_download.read_failures(failure_file), tasks)
+
+  def test_retry_failures_in_bulk(self):
+    downloader = pull_seismometer_data.WaveformDownloader(
+        clientcode=self.url, network='NC', stations=['JRSC', 'JSFB'],
+        channels=['HNE', 'HNZ'], location='*', datapath=self.path,
+        engine='thread', max_requests_per_second=1000.0)
+    tasks = [fdsn_download.DownloadTask(
+        os.path.join(self.path, 'event_{:05d}.h5'.format(i)),
+        UTCDateTime(2020, 1, 1, 0, i), 60) for i in range(4)]
+    failure_file = os.path.join(self.path, 'failures.jsonl')
+    fdsn_download.write_failures(failure_file, tasks)
+
+    downloader.retry_failures(failure_file, n_threads=2, bulk_size=2)
+    self.assertEqual(self.server.num_requests, 2)
+    self.assertEqual(fdsn_download.read_failures(failure_file), [])
+    for task in tasks:
+      with h5py.File(task.filename, 'r') as f:
+        self.assertEqual(sorted(f.keys()), [
+            'JRSC.HNE', 'JRSC.HNZ', 'JSFB.HNE', 'JSFB.HNZ'])
+        self.assertAlmostEqual(f['JRSC.HNE'].shape[0], 60 * _SAMPLING_RATE,
+                               delta=1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+"""Tests of the vectorized geodetic computations against obspy.
+
+Usage:
+  python -m unittest tests.test_geodetics
+"""
+
+import unittest
+
+import numpy as np
+from obspy.geodetics.base import gps2dist_azimuth
+
+from preprocessing import geodetics
+from preprocessing import parameters
+
+
+class DistanceAzimuthTest(unittest.TestCase):
+
+  def _check(self, lat1, lon1, lat2, lon2, atol=1e-3):
+    distance, azimuth = geodetics.distance_azimuth(lat1, lon1, lat2, lon2)
+    expected = np.array([
+        gps2dist_azimuth(*coordinates)[:2] for coordinates in zip(
+            *np.broadcast_arrays(lat1, lon1, lat2, lon2))])
+    np.testing.assert_allclose(distance, expected[:, 0], rtol=0,
+                               atol=atol)
+    # the azimuth wraps around at 360 degrees
+    azimuth_error = np.mod(azimuth - expected[:, 1] + 180, 360) - 180
+    np.testing.assert_allclose(azimuth_error, 0, atol=1e-6)
+
+  def test_catalog_region(self):
+    rng = np.random.default_rng(0)
+    num_events = 1000
+    self._check(
+        parameters.stanford_latitude, parameters.stanford_longitude,
+        parameters.stanford_latitude + rng.uniform(
+            -parameters.max_radius, parameters.max_radius, num_events),
+        parameters.stanford_longitude + rng.uniform(
+            -parameters.max_radius, parameters.max_radius, num_events))
+
+  def test_global(self):
+    # obspy uses geographiclib if available, which differs by up to a few
+    # centimeters from Vincenty's formula over thousands of kilometers
+    rng = np.random.default_rng(1)
+    num_points = 1000
+    self._check(rng.uniform(-80, 80, num_points),
+                rng.uniform(-180, 180, num_points),
+                rng.uniform(-80, 80, num_points),
+                rng.uniform(-180, 180, num_points), atol=0.1)
+
+  def test_coincident_points(self):
+    distance, azimuth = geodetics.distance_azimuth(
+        [37.4, 0.0], [-122.2, 10.0], [37.4, 0.0], [-122.2, 10.0])
+    np.testing.assert_array_equal(distance, 0)
+    np.testing.assert_array_equal(azimuth, 0)
+
+  def test_scalars(self):
+    distance, azimuth = geodetics.distance_azimuth(37.4, -122.2, 37.5, -122.2)
+    self.assertEqual(np.shape(distance), ())
+    self.assertAlmostEqual(float(azimuth), 0.0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,165 @@
+"""Tests of the incremental reruns of the window processing with a completion
+ledger.
+
+Usage:
+  python -m unittest tests.test_ledger
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import h5py
+import numpy as np
+
+from preprocessing import ledger
+from preprocessing import window_store
+from tests import processing_stub
+
+process_seismometer = processing_stub.import_module(
+    'preprocessing.process_seismometer')
+
+
+def _make_raw_file(filename, seed, num_samples=6000):
+  """Writes a raw seismometer window with random channels."""
+  rng = np.random.default_rng(seed)
+  os.makedirs(os.path.dirname(filename), exist_ok=True)
+  with h5py.File(filename, 'w') as f:
+    for key in ('JRSC.HNE', 'JRSC.HNN', 'JRSC.HNZ'):
+      f.create_dataset(key, data=rng.normal(size=num_samples))
+
+
+class CompletionLedgerTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.filename = os.path.join(self._tmp_dir.name, 'event_00000.hdf5')
+    self.ledger_file = os.path.join(self._tmp_dir.name, 'ledger.jsonl')
+    with open(self.filename, 'w') as f:
+      f.write('a')
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def test_complete(self):
+    ledger.CompletionLedger(self.ledger_file, dict(a=1)).record(self.filename)
+    self.assertTrue(ledger.CompletionLedger(
+        self.ledger_file, dict(a=1)).is_complete(self.filename))
+    self.assertFalse(ledger.CompletionLedger(
+        self.ledger_file, dict(a=2)).is_complete(self.filename))
+
+  def test_modified_input(self):
+    completion_ledger = ledger.CompletionLedger(self.ledger_file, {})
+    completion_ledger.record(self.filename)
+    with open(self.filename, 'w') as f:
+      f.write('ab')
+    self.assertFalse(completion_ledger.is_complete(self.filename))
+
+  def test_missing_output(self):
+    completion_ledger = ledger.CompletionLedger(self.ledger_file, {})
+    completion_ledger.record(self.filename)
+    self.assertEqual(completion_ledger.filter_incomplete(
+        [self.filename], lambda filename: True), [])
+    self.assertEqual(completion_ledger.filter_incomplete(
+        [self.filename], lambda filename: False), [self.filename])
+
+
+class IncrementalProcessingTest(unittest.TestCase):
+  """Tests reruns of `process_windows` after an input changed."""
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.path = self._tmp_dir.name
+    self.raw_path = os.path.join(self.path, 'raw')
+    self.out_path = os.path.join(self.path, 'processed')
+    self.filenames = [
+        os.path.join(self.raw_path, 'seismometer', 'event',
+                     'event_{:05d}.hdf5'.format(i)) for i in range(3)]
+    for i, filename in enumerate(self.filenames):
+      _make_raw_file(filename, i)
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def _process(self, store_file=None):
+    """Runs `process_windows`.
+
+    Returns:
+      The files that were processed.
+    """
+    read_hdf5 = mock.Mock(wraps=process_seismometer.read_hdf5)
+    with mock.patch.object(process_seismometer, 'read_hdf5', read_hdf5):
+      process_seismometer.process_windows(
+          os.path.join(self.raw_path, 'seismometer', '*', '*'),
+          in_dir=self.raw_path, out_dir=self.out_path, raw_window=60,
+          detect_window=20.48, event_duration=12, low_freq=1.0,
+          high_freq=12.0, dt=0.01, q=4,
+          ledger_file=os.path.join(self.out_path, 'ledger.jsonl'),
+          store_file=store_file)
+    return [call.args[0] for call in read_hdf5.call_args_list]
+
+  def _modify(self, filename):
+    """Rewrites an input file, with a modification time that differs even on
+    file systems with coarse timestamps."""
+    mtime = os.stat(filename).st_mtime_ns
+    _make_raw_file(filename, seed=10)
+    os.utime(filename, ns=(mtime + 10**9, mtime + 10**9))
+
+  def _read_outputs(self):
+    outputs = []
+    for filename in self.filenames:
+      out_file = filename.replace(self.raw_path, self.out_path).replace(
+          '.hdf5', '.h5')
+      with h5py.File(out_file, 'r') as f:
+        outputs.append((os.stat(out_file).st_mtime_ns, f['input'][()]))
+    return outputs
+
+  def _read_store(self, store_file):
+    with window_store.WindowStore(store_file, 'r') as store:
+      return (list(store.read_index()[0]),
+              [store.read(i)[0] for i in range(len(store))])
+
+  def test_changed_input(self):
+    self.assertEqual(self._process(), self.filenames)
+    outputs = self._read_outputs()
+    self._modify(self.filenames[1])
+    self.assertEqual(self._process(), [self.filenames[1]])
+    new_outputs = self._read_outputs()
+    for i in (0, 2):
+      self.assertEqual(new_outputs[i][0], outputs[i][0])
+      np.testing.assert_array_equal(new_outputs[i][1], outputs[i][1])
+    self.assertFalse(np.array_equal(new_outputs[1][1], outputs[1][1]))
+
+  def test_missing_output(self):
+    self._process()
+    os.remove(self.filenames[2].replace(self.raw_path, self.out_path).replace(
+        '.hdf5', '.h5'))
+    self.assertEqual(self._process(), [self.filenames[2]])
+
+  def test_changed_input_in_store(self):
+    store_file = os.path.join(self.out_path, 'windows.h5')
+    self._process(store_file)
+    source_files, windows = self._read_store(store_file)
+    self._modify(self.filenames[1])
+    self.assertEqual(self._process(store_file), [self.filenames[1]])
+    new_source_files, new_windows = self._read_store(store_file)
+    self.assertEqual(new_source_files, source_files)
+    for i in (0, 2):
+      np.testing.assert_array_equal(new_windows[i], windows[i])
+    self.assertFalse(np.array_equal(new_windows[1], windows[1]))
+
+  def test_moved_store(self):
+    store_file = os.path.join(self.out_path, 'windows.h5')
+    self._process(store_file)
+    moved_store_file = os.path.join(self.path, 'moved', 'windows.h5')
+    os.makedirs(os.path.dirname(moved_store_file))
+    shutil.move(store_file, moved_store_file)
+    self.assertEqual(self._process(moved_store_file), [])
+    # a store that is missing is written again
+    self.assertEqual(self._process(store_file), self.filenames)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,135 @@
+"""Tests of the multi-threshold matching of detections against a brute-force
+matcher that evaluates each threshold separately.
+
+Usage:
+  python -m unittest tests.test_match_detections
+"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from postprocessing import match_detections
+
+
+_SECOND = 10**9
+
+
+def _brute_force_match(window_starts, scores, event_times, window_length,
+                       thresholds, tolerance=0.0):
+  """Matches the detections window by window, for each threshold."""
+  length = int(round(window_length * 1e9))
+  tolerance = int(round(tolerance * 1e9))
+  covers = [[start - tolerance <= time <= start + length + tolerance
+             for time in event_times] for start in window_starts]
+  observed = [j for j in range(len(event_times))
+              if any(row[j] for row in covers)]
+  rows = []
+  for threshold in thresholds:
+    above = [score >= threshold for score in scores]
+    # runs of consecutive overlapping windows above the threshold
+    runs = []
+    for i in range(len(scores)):
+      if not above[i]:
+        continue
+      if (runs and runs[-1][-1] == i - 1 and
+          window_starts[i] - window_starts[i - 1] <= length):
+        runs[-1].append(i)
+      else:
+        runs.append([i])
+    true_detections = sum(any(any(covers[i]) for i in run) for run in runs)
+    matched = sum(any(above[i] and covers[i][j] for i in range(len(scores)))
+                  for j in observed)
+    rows.append({
+        'threshold': threshold,
+        'detections': len(runs),
+        'true_detections': true_detections,
+        'false_alarms': len(runs) - true_detections,
+        'matched_events': matched,
+        'missed_events': len(observed) - matched,
+        'precision': true_detections / len(runs) if runs else np.nan,
+        'recall': matched / len(observed) if observed else np.nan,
+    })
+  return pd.DataFrame(rows, columns=[
+      'threshold', 'detections', 'true_detections', 'false_alarms',
+      'matched_events', 'missed_events', 'precision', 'recall'])
+
+
+class MatchTest(unittest.TestCase):
+
+  def assert_matches_brute_force(self, window_starts, scores, event_times,
+                                 window_length, thresholds, tolerance=0.0):
+    window_starts = np.asarray(window_starts, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    event_times = np.asarray(event_times, dtype=np.int64)
+    results = match_detections.match(window_starts, scores, event_times,
+                                     window_length, thresholds, tolerance)
+    expected = _brute_force_match(window_starts, scores, event_times,
+                                  window_length, thresholds, tolerance)
+    pd.testing.assert_frame_equal(results, expected, check_dtype=False)
+
+  def test_random(self):
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+      num_windows = rng.integers(1, 40)
+      # windows of 10 s with 50% overlap, with gaps between files
+      strides = rng.choice([5, 5, 5, 30], num_windows - 1)
+      window_starts = np.concatenate([[0], np.cumsum(strides)]) * _SECOND
+      # scores with ties, and thresholds equal to the scores
+      scores = rng.integers(0, 5, num_windows) / 4
+      # event times on a 1 s grid, so some fall on window boundaries
+      event_times = rng.integers(-20, window_starts[-1] // _SECOND + 20,
+                                 rng.integers(0, 10)) * _SECOND
+      tolerance = rng.choice([0.0, 1.0, 2.5])
+      self.assert_matches_brute_force(window_starts, scores, event_times, 10,
+                                      np.linspace(0, 1, 5), tolerance)
+
+  def test_window_boundaries(self):
+    window_starts = np.array([0, 20, 40]) * _SECOND
+    scores = [1.0, 1.0, 1.0]
+    # the first two events are on the edges of the first window extended by
+    # the tolerance, the third on the edge of the second window, and the last
+    # two just outside the data
+    event_times = (np.array([-2, 12, 28]) * _SECOND).tolist() + [
+        -2 * _SECOND - 1, 52 * _SECOND + 1]
+    self.assert_matches_brute_force(window_starts, scores, event_times, 10,
+                                    [1.0], tolerance=2.0)
+    results = match_detections.match(
+        window_starts, scores, event_times, 10, [1.0], tolerance=2.0)
+    self.assertEqual(results['matched_events'].iloc[0], 3)
+    self.assertEqual(results['missed_events'].iloc[0], 0)
+    self.assertEqual(results['false_alarms'].iloc[0], 1)
+
+  def test_threshold_boundary(self):
+    window_starts = np.array([0, 5, 10, 15]) * _SECOND
+    scores = [0.5, 0.7, 0.5, 0.7]
+    event_times = [7 * _SECOND]
+    self.assert_matches_brute_force(window_starts, scores, event_times, 10,
+                                    [0.5, 0.6, 0.7, 0.8])
+    results = match_detections.match(window_starts, scores, event_times, 10,
+                                     [0.5, 0.7])
+    # scores equal to the threshold are above it
+    self.assertEqual(results['detections'].tolist(), [1, 2])
+    self.assertEqual(results['matched_events'].tolist(), [1, 1])
+
+  def test_ties(self):
+    # duplicate window starts, duplicate events and equal scores
+    window_starts = np.array([0, 0, 5, 5, 10]) * _SECOND
+    scores = [0.5, 0.5, 0.5, 0.2, 0.5]
+    event_times = [3 * _SECOND, 3 * _SECOND, 14 * _SECOND]
+    self.assert_matches_brute_force(window_starts, scores, event_times, 10,
+                                    [0.2, 0.5, 0.6])
+
+  def test_empty(self):
+    window_starts = np.array([0, 5]) * _SECOND
+    self.assert_matches_brute_force(window_starts, [0.1, 0.9], [], 10,
+                                    [0.0, 0.5, 1.0])
+    self.assert_matches_brute_force([], [], [3 * _SECOND], 10, [0.0, 0.5])
+    self.assert_matches_brute_force([], [], [], 10, [0.5])
+    self.assert_matches_brute_force(window_starts, [0.1, 0.9],
+                                    [3 * _SECOND], 10, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
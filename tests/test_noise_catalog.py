@@ -0,0 +1,118 @@
+"""Tests of the sampling of the background noise time stamps.
+
+Usage:
+  python -m unittest tests.test_noise_catalog
+"""
+
+import datetime as dt
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from preprocessing import catalog_store
+from preprocessing import create_noise_catalog
+
+
+class SampleIntervalsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rng = np.random.default_rng(0)
+    lengths = self.rng.integers(1, 600, 50)
+    gaps = self.rng.integers(1, 600, 50)
+    self.starts = 1577836800 + np.cumsum(lengths + gaps) - lengths
+    self.ends = self.starts + lengths
+
+  def _check(self, times, num_samples, spacing):
+    self.assertEqual(len(times), num_samples)
+    self.assertTrue(np.all(np.diff(times) >= max(spacing, 0)))
+    interval = np.searchsorted(self.starts, times, 'right') - 1
+    self.assertTrue(np.all(interval >= 0))
+    self.assertTrue(np.all(times < self.ends[interval]))
+
+  def test_spacing(self):
+    total = (self.ends - self.starts).sum()
+    for spacing in (0, 1, 30, total // 20):
+      with self.subTest(spacing=spacing):
+        times = create_noise_catalog._sample_intervals(  # pylint: disable=protected-access
+            self.rng, self.starts, self.ends, 20, spacing)
+        self._check(times, 20, spacing)
+
+  def test_tight_spacing(self):
+    # the whole allowed time is needed for the spacing
+    total = (self.ends - self.starts).sum()
+    times = create_noise_catalog._sample_intervals(  # pylint: disable=protected-access
+        self.rng, self.starts, self.ends, 2, total - 1)
+    self._check(times, 2, total - 1)
+    with self.assertRaises(ValueError):
+      create_noise_catalog._sample_intervals(  # pylint: disable=protected-access
+          self.rng, self.starts, self.ends, 2, total)
+
+  def test_empty(self):
+    times = create_noise_catalog._sample_intervals(  # pylint: disable=protected-access
+        self.rng, self.starts, self.ends, 0, 10)
+    self.assertEqual(len(times), 0)
+
+  def test_split_by_hour(self):
+    starts = np.array([0, 3000, 10800]) + 1577836800
+    ends = np.array([100, 7300, 14400]) + 1577836800
+    split_starts, split_ends = create_noise_catalog._split_by_hour(  # pylint: disable=protected-access
+        starts, ends)
+    np.testing.assert_array_equal(
+        split_starts - 1577836800, [0, 3000, 3600, 7200, 10800])
+    np.testing.assert_array_equal(
+        split_ends - 1577836800, [100, 3600, 7200, 7300, 14400])
+
+
+class NoiseCatalogBuilderTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    rng = np.random.default_rng(0)
+    start = pd.Timestamp('2020-01-01').value
+    self.event_times = np.sort(
+        start + rng.integers(0, 10 * 86400, 300) * 10**9)
+    self.catalog_file = os.path.join(self._tmp_dir.name, 'catalog.h5')
+    catalog_store.save_catalog(pd.DataFrame({
+        'datetime': pd.to_datetime(self.event_times),
+        'distance': rng.uniform(0, 100000, 300),
+    }), self.catalog_file)
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def _create(self, num_entries, stratify_by_hour):
+    builder = create_noise_catalog.NoiseCatalogBuilder(
+        self.catalog_file, num_entries, buffer=dt.timedelta(minutes=10),
+        min_spacing=dt.timedelta(minutes=10),
+        stratify_by_hour=stratify_by_hour)
+    builder.create_noise_catalog()
+    times = builder.catalog['datetime'].to_numpy(
+        dtype='datetime64[ns]').astype(np.int64)
+    self.assertEqual(len(times), num_entries)
+    self.assertTrue(np.all(np.diff(times) >= 10 * 60 * 10**9))
+    gaps = np.abs(times[:, None] - self.event_times[None]).min(axis=1)
+    self.assertTrue(np.all(gaps >= 10 * 60 * 10**9))
+    self.assertTrue(np.all(times > self.event_times[0]))
+    self.assertTrue(np.all(times < self.event_times[-1]))
+    return times
+
+  def test_uniform(self):
+    self._create(200, stratify_by_hour=False)
+
+  def test_stratify_by_hour(self):
+    times = self._create(240, stratify_by_hour=True)
+    counts = np.bincount(pd.to_datetime(times).hour, minlength=24)
+    np.testing.assert_array_equal(counts, np.full(24, 10))
+
+  def test_stratify_by_hour_remainder(self):
+    times = self._create(250, stratify_by_hour=True)
+    counts = np.bincount(pd.to_datetime(times).hour, minlength=24)
+    self.assertEqual(counts.sum(), 250)
+    self.assertLessEqual(counts.max() - counts.min(), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+"""Tests of the streaming normalization statistics.
+
+Usage:
+  python -m unittest tests.test_normalization_stats
+"""
+
+import argparse
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from preprocessing import normalization_stats
+
+try:
+  import tensorflow as tf
+except ImportError:
+  tf = None
+
+
+class NormalizationStatsTest(unittest.TestCase):
+
+  def setUp(self):
+    rng = np.random.default_rng(0)
+    self.data = (rng.standard_t(3, (3, 100000)) *
+                 np.array([0.01, 1.0, 50.0])[:, np.newaxis])
+    self.stats = normalization_stats.NormalizationStats(per_channel=True)
+    for part in np.array_split(self.data, 7, axis=1):
+      part_stats = normalization_stats.NormalizationStats(per_channel=True)
+      part_stats.update(part)
+      self.stats.merge(part_stats)
+
+  def test_moments(self):
+    np.testing.assert_allclose(self.stats.mean, self.data.mean(axis=1))
+    np.testing.assert_allclose(self.stats.std, self.data.std(axis=1))
+
+  def test_percentile(self):
+    np.testing.assert_allclose(
+        self.stats.percentile(85),
+        np.percentile(np.abs(self.data), 85, axis=1), rtol=0.01)
+
+  def test_clipped_std(self):
+    clip = self.stats.percentile(85)
+    clipped = np.clip(self.data, -clip[:, np.newaxis], clip[:, np.newaxis])
+    np.testing.assert_allclose(self.stats.clipped_std(clip),
+                               np.sqrt(np.mean(clipped ** 2, axis=1)),
+                               rtol=0.001)
+
+  def test_unclipped_std(self):
+    np.testing.assert_allclose(self.stats.clipped_std(np.abs(self.data).max(axis=1)),
+                               self.data.std(axis=1), rtol=0.001)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class GetNormalizationTest(unittest.TestCase):
+
+  def test_missing_stats_file(self):
+    from tfrecords import sharding
+    with tempfile.TemporaryDirectory() as datapath:
+      params = argparse.Namespace(stats_file='stats.npz', compute_stats=False)
+      with self.assertRaises(ValueError):
+        sharding.get_normalization(params, datapath, [], (1.0, 1.0),
+                                   per_channel=False)
+      self.assertFalse(os.path.exists(os.path.join(datapath, 'stats.npz')))
+
+
+if __name__ == '__main__':
+  unittest.main()
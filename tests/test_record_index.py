@@ -0,0 +1,100 @@
+"""Tests of the random access to indexed TFRecord shards.
+
+Usage:
+  python -m unittest tests.test_record_index
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import h5py
+import numpy as np
+
+from tfrecords import record_index
+
+try:
+  import tensorflow as tf
+except ImportError:
+  tf = None
+
+
+_INPUT_SHAPE = (4, 5)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class IndexedRecordsTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.datapath = self._tmp_dir.name
+    self.rng = np.random.default_rng(0)
+    # 11 windows, so the last record of a shard is not full when packed
+    self.entries = []
+    for i in range(11):
+      filename = os.path.join(self.datapath, 'w{:02d}.h5'.format(i))
+      with h5py.File(filename, 'w') as f:
+        f.create_dataset(
+            'input', data=self.rng.standard_normal(_INPUT_SHAPE) * 0.01)
+        f.create_dataset('label', data=np.full(1, i % 2, dtype=np.float32))
+      self.entries.append(filename)
+    with open(os.path.join(self.datapath, 'manifest.txt'), 'w') as f:
+      f.write(''.join(entry + '\n' for entry in self.entries))
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def _convert(self, *args):
+    from tfrecords import convert_tfrecords_das
+    params, _ = convert_tfrecords_das.ArgumentParser().parse_known_args([
+        '--manifest_file', 'manifest.txt', '--output_file_prefix', 'out/x',
+        '--read_workers', '0', '--write_index'] + list(args))
+    with mock.patch.object(convert_tfrecords_das.get_datapath, 'get_datapath',
+                           return_value=self.datapath):
+      convert_tfrecords_das.convert_to_tfrecords(params)
+
+  def _check_examples(self):
+    from tfrecords import convert_tfrecords_das
+    data_loader = convert_tfrecords_das.DataLoader(0.0, 1.0)
+    with record_index.IndexedRecords(
+        os.path.join(self.datapath, 'out', 'x-*'), _INPUT_SHAPE) as records:
+      self.assertEqual(len(records), len(self.entries))
+      # the examples are numbered in the order they were written
+      self.assertEqual(records.entries.tolist(), self.entries)
+      for i, entry in enumerate(self.entries):
+        self.assertEqual(records.find(entry), i)
+        inputs, labels = records[records.find(entry)]
+        expected_inputs, expected_labels = data_loader.read(entry)
+        np.testing.assert_array_equal(inputs, expected_inputs)
+        np.testing.assert_array_equal(labels, expected_labels)
+        np.testing.assert_array_equal(records.labels[i], expected_labels)
+      self.assertIsNone(records.find('missing.h5'))
+      self.assertEqual(sorted(i for i, _, _ in records.shuffled(seed=0)),
+                       list(range(len(self.entries))))
+    return records
+
+  def test_shards(self):
+    self._convert('--num_shards', '3', '--compression_type', '')
+    records = self._check_examples()
+    self.assertEqual(len(records.files), 3)
+
+  def test_packed_shards(self):
+    self._convert('--num_shards', '2', '--compression_type', '',
+                  '--examples_per_record', '3')
+    self._check_examples()
+
+  def test_sized_shards(self):
+    self._convert('--target_shard_bytes', '500', '--compression_type', '',
+                  '--examples_per_record', '2')
+    records = self._check_examples()
+    self.assertGreater(len(records.files), 1)
+
+  def test_compressed_shards(self):
+    with self.assertRaises(ValueError):
+      self._convert('--num_shards', '2', '--compression_type', 'GZIP')
+    self.assertFalse(os.path.exists(os.path.join(self.datapath, 'out')))
+
+
+if __name__ == '__main__':
+  unittest.main()
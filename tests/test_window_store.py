@@ -0,0 +1,214 @@
+"""Tests of the consolidated window store and of resuming the processing
+into it.
+
+Usage:
+  python -m unittest tests.test_window_store
+"""
+
+import gc
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import h5py
+import numpy as np
+
+from preprocessing import ledger
+from preprocessing import window_store
+from tests import processing_stub
+
+process_seismometer = processing_stub.import_module(
+    'preprocessing.process_seismometer')
+
+try:
+  import tensorflow as tf
+except ImportError:
+  tf = None
+
+
+def _make_raw_file(filename, seed, num_samples=6000):
+  """Writes a raw seismometer window with random channels."""
+  rng = np.random.default_rng(seed)
+  os.makedirs(os.path.dirname(filename), exist_ok=True)
+  with h5py.File(filename, 'w') as f:
+    for key in ('JRSC.HNE', 'JRSC.HNN', 'JRSC.HNZ'):
+      f.create_dataset(key, data=rng.normal(size=num_samples))
+
+
+class WindowStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.store_file = os.path.join(self._tmp_dir.name, 'store.h5')
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def test_repair_partial_append(self):
+    with window_store.WindowStore(self.store_file) as store:
+      store.append(np.zeros((2, 3)), 0.0, 'noise_00001.hdf5')
+      store.append(np.ones((2, 3)), 1.0, 'event_00002.hdf5')
+      # append of a third window interrupted after its input
+      store._file['input'].resize(3, axis=0)  # pylint: disable=protected-access
+      store.repair()
+      self.assertEqual(len(store), 2)
+      self.assertEqual(store._file['input'].shape[0], 2)  # pylint: disable=protected-access
+
+  def test_replace_in_place(self):
+    with window_store.WindowStore(self.store_file) as store:
+      for i in range(3):
+        store.replace('event_{:05d}.hdf5'.format(i),
+                      [(np.full((2, 3), i), 1.0, 1),
+                       (np.full((2, 3), i), 1.0, 2)])
+      indices = store.replace('event_00001.hdf5',
+                              [(np.full((2, 3), 5), 1.0, 1),
+                               (np.full((2, 3), 5), 1.0, 2)])
+      self.assertEqual(indices, [2, 3])
+      self.assertEqual(len(store), 6)
+      np.testing.assert_array_equal(
+          [store.read(i)[0][0, 0] for i in range(6)], [0, 0, 5, 5, 2, 2])
+
+  def test_replace_other_count(self):
+    with window_store.WindowStore(self.store_file) as store:
+      for i in range(3):
+        store.replace('event_{:05d}.hdf5'.format(i),
+                      [(np.full((2, 3), i), 1.0, 0)])
+      indices = store.replace('event_00001.hdf5',
+                              [(np.full((2, 3), 5), 1.0, 1),
+                               (np.full((2, 3), 5), 1.0, 2)])
+      self.assertEqual(indices, [2, 3])
+      source_files, event_ids, channel_subsets = store.read_index()
+      self.assertEqual(list(source_files), [
+          'event_00000.hdf5', 'event_00002.hdf5', 'event_00001.hdf5',
+          'event_00001.hdf5'])
+      np.testing.assert_array_equal(event_ids, [0, 2, 1, 1])
+      np.testing.assert_array_equal(channel_subsets, [0, 0, 1, 2])
+      np.testing.assert_array_equal(
+          [store.read(i)[0][0, 0] for i in range(4)], [0, 2, 5, 5])
+
+  def test_reset(self):
+    with window_store.WindowStore(self.store_file) as store:
+      store.reset('a')
+      store.append(np.zeros((2, 3)), 0.0, 'noise_00001.hdf5')
+      store.reset('a')
+      self.assertEqual(len(store), 1)
+      store.reset('b')
+      self.assertEqual(len(store), 0)
+      self.assertNotIn('noise_00001.hdf5', store)
+      # windows of another shape can be written after a reset
+      store.append(np.zeros((4, 5)), 0.0, 'noise_00001.hdf5')
+      self.assertIn('noise_00001.hdf5', store)
+
+
+class _Killed(Exception):
+  pass
+
+
+class ResumeTest(unittest.TestCase):
+  """Tests resuming `process_windows` with a window store."""
+
+  def setUp(self):
+    self._tmp_dir = tempfile.TemporaryDirectory()
+    self.path = self._tmp_dir.name
+    self.raw_path = os.path.join(self.path, 'raw')
+    self.filenames = [
+        os.path.join(self.raw_path, 'seismometer', 'event',
+                     'event_{:05d}.hdf5'.format(i)) for i in range(4)]
+    for i, filename in enumerate(self.filenames):
+      _make_raw_file(filename, i)
+
+  def tearDown(self):
+    self._tmp_dir.cleanup()
+
+  def _process(self, name='store', crash_at=None, **params):
+    """Runs `process_windows`, killed after the window of `crash_at` was
+    written and before it was recorded as complete, if set.
+
+    Returns:
+      (source_files, windows) tuple of the resulting store.
+    """
+    kwargs = dict(raw_window=60, detect_window=20.48, event_duration=12,
+                  low_freq=1.0, high_freq=12.0, dt=0.01, q=4)
+    kwargs.update(params)
+    store_file = os.path.join(self.path, name, 'windows.h5')
+    record = ledger.CompletionLedger.record
+
+    def record_or_crash(completion_ledger, filename):
+      if filename == crash_at:
+        raise _Killed()
+      record(completion_ledger, filename)
+
+    with mock.patch.object(ledger.CompletionLedger, 'record',
+                           record_or_crash):
+      try:
+        process_seismometer.process_windows(
+            os.path.join(self.raw_path, 'seismometer', '*', '*'),
+            in_dir=self.raw_path, out_dir=os.path.join(self.path, name),
+            ledger_file=os.path.join(self.path, name, 'ledger.jsonl'),
+            store_file=store_file, **kwargs)
+      except _Killed:
+        # the killed run leaves its store open
+        gc.collect()
+        return None
+    with window_store.WindowStore(store_file, 'r') as store:
+      return (list(store.read_index()[0]),
+              [store.read(i)[0] for i in range(len(store))])
+
+  def test_resume_after_unrecorded_write(self):
+    self._process(crash_at=self.filenames[1])
+    source_files, windows = self._process()
+    expected_source_files, expected_windows = self._process('expected')
+    self.assertEqual(source_files, self.filenames)
+    self.assertEqual(expected_source_files, self.filenames)
+    np.testing.assert_array_equal(windows, expected_windows)
+
+  def test_parameter_change(self):
+    self._process()
+    # the windows are longer with the new parameters
+    source_files, windows = self._process(detect_window=30.0)
+    expected_source_files, expected_windows = self._process(
+        'expected', detect_window=30.0)
+    self.assertEqual(source_files, expected_source_files)
+    self.assertEqual(len(windows), len(self.filenames))
+    np.testing.assert_array_equal(windows, expected_windows)
+
+  def test_parameter_change_resumed(self):
+    self._process()
+    self._process(crash_at=self.filenames[2], high_freq=10.0)
+    source_files, windows = self._process(high_freq=10.0)
+    _, expected_windows = self._process('expected', high_freq=10.0)
+    self.assertEqual(source_files, self.filenames)
+    np.testing.assert_array_equal(windows, expected_windows)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed.')
+class ResolveStoreEntryTest(unittest.TestCase):
+
+  def test_das_store_entry(self):
+    from tfrecords import convert_tfrecords_seismometer
+    with tempfile.TemporaryDirectory() as path:
+      das_store_file = os.path.join(path, 'das', 'windows.h5')
+      store_file = os.path.join(path, 'geophone', 'windows.h5')
+      for filename in (das_store_file, store_file):
+        os.makedirs(os.path.dirname(filename))
+      with window_store.WindowStore(store_file) as store:
+        for i in (2, 1):
+          store.append(np.zeros((6, 3)), 1.0, os.path.join(
+              path, 'raw', 'geophone', 'event_{:05d}.hdf5'.format(i)))
+      with window_store.WindowStore(das_store_file) as store:
+        for i in (1, 2):
+          for channel_subset in (1, 2):
+            store.append(np.zeros((4, 3)), 1.0, os.path.join(
+                path, 'raw', 'das', 'event_{:05d}.hdf5'.format(i)),
+                         channel_subset)
+
+      resolved = [convert_tfrecords_seismometer._resolve_entry(  # pylint: disable=protected-access
+          window_store.make_entry(das_store_file, i)) for i in range(4)]
+      self.assertEqual(resolved, [
+          window_store.make_entry(store_file, 1), None,
+          window_store.make_entry(store_file, 0), None])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,239 @@
+"""Build state of a TFRecord dataset, for incremental rebuilds.
+
+The build state is a JSON file next to the output prefix of a dataset. It
+records the conversion parameters, which manifest entries went into which
+shard, and a content hash of the window data of each input, computed by the
+shard writers from the data they read. On a rerun with the same parameters:
+  - shards whose entries are still a contiguous run of the manifest, in the
+    same order relative to the other kept shards, and whose input hashes are
+    unchanged are kept as is,
+  - the manifest entries between the kept shards, i.e. new, moved or changed
+    entries, are written into new shards of the average size of the previous
+    ones.
+The records are thus always in manifest order. Only the new shards are
+converted, and the kept ones are renamed if the number of shards changed.
+
+Manifest entries are assumed to be unique. Deleting the build state file
+forces a full rebuild.
+"""
+
+import collections
+import glob
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from preprocessing import ledger
+from preprocessing import window_store
+from tfrecords import record_index
+
+
+_STATE_FILE_SUFFIX = '.build_state.json'
+
+
+ShardPlan = collections.namedtuple('ShardPlan', ['entries', 'file'])
+
+
+def get_state_file(output_file_prefix):
+  return output_file_prefix + _STATE_FILE_SUFFIX
+
+
+def get_fingerprint(params):
+  """Computes a fingerprint of the conversion parameters."""
+  return ledger.fingerprint(params)
+
+
+def hash_window(data, label):
+  """Computes the content hash of the data and label of a window."""
+  digest = hashlib.sha256()
+  for array in (data, label):
+    digest.update(np.ascontiguousarray(array).tobytes())
+  return digest.hexdigest()
+
+
+def hash_input(entry):
+  """Computes the content hash of a manifest entry.
+
+  Returns:
+    The hash of the window data and label, or None if the input does not
+    exist.
+  """
+  reader = window_store.WindowReader()
+  if entry is None or not reader.exists(entry):
+    return None
+  return hash_window(*reader.read(entry))
+
+
+def _stat_input(entry):
+  if entry is None:
+    return None, None
+  try:
+    stat = os.stat(window_store.parse_entry(entry)[0])
+  except OSError:
+    return None, None
+  return stat.st_size, stat.st_mtime_ns
+
+
+class BuildState():
+  """Shards of a TFRecord dataset and the inputs they were written from.
+
+  Attr:
+    fingerprint: Fingerprint of the conversion parameters.
+    shards: List of {'file', 'entries'} dicts, in shard order.
+    inputs: Dict mapping each entry to its {'hash', 'size', 'mtime'}, where
+      size and mtime are those of the underlying file when it was hashed.
+  """
+
+  def __init__(self, fingerprint, shards=None, inputs=None):
+    self.fingerprint = fingerprint
+    self.shards = shards or []
+    self.inputs = inputs or {}
+
+  @classmethod
+  def load(cls, state_file, fingerprint):
+    """Loads a build state.
+
+    Returns:
+      The build state, or None if there is no state file or if it was written
+      with other parameters.
+    """
+    if not os.path.isfile(state_file):
+      return None
+    with open(state_file, 'r') as f:
+      state = json.load(f)
+    if state['fingerprint'] != fingerprint:
+      logging.info('Conversion parameters changed, rebuilding all shards.')
+      return None
+    return cls(state['fingerprint'], state['shards'], state['inputs'])
+
+  def save(self, state_file):
+    with ledger.atomic_output(state_file) as tmp_file:
+      with open(tmp_file, 'w') as f:
+        json.dump({
+            'fingerprint': self.fingerprint,
+            'shards': self.shards,
+            'inputs': self.inputs,
+        }, f)
+
+  def hash_inputs(self, entries, resolve=None):
+    """Gets the content hashes of entries, before a build.
+
+    Only the inputs of the previous build whose underlying file changed size
+    or modification time are read and hashed. The hashes of the other inputs
+    of the previous build are reused, and those of new inputs are left to the
+    shard writers, which fill them in with `update_hashes`.
+
+    Args:
+      entries: Manifest entries.
+      resolve: Function mapping a manifest entry to the input actually read,
+        or to None if there is none.
+
+    Returns:
+      Dict mapping each entry to its {'hash', 'size', 'mtime'}.
+    """
+    inputs = {}
+    for entry in entries:
+      path = resolve(entry) if resolve else entry
+      size, mtime = _stat_input(path)
+      previous = self.inputs.get(entry)
+      if previous is None:
+        inputs[entry] = {'hash': None, 'size': size, 'mtime': mtime}
+      elif (previous['size'], previous['mtime']) == (size, mtime):
+        inputs[entry] = previous
+      else:
+        inputs[entry] = {
+            'hash': hash_input(path), 'size': size, 'mtime': mtime}
+    return inputs
+
+  @staticmethod
+  def update_hashes(inputs, hashes):
+    """Sets the hashes computed by the shard writers."""
+    for entry, digest in hashes.items():
+      inputs[entry] = dict(inputs[entry], hash=digest)
+
+  def record(self, shard_files, shard_entries, inputs):
+    """Records the shards of a build."""
+    self.shards = [{'file': shard_file, 'entries': list(entries)}
+                   for shard_file, entries in zip(shard_files, shard_entries)]
+    self.inputs = inputs
+
+  def plan(self, entries, inputs):
+    """Plans the shards of a rebuild.
+
+    The previous shards are matched against the manifest in order. A shard is
+    kept if its entries are the next contiguous run of the manifest after the
+    previously kept shard, possibly after some new or moved entries, and if
+    its inputs are unchanged. The entries before each kept shard and after the
+    last one are planned as new shards.
+
+    Args:
+      entries: Manifest entries.
+      inputs: Input hashes of the entries, from `hash_inputs`.
+
+    Returns:
+      List of ShardPlan tuples, in manifest order. The file of a plan is the
+      existing shard file if the shard can be kept as is, and None if it
+      needs to be written.
+    """
+    positions = {entry: i for i, entry in enumerate(entries)}
+    num_entries = sum(len(shard['entries']) for shard in self.shards)
+    shard_size = max(-(-num_entries // max(len(self.shards), 1)), 1)
+
+    plans = []
+
+    def add_new_shards(start, end):
+      for i in range(start, end, shard_size):
+        plans.append(ShardPlan(entries[i:min(i + shard_size, end)], None))
+
+    start = 0
+    for shard in self.shards:
+      shard_entries = shard['entries']
+      position = positions.get(shard_entries[0]) if shard_entries else None
+      if (position is None or position < start or
+          entries[position:position + len(shard_entries)] != shard_entries or
+          not os.path.isfile(shard['file']) or
+          any(inputs[entry]['hash'] != self.inputs[entry]['hash']
+              for entry in shard_entries)):
+        continue
+      add_new_shards(start, position)
+      plans.append(ShardPlan(shard_entries, shard['file']))
+      start = position + len(shard_entries)
+    add_new_shards(start, len(entries))
+    return plans
+
+
+def remove_stale_shards(output_file_prefix, shard_files, file_suffixes):
+  """Removes the shards of previous builds that are not shards of this one,
+  e.g. `-NNNN-of-NNNN` shards of a build with a different number of shards.
+
+  Args:
+    output_file_prefix: Prefix of the shard files.
+    shard_files: Shard files of this build.
+    file_suffixes: Suffixes of the shard files of any compression type.
+  """
+  shard_files = set(shard_files)
+  for file_suffix in file_suffixes:
+    for tfrecord_file in glob.glob('{}-{}-of-{}{}'.format(
+        glob.escape(output_file_prefix), '[0-9]' * 4, '[0-9]' * 4,
+        file_suffix)):
+      if tfrecord_file not in shard_files:
+        logging.info('Removing stale shard %s.', tfrecord_file)
+        record_index.remove_shard(tfrecord_file)
+
+
+def replace_shards(tmp_files, shard_files, stale_files=()):
+  """Moves the shards of a build, and their index files, to their final names.
+
+  Args:
+    tmp_files: Temporary shard files, in shard order.
+    shard_files: Final shard files, in shard order.
+    stale_files: Files of the previous build that are no longer shards.
+  """
+  for stale_file in stale_files:
+    if stale_file not in tmp_files:
+      record_index.remove_shard(stale_file)
+  for tmp_file, shard_file in zip(tmp_files, shard_files):
+    record_index.move_shard(tmp_file, shard_file)
@@ -0,0 +1,102 @@
+"""Checks a normalization statistics file against the built-in values.
+
+The built-in clip and standard deviation values of the converters were
+computed on the training dataset. Recomputing them from the statistics of the
+same dataset should give them back within a few percent, which checks both
+the percentile interpolation and the standard deviation of the clipped values.
+The ratio of the standard deviation to the clip value, about 0.53 for DAS
+data, is checked as well, since it does not depend on the scale of the data.
+
+Usage:
+  python -m tfrecords.check_normalization_stats \
+    --stats_file tfrecords/das_high_prob_balanced/train_stats.npz
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import numpy as np
+
+from config import get_datapath
+from preprocessing import normalization_stats
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+
+def check_stats(stats_file, sensor, clip_percentile=None, tolerance=0.05):
+  """Compares the values of a stats file to the built-in values.
+
+  Args:
+    stats_file: Normalization statistics file.
+    sensor: 'das' or 'seismometer'.
+    clip_percentile: Percentile the data are clipped to. Defaults to the
+      percentile of the built-in values.
+    tolerance: Largest relative deviation from the built-in values.
+
+  Returns:
+    Whether all the values are within the tolerance.
+  """
+  if sensor == 'das':
+    from tfrecords import convert_tfrecords_das as converter
+    expected_clip = converter._DEFAULT_CLIP_VALUE
+    expected_std = converter._DEFAULT_STD_VALUE
+    default_percentile = 85.0
+  else:
+    from tfrecords import convert_tfrecords_seismometer as converter
+    expected_clip = converter._DEFAULT_CLIP_VALUES
+    expected_std = converter._DEFAULT_STD_VALUES
+    default_percentile = 98.0
+  if clip_percentile is None:
+    clip_percentile = default_percentile
+
+  clip, std = normalization_stats.load_clip_and_std(stats_file,
+                                                    clip_percentile)
+  passed = True
+  for name, value, expected in (
+      ('clip', clip, expected_clip), ('std', std, expected_std),
+      ('std / clip', np.divide(std, clip),
+       np.divide(expected_std, expected_clip))):
+    deviation = np.max(np.abs(np.divide(value, expected) - 1))
+    logging.info('%s: %s, built-in %s, deviation %.1f%%', name,
+                 np.round(value, 6), np.round(expected, 6), 100 * deviation)
+    passed = passed and deviation <= tolerance
+  return passed
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--stats_file',
+      help='Normalization statistics file of the training dataset.',
+      default='tfrecords/das_high_prob_balanced/train_stats.npz',
+  )
+  parser.add_argument(
+      '--sensor',
+      help='Sensor of the dataset.',
+      choices=['das', 'seismometer'],
+      default='das',
+  )
+  parser.add_argument(
+      '--clip_percentile',
+      help='Percentile of the absolute values the data are clipped to.',
+      type=float,
+  )
+  parser.add_argument(
+      '--tolerance',
+      help='Largest relative deviation from the built-in values.',
+      type=float,
+      default=0.05,
+  )
+  params = parser.parse_args()
+  stats_file = os.path.join(get_datapath.get_datapath(), params.stats_file)
+  if not check_stats(stats_file, params.sensor, params.clip_percentile,
+                     params.tolerance):
+    logging.error('The statistics deviate from the built-in values.')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
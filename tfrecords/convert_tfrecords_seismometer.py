@@ -1,32 +1,15 @@
-import argparse
-import enum
+import functools
 import logging
 import os
-import random
-import re
 import sys
 
-import h5py
 import numpy as np
 import tensorflow as tf
-import yaml
 
-
-random.seed(42)
-
-
-_DATAPATH_FILE = 'config/datapath.sh'
-
-
-class CompressionType(enum.Enum):
-  GZIP = 'GZIP'
-  NONE = ''
-
-
-_FILE_EXTENSION = {
-    CompressionType.GZIP: '.gz',
-    CompressionType.NONE: '',
-}
+from config import get_datapath
+from preprocessing import window_store
+from tfrecords import build_state
+from tfrecords import sharding
 
 
 logging.basicConfig(level=logging.INFO)
@@ -44,205 +27,114 @@ def create_tf_example(inputs, labels):
   return tf.train.Example(features=tf.train.Features(feature=feature_dict))
 
 
+# 98th percentile, used without a stats file
+_DEFAULT_CLIP_VALUES = np.array(
+    [9.29433527, 9.75987179, 7.43926465, 50.09132858, 48.78753105,
+     54.2594487], dtype=np.float32)
+_DEFAULT_STD_VALUES = np.array(
+    [1.75401556, 2.2324876, 1.63497632, 11.47794848, 10.901093,
+     11.95739858], dtype=np.float32)
+
+
 class DataLoader():
-  def __init__(self, min_val, max_val):
+  def __init__(self, min_val, max_val, clip_values=_DEFAULT_CLIP_VALUES,
+               std_values=_DEFAULT_STD_VALUES):
     self.min_val = min_val
     self.max_val = max_val
+    self.clip_values = np.expand_dims(
+        np.asarray(clip_values, dtype=np.float32), axis=1)
+    self.std_values = np.expand_dims(
+        np.asarray(std_values, dtype=np.float32), axis=1)
+    self._reader = window_store.WindowReader()
 
   def _clip_and_rescale(self, data):
     data = np.clip(data, self.min_val, self.max_val)
     return np.divide((data - self.min_val), (self.max_val - self.min_val))
 
-  def read(self, filename):
-    with h5py.File(filename, 'r') as f:
-      data = f.get('input')[()]
-      labels = f.get('label')[()]
-    # 98th percentile
-    clip_values = np.array([9.29433527,  9.75987179,  7.43926465, 50.09132858, 48.78753105,
-                            54.2594487], dtype=np.float32)
-    std_values = np.array([1.75401556,  2.2324876,  1.63497632, 11.47794848, 10.901093,
-                           11.95739858], dtype=np.float32)
-    clip_values = np.expand_dims(clip_values, axis=1)
-    std_values = np.expand_dims(std_values, axis=1)
-    data = np.clip(data, -clip_values, clip_values) / std_values
-    data = np.float32(data)
-    data = data.T
-    return data, labels
-
-
-def _get_file_suffix(compression_type):
-  return '.tfrecord{}'.format(_FILE_EXTENSION[compression_type])
-
-
-def read_manifest(manifest_file):
-  with open(manifest_file, 'r') as f:
-    file_list = [line.rstrip() for line in f]
-  logging.info('Converting %s files into TFRecords.', len(file_list))
-  return file_list
-
-
-def _glob(file_pattern):
-  return sorted(tf.io.gfile.glob(file_pattern))
+  def exists(self, filename):
+    return self._reader.exists(filename)
 
+  def _normalize(self, data):
+    data = np.clip(data, -self.clip_values, self.clip_values) / self.std_values
+    data = np.float32(data)
+    return data.T
 
-def create_manifest(manifest_file, file_pattern, shuffle=True):
-  file_list = _glob(file_pattern)
-  if shuffle:
-    random.shuffle(file_list)
-  os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
-  with open(manifest_file, 'w') as f:
-    for filename in file_list:
-      f.write(filename + '\n')
+  def read_entry(self, entry):
+    """Reads the window of a manifest entry, and the hash of its raw data.
 
+    Returns:
+      (data, labels, hash) tuple, or None if the window does not exist.
+    """
+    filename = _resolve_entry(entry)
+    if filename is None or not self.exists(filename):
+      return None
+    data, labels = self._reader.read(filename)
+    return (self._normalize(data), labels,
+            build_state.hash_window(data, labels))
 
-def _get_datapath():
-  regex_pattern = r'DATAPATH="(\S+)"'
-  with open(_DATAPATH_FILE, 'r') as f:
-    datapath_text = f.read()
-  regex_match = re.search(regex_pattern, datapath_text)
-  if regex_match:
-    return regex_match.group(1)
-  raise ValueError(
-      'Please set a correct datapath in {}'.format(_DATAPATH_FILE))
+  def read(self, filename):
+    data, labels = self._reader.read(filename)
+    return self._normalize(data), labels
 
 
 def convert_to_tfrecords(params):
-  datapath = _get_datapath()
-  manifest_file = os.path.join(datapath, params.manifest_file)
-  if not os.path.exists(manifest_file):
-    logging.info('Creating manifest file: %s', manifest_file)
-    create_manifest(manifest_file, os.path.join(
-        datapath, params.input_file_pattern))
-  else:
-    logging.info('Using the existing manifest file: %s', manifest_file)
-
-  file_list = read_manifest(manifest_file)
-  file_shards = np.array_split(file_list, params.num_shards)
-  file_suffix = _get_file_suffix(params.compression_type)
-  options = tf.io.TFRecordOptions(
-      compression_type=params.compression_type.value)
-  data_loader = DataLoader(params.min_val, params.max_val)
-  output_file_prefix = os.path.join(datapath, params.output_file_prefix)
-
-  os.makedirs(os.path.dirname(output_file_prefix), exist_ok=True)
-  for i, file_shard in enumerate(file_shards):
-    tfrecord_file = '{}-{:04d}-of-{:04d}{}'.format(
-        output_file_prefix, i, params.num_shards, file_suffix)
-    logging.info('Writing %s', tfrecord_file)
-    with tf.io.TFRecordWriter(tfrecord_file, options=options) as writer:
-      for filename in file_shard:
-        filename = filename.replace('das', 'geophone')
-        filename = filename.replace('_1.h5', '.h5')
-        if os.path.isfile(filename):
-          inputs, outputs = data_loader.read(filename)
-          tf_example = create_tf_example(inputs, outputs)
-          writer.write(tf_example.SerializeToString())
-
-
-class ArgumentParser():
+  sharding.convert_to_tfrecords(
+      params, get_datapath.get_datapath(), DataLoader,
+      (_DEFAULT_CLIP_VALUES, _DEFAULT_STD_VALUES), per_channel=True,
+      resolve_entry=_resolve_entry)
+
+
+def _to_seismometer_path(path):
+  return path.replace('das', 'geophone')
+
+
+@functools.lru_cache(maxsize=None)
+def _get_store_entries(das_store_file):
+  """Maps the windows of a DAS store to those of the seismometer store.
+
+  The seismometer store and the raw data files are found with the same path
+  mapping as the per-window files, and, as for those, only the windows of
+  channel subset 1 have a seismometer window.
+
+  Returns:
+    Dict mapping the index of each DAS window to its seismometer entry.
+  """
+  store_file = _to_seismometer_path(das_store_file)
+  if not os.path.isfile(das_store_file) or not os.path.isfile(store_file):
+    return {}
+  with window_store.WindowStore(store_file, 'r') as store:
+    source_files = store.read_index()[0]
+  windows = {source_file: i for i, source_file in enumerate(source_files)}
+  with window_store.WindowStore(das_store_file, 'r') as store:
+    das_source_files, _, channel_subsets = store.read_index()
+  entries = {}
+  for i, (source_file, channel_subset) in enumerate(
+      zip(das_source_files, channel_subsets)):
+    j = windows.get(_to_seismometer_path(source_file))
+    if channel_subset == 1 and j is not None:
+      entries[i] = window_store.make_entry(store_file, j)
+  return entries
+
+
+def _resolve_entry(entry):
+  """Maps a manifest entry to the seismometer window to read.
+
+  Returns:
+    The seismometer window file or store entry, or None if a DAS store window
+    has no seismometer window.
+  """
+  store_file, i = window_store.parse_entry(entry)
+  if i is not None:
+    return _get_store_entries(store_file).get(i)
+  entry = _to_seismometer_path(entry)
+  entry = entry.replace('_1.h5', '.h5')
+  return entry
+
+
+class ArgumentParser(sharding.ArgumentParser):
 
   def __init__(self):
-    config_parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        add_help=False)
-
-    config_parser.add_argument(
-        '-c', '--config-file',
-        help='Parse script arguments from config file.',
-        default=None,
-        metavar='FILE')
-
-    self._config_parser = config_parser
-
-    self._parser = argparse.ArgumentParser(parents=[config_parser])
-
-  @ staticmethod
-  def _parse_config(items):
-    argv = []
-    for k, v in items:
-      argv.append('--{}'.format(k))
-      argv.append(v)
-    return argv
-
-  def _add_arguments(self, defaults=None):
-    parser = self._parser
-
-    parser.add_argument(
-        '--input_file_pattern',
-        help='Input data files.',
-        default='',
-    )
-    parser.add_argument(
-        '--output_file_prefix',
-        help='Output file prefix.',
-        default='tfrecords/',
-    )
-    parser.add_argument(
-        '--input_height',
-        help='Input data height.',
-        type=int,
-    )
-    parser.add_argument(
-        '--input_width',
-        help='Input data width.',
-        type=int,
-        default=1,
-    )
-    parser.add_argument(
-        '--input_depth',
-        help='Input data depth.',
-        type=int,
-        default=1,
-    )
-    parser.add_argument(
-        '--input_channels',
-        help='Input data channels.',
-        type=int,
-        default=1,
-    )
-    parser.add_argument(
-        '--num_shards',
-        help='Number of shards to generate.',
-        type=int,
-        default=0,
-    )
-    parser.add_argument(
-        '--compression_type',
-        help='File compression type.',
-        type=CompressionType,
-        choices=list(CompressionType),
-        default=CompressionType.GZIP,
-    )
-    parser.add_argument(
-        '--manifest_file',
-        help='Manifest file.',
-        default='tfrecords/manifests/manifest.txt',
-    )
-    parser.add_argument(
-        '--min_val',
-        help='Minimum value.',
-        type=float,
-        default=0.0,
-    )
-    parser.add_argument(
-        '--max_val',
-        help='Maximum value.',
-        type=float,
-        default=1.0,
-    )
-
-  def parse_known_args(self, argv):
-    args, remaining_argv = self._config_parser.parse_known_args(argv)
-    if args.config_file:
-      with open(args.config_file, 'r') as config:
-        defaults = yaml.safe_load(config)
-      defaults['config_file'] = args.config_file
-    else:
-      defaults = dict()
-    self._add_arguments(defaults=defaults)
-    self._parser.set_defaults(**defaults)
-
-    return self._parser.parse_known_args(remaining_argv)
+    super().__init__(clip_percentile=98.0)
 
 
 def main():
@@ -0,0 +1,66 @@
+"""Input pipeline for the TFRecords written by the converters.
+
+Each record holds K examples, with K = 1 unless the converter was run with
+`examples_per_record`: the `inputs` feature holds a contiguous [K, ...] input
+buffer and the `labels` feature a contiguous [K, ...] label buffer. The
+records are parsed as [K, ...] tensors and unbatched in the graph, so packed
+records cost one parse per K examples, and plain records are read the same
+way.
+"""
+
+import tensorflow as tf
+
+
+_FEATURES = {
+    'inputs': tf.io.FixedLenFeature([], tf.string),
+    'labels': tf.io.FixedLenFeature([], tf.string),
+}
+
+
+def parse_record(serialized, input_shape, label_shape=(1,),
+                 dtype=tf.float32):
+  """Parses a record into its [K, ...] inputs and labels.
+
+  Args:
+    serialized: Serialized record.
+    input_shape: Shape of the input of an example, e.g. [288, 695].
+    label_shape: Shape of the label of an example.
+    dtype: Data type of the inputs and labels.
+
+  Returns:
+    (inputs, labels) tuple of [K] + input_shape and [K] + label_shape tensors.
+  """
+  features = tf.io.parse_single_example(serialized, _FEATURES)
+  inputs = tf.io.decode_raw(features['inputs'], dtype)
+  labels = tf.io.decode_raw(features['labels'], dtype)
+  inputs = tf.reshape(inputs, [-1] + list(input_shape))
+  labels = tf.reshape(labels, [-1] + list(label_shape))
+  return inputs, labels
+
+
+def make_dataset(file_pattern, input_shape, label_shape=(1,),
+                 compression_type='GZIP', dtype=tf.float32,
+                 num_parallel_reads=tf.data.AUTOTUNE):
+  """Creates a dataset of the examples of TFRecord shards.
+
+  Args:
+    file_pattern: Unix glob pattern of the shards.
+    input_shape: Shape of the input of an example.
+    label_shape: Shape of the label of an example.
+    compression_type: Compression type of the shards, 'GZIP' or ''.
+    dtype: Data type of the inputs and labels.
+    num_parallel_reads: Number of shards read concurrently.
+
+  Returns:
+    tf.data.Dataset of (inputs, labels) examples, in record order when
+    num_parallel_reads is None.
+  """
+  files = tf.data.Dataset.list_files(file_pattern, shuffle=False)
+  dataset = tf.data.TFRecordDataset(
+      files, compression_type=compression_type,
+      num_parallel_reads=num_parallel_reads)
+  dataset = dataset.map(
+      lambda serialized: parse_record(serialized, input_shape, label_shape,
+                                      dtype),
+      num_parallel_calls=tf.data.AUTOTUNE)
+  return dataset.unbatch()
@@ -0,0 +1,228 @@
+"""Record-offset index of uncompressed TFRecord shards, for random access.
+
+With `write_index`, the converters write uncompressed shards and, next to each
+shard, an index file `<shard>.index.npz` holding, for each example in shard
+order:
+  - offsets: byte offset of the record holding the example,
+  - lengths: length of the record data,
+  - positions: position of the example in its record, non-zero for packed
+    records only,
+  - entries: manifest entry of the example,
+  - labels: label of the example.
+
+A TFRecord is framed by a 12-byte header (the data length and its CRC) and a
+4-byte footer (the data CRC), so the offset of each record follows from the
+lengths of the previous ones. `IndexedRecords` reads single examples with one
+seek and one read, from any number of shards, without TensorFlow.
+"""
+
+import glob
+import os
+import struct
+
+import numpy as np
+
+from tfrecords import serialization
+
+
+_INDEX_FILE_SUFFIX = '.index.npz'
+_HEADER_BYTES = 12
+_FOOTER_BYTES = 4
+
+
+def get_index_file(tfrecord_file):
+  return tfrecord_file + _INDEX_FILE_SUFFIX
+
+
+def move_shard(src, dst):
+  """Renames a shard, together with its index file if any."""
+  os.replace(src, dst)
+  if os.path.isfile(get_index_file(src)):
+    os.replace(get_index_file(src), get_index_file(dst))
+
+
+def remove_shard(tfrecord_file):
+  """Removes a shard, together with its index file if any."""
+  for filename in (tfrecord_file, get_index_file(tfrecord_file)):
+    if os.path.isfile(filename):
+      os.remove(filename)
+
+
+class CountingWriter():
+  """Wraps a TFRecord writer to count the bytes of the records written.
+
+  The writer is passed to `serialization.PackedWriter` in place of the
+  TFRecord writer.
+
+  Attr:
+    num_bytes: Number of bytes written, framing included, i.e. the exact size
+      of an uncompressed shard.
+  """
+
+  def __init__(self, writer):
+    self._writer = writer
+    self.num_bytes = 0
+
+  def write(self, record):
+    self._writer.write(record)
+    self.num_bytes += _HEADER_BYTES + len(record) + _FOOTER_BYTES
+
+
+class RecordIndexWriter(CountingWriter):
+  """Wraps a TFRecord writer of an uncompressed shard to index its examples.
+
+  The examples are added in the order they are written.
+  """
+
+  def __init__(self, writer):
+    super().__init__(writer)
+    self._offsets = []
+    self._lengths = []
+    self._entries = []
+    self._labels = []
+
+  def write(self, record):
+    self._offsets.append(self.num_bytes)
+    self._lengths.append(len(record))
+    super().write(record)
+
+  def add_example(self, entry, labels):
+    self._entries.append(entry)
+    self._labels.append(labels)
+
+  def save(self, index_file, examples_per_record=1):
+    """Writes the index of the examples added so far.
+
+    Args:
+      index_file: Index file.
+      examples_per_record: Number of examples per record the examples were
+        packed with.
+    """
+    records = np.arange(len(self._entries)) // max(examples_per_record, 1)
+    with open(index_file, 'wb') as f:
+      np.savez(
+          f,
+          offsets=np.array(self._offsets, dtype=np.int64)[records],
+          lengths=np.array(self._lengths, dtype=np.int64)[records],
+          positions=np.arange(len(self._entries)) % max(
+              examples_per_record, 1),
+          entries=np.array(self._entries, dtype=str),
+          labels=np.array(self._labels, dtype=np.float32))
+
+
+class IndexedRecords():
+  """Random access to the examples of indexed TFRecord shards.
+
+  The examples are numbered in shard order, then in record order, which is
+  the order in which the converters wrote them and in which a sequential read
+  of the shards returns them.
+
+  Attr:
+    files: Shard files.
+    entries: Manifest entry of each example.
+    labels: Label of each example.
+  """
+
+  def __init__(self, file_pattern, input_shape, dtype=np.float32):
+    """Initialization.
+
+    Args:
+      file_pattern: Unix glob pattern of the shards, or list of shard files.
+      input_shape: Shape of the input of an example.
+      dtype: Data type of the inputs and labels.
+    """
+    if isinstance(file_pattern, str):
+      files = sorted(glob.glob(file_pattern))
+      files = [filename for filename in files
+               if not filename.endswith(_INDEX_FILE_SUFFIX)]
+    else:
+      files = list(file_pattern)
+    if not files:
+      raise ValueError('No shards match {}.'.format(file_pattern))
+    self.files = files
+    self._input_shape = tuple(input_shape)
+    self._dtype = np.dtype(dtype)
+
+    shards, offsets, lengths, positions, entries, labels = (
+        [], [], [], [], [], [])
+    for i, tfrecord_file in enumerate(files):
+      with np.load(get_index_file(tfrecord_file)) as index:
+        shards.append(np.full(len(index['entries']), i, dtype=np.int32))
+        offsets.append(index['offsets'])
+        lengths.append(index['lengths'])
+        positions.append(index['positions'])
+        entries.append(index['entries'])
+        labels.append(index['labels'])
+    self._shards = np.concatenate(shards)
+    self._offsets = np.concatenate(offsets)
+    self._lengths = np.concatenate(lengths)
+    self._positions = np.concatenate(positions)
+    self.entries = np.concatenate(entries)
+    self.labels = np.concatenate(labels)
+    self._handles = {}
+    self._examples_by_entry = None
+
+  def __len__(self):
+    return len(self._offsets)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    for handle in self._handles.values():
+      handle.close()
+    self._handles = {}
+
+  def _get_handle(self, shard):
+    if shard not in self._handles:
+      self._handles[shard] = open(self.files[shard], 'rb')
+    return self._handles[shard]
+
+  def read_record(self, i):
+    """Reads the serialized record holding example i."""
+    f = self._get_handle(self._shards[i])
+    f.seek(self._offsets[i])
+    data = f.read(_HEADER_BYTES + self._lengths[i])
+    length, = struct.unpack('<Q', data[:8])
+    if length != self._lengths[i]:
+      raise ValueError('Record {} of {} does not match its index.'.format(
+          i, self.files[self._shards[i]]))
+    return data[_HEADER_BYTES:]
+
+  def __getitem__(self, i):
+    """Reads example i.
+
+    Returns:
+      (inputs, labels) tuple of arrays.
+    """
+    features = serialization.parse_example(self.read_record(i))
+    position = self._positions[i]
+    inputs = np.frombuffer(features['inputs'], dtype=self._dtype).reshape(
+        (-1,) + self._input_shape)[position]
+    labels = np.frombuffer(features['labels'], dtype=self._dtype).reshape(
+        (-1,) + self.labels.shape[1:])[position]
+    return inputs, labels
+
+  def find(self, entry):
+    """Finds the example of a manifest entry.
+
+    Returns:
+      The example number, or None if the entry is not in the shards.
+    """
+    if self._examples_by_entry is None:
+      self._examples_by_entry = {
+          entry: i for i, entry in enumerate(self.entries)}
+    return self._examples_by_entry.get(entry)
+
+  def shuffled(self, seed=None):
+    """Iterates over the examples of all the shards in a random order.
+
+    Yields:
+      (example number, inputs, labels) tuples.
+    """
+    rng = np.random.default_rng(seed)
+    for i in rng.permutation(len(self)):
+      yield (i,) + self[i]
@@ -0,0 +1,645 @@
+"""Sharding of the TFRecord datasets, shared by the converters.
+
+The DAS and seismometer converters only differ in how a manifest entry is
+read and normalized, which their `DataLoader` classes implement. This module
+holds everything else: the manifest, the normalization statistics, the full
+and incremental builds, the shard writers and the command line flags.
+
+Shards are written either as a fixed number of shards, or as shards of about
+`target_shard_bytes` each. The shard writers run in spawned worker processes,
+so they get the `DataLoader` class of the converter and its arguments, in a
+`WriterConfig`, rather than a data loader instance.
+"""
+
+import argparse
+import collections
+import enum
+import logging
+import os
+import random
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+from preprocessing import normalization_stats
+from preprocessing import parallel
+from preprocessing import window_store
+from tfrecords import build_state
+from tfrecords import record_index
+from tfrecords import serialization
+
+random.seed(42)
+
+
+class CompressionType(enum.Enum):
+  GZIP = 'GZIP'
+  NONE = ''
+
+
+_FILE_EXTENSION = {
+    CompressionType.GZIP: '.gz',
+    CompressionType.NONE: '',
+}
+
+
+_DEFAULT_SHARD_BYTES = 100 * 1024 * 1024
+# TensorFlow is not fork-safe once imported, so the worker processes are
+# spawned
+START_METHOD = 'spawn'
+
+
+# Parameters of the shard writers. `data_loader` is the `DataLoader` class of
+# the converter, built in the workers with `data_loader_args`, and
+# `read_ahead` is a (read_workers, prefetch_depth) tuple.
+WriterConfig = collections.namedtuple(
+    'WriterConfig', ['data_loader', 'data_loader_args', 'compression_type',
+                     'examples_per_record', 'write_index', 'read_ahead'])
+
+
+def get_writer_config(params, data_loader, normalization):
+  """Gets the parameters of the shard writers.
+
+  Args:
+    params: Parsed arguments of `ArgumentParser`.
+    data_loader: `DataLoader` class of the converter, built with the min
+      value, the max value and the normalization values.
+    normalization: (clip, std) tuple.
+  """
+  return WriterConfig(
+      data_loader, (params.min_val, params.max_val) + tuple(normalization),
+      params.compression_type, params.examples_per_record,
+      params.write_index, (params.read_workers, params.prefetch_depth))
+
+
+def get_file_suffix(compression_type):
+  return '.tfrecord{}'.format(_FILE_EXTENSION[compression_type])
+
+
+def read_manifest(manifest_file):
+  with open(manifest_file, 'r') as f:
+    file_list = [line.rstrip() for line in f]
+  logging.info('Converting %s files into TFRecords.', len(file_list))
+  return file_list
+
+
+def _glob(file_pattern):
+  return sorted(tf.io.gfile.glob(file_pattern))
+
+
+def create_manifest(manifest_file, file_pattern, shuffle=True, store=False):
+  file_list = _glob(file_pattern)
+  if store:
+    file_list = [entry for store_file in file_list
+                 for entry in window_store.list_entries(store_file)]
+  if shuffle:
+    random.shuffle(file_list)
+  os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+  with open(manifest_file, 'w') as f:
+    for filename in file_list:
+      f.write(filename + '\n')
+
+
+def get_normalization(params, datapath, file_list, default_normalization,
+                      per_channel, resolve_entry=None):
+  """Gets the clip and standard deviation values the data are normalized by.
+
+  The values are loaded from the stats file. With `compute_stats`, i.e. when
+  converting the training manifest, the file is computed from the windows of
+  the manifest if it does not exist.
+
+  Args:
+    file_list: Manifest entries the stats are computed from.
+    default_normalization: (clip, std) tuple used without a stats file.
+    per_channel: Whether the stats are computed per channel.
+    resolve_entry: Function mapping a manifest entry to the window it reads,
+      or to None if it has no window.
+
+  Returns:
+    (clip, std) tuple.
+
+  Raises:
+    ValueError: If the stats file does not exist and `compute_stats` is not
+      set.
+  """
+  if not params.stats_file:
+    return default_normalization
+  stats_file = os.path.join(datapath, params.stats_file)
+  if not os.path.exists(stats_file):
+    if not params.compute_stats:
+      raise ValueError(
+          'Normalization statistics file {} not found. Convert the training '
+          'manifest with compute_stats first.'.format(stats_file))
+    logging.info('Computing the normalization statistics: %s', stats_file)
+    if resolve_entry is not None:
+      file_list = [filename for filename in map(resolve_entry, file_list)
+                   if filename is not None]
+    stats = normalization_stats.compute_stats(
+        file_list, per_channel=per_channel, n_workers=params.num_workers,
+        start_method=START_METHOD)
+    os.makedirs(os.path.dirname(stats_file), exist_ok=True)
+    stats.save(stats_file)
+  else:
+    logging.info('Using the existing normalization statistics: %s',
+                 stats_file)
+  return normalization_stats.load_clip_and_std(stats_file,
+                                               params.clip_percentile)
+
+
+def get_shard_file(output_file_prefix, i, num_shards, file_suffix):
+  return '{}-{:04d}-of-{:04d}{}'.format(
+      output_file_prefix, i, num_shards, file_suffix)
+
+
+def convert_to_tfrecords(params, datapath, data_loader,
+                         default_normalization, per_channel,
+                         resolve_entry=None):
+  """Converts the windows of a manifest into TFRecord shards.
+
+  On a rerun with the same parameters, only the shards whose entries changed
+  are written again, see `build_state`.
+
+  Args:
+    params: Parsed arguments of `ArgumentParser`.
+    datapath: Directory the paths of `params` are relative to.
+    data_loader: `DataLoader` class of the converter.
+    default_normalization: (clip, std) tuple used without a stats file.
+    per_channel: Whether the normalization stats are computed per channel.
+    resolve_entry: Function mapping a manifest entry to the window it reads,
+      or to None if it has no window. Defaults to the entry itself.
+
+  Raises:
+    ValueError: If indexed shards are to be compressed.
+  """
+  manifest_file = os.path.join(datapath, params.manifest_file)
+  if not os.path.exists(manifest_file):
+    logging.info('Creating manifest file: %s', manifest_file)
+    if params.input_store_pattern:
+      create_manifest(manifest_file, os.path.join(
+          datapath, params.input_store_pattern), store=True)
+    else:
+      create_manifest(manifest_file, os.path.join(
+          datapath, params.input_file_pattern))
+  else:
+    logging.info('Using the existing manifest file: %s', manifest_file)
+
+  file_list = read_manifest(manifest_file)
+  normalization = get_normalization(params, datapath, file_list,
+                                    default_normalization, per_channel,
+                                    resolve_entry)
+  file_suffix = get_file_suffix(params.compression_type)
+  output_file_prefix = os.path.join(datapath, params.output_file_prefix)
+
+  if (params.write_index and
+      params.compression_type is not CompressionType.NONE):
+    raise ValueError('Indexed shards must be written uncompressed, with '
+                     '--compression_type "".')
+
+  os.makedirs(os.path.dirname(output_file_prefix), exist_ok=True)
+  state_file = build_state.get_state_file(output_file_prefix)
+  fingerprint = build_state.get_fingerprint({
+      'compression_type': params.compression_type.value,
+      'min_val': params.min_val,
+      'max_val': params.max_val,
+      'normalization': np.asarray(normalization).tolist(),
+      'num_shards': params.num_shards,
+      'target_shard_bytes': params.target_shard_bytes,
+      'examples_per_record': params.examples_per_record,
+      'write_index': params.write_index,
+  })
+  state = build_state.BuildState.load(state_file, fingerprint)
+  rebuild = state is not None
+  if not rebuild:
+    state = build_state.BuildState(fingerprint)
+  config = get_writer_config(params, data_loader, normalization)
+  # the inputs of a full build are hashed by the shard writers only
+  inputs = state.hash_inputs(file_list, resolve_entry)
+  if rebuild:
+    shard_files, shard_entries, hashes = _rebuild_shards(
+        state, inputs, file_list, output_file_prefix, file_suffix, params,
+        config)
+  elif params.target_shard_bytes or params.num_shards <= 0:
+    shard_files, shard_entries, hashes = _convert_to_sized_shards(
+        file_list, output_file_prefix, file_suffix, params, config)
+  else:
+    shard_files, shard_entries, hashes = _convert_to_shards(
+        file_list, output_file_prefix, file_suffix, params, config)
+  build_state.remove_stale_shards(
+      output_file_prefix, shard_files,
+      [get_file_suffix(compression_type)
+       for compression_type in CompressionType])
+  state.update_hashes(inputs, hashes)
+  state.record(shard_files, shard_entries, inputs)
+  state.save(state_file)
+
+
+def _rebuild_shards(state, inputs, file_list, output_file_prefix, file_suffix,
+                    params, config):
+  """Keeps the unchanged shards and writes the other entries in new shards.
+
+  Args:
+    config: `WriterConfig` of the shard writers.
+
+  Returns:
+    (shard files, shard entries, input hashes) tuple, with the hashes of the
+    inputs of the new shards.
+  """
+  plans = state.plan(file_list, inputs)
+  tmp_files = ['{}.rebuild{:04d}.tmp'.format(output_file_prefix, i)
+               for i in range(len(plans))]
+  tasks = [(tmp_file, plan.entries, config)
+           for tmp_file, plan in zip(tmp_files, plans) if plan.file is None]
+  logging.info('Rewriting %s of %s shards.', len(tasks), len(plans))
+  hashes = {}
+  for i, (_, count, shard_hashes) in enumerate(parallel.imap_bounded(
+      _write_shard, tasks, min(params.num_workers, len(tasks)),
+      start_method=START_METHOD)):
+    hashes.update(shard_hashes)
+    logging.info('Rewrote %s examples (%s of %s shards).', count, i + 1,
+                 len(tasks))
+
+  kept_files = set()
+  for tmp_file, plan in zip(tmp_files, plans):
+    if plan.file is not None:
+      record_index.move_shard(plan.file, tmp_file)
+      kept_files.add(plan.file)
+  shard_files = [
+      get_shard_file(output_file_prefix, i, len(plans), file_suffix)
+      for i in range(len(plans))]
+  build_state.replace_shards(
+      tmp_files, shard_files,
+      [shard['file'] for shard in state.shards
+       if shard['file'] not in kept_files])
+  return shard_files, [plan.entries for plan in plans], hashes
+
+
+def _convert_to_shards(file_list, output_file_prefix, file_suffix, params,
+                      config):
+  """Writes `num_shards` shards.
+
+  Args:
+    config: `WriterConfig` of the shard writers.
+
+  Returns:
+    (shard files, shard entries, input hashes) tuple.
+  """
+  file_shards = np.array_split(file_list, params.num_shards)
+  tasks = [
+      (get_shard_file(output_file_prefix, i, params.num_shards, file_suffix),
+       list(file_shard), config)
+      for i, file_shard in enumerate(file_shards)]
+  # the shards are independent, so they are written concurrently, each by a
+  # single worker, which gives the same files as writing them one by one
+  num_examples = 0
+  hashes = {}
+  for i, (tfrecord_file, count, shard_hashes) in enumerate(
+      parallel.imap_bounded(_write_shard, tasks,
+                            min(params.num_workers, len(tasks)),
+                            start_method=START_METHOD)):
+    num_examples += count
+    hashes.update(shard_hashes)
+    logging.info('Wrote %s examples to %s (%s of %s shards, %s examples).',
+                 count, tfrecord_file, i + 1, len(tasks), num_examples)
+  return [task[0] for task in tasks], [task[1] for task in tasks], hashes
+
+
+def _convert_to_sized_shards(file_list, output_file_prefix, file_suffix,
+                            params, config):
+  """Writes shards of about `target_shard_bytes` each.
+
+  The manifest is split into one contiguous part per worker. Each worker
+  streams its part into temporary shards, rolling over to a new shard once the
+  compressed output crosses the target size. The shards are then renamed in
+  manifest order, once their total number is known.
+
+  Args:
+    config: `WriterConfig` of the shard writers.
+
+  Returns:
+    (shard files, shard entries, input hashes) tuple.
+  """
+  target_shard_bytes = params.target_shard_bytes or _DEFAULT_SHARD_BYTES
+  num_parts = max(min(params.num_workers, len(file_list)), 1)
+  tasks = [
+      ('{}.part{:04d}'.format(output_file_prefix, i), list(file_part), config,
+       target_shard_bytes)
+      for i, file_part in enumerate(np.array_split(file_list, num_parts))]
+
+  shards = []
+  hashes = {}
+  num_examples = 0
+  for i, (part_shards, part_hashes) in enumerate(parallel.imap_bounded(
+      _write_sized_shards, tasks, num_parts, start_method=START_METHOD)):
+    shards.extend(part_shards)
+    hashes.update(part_hashes)
+    num_examples += sum(count for _, count, _ in part_shards)
+    logging.info('Wrote %s shards (%s of %s parts, %s examples).',
+                 len(part_shards), i + 1, num_parts, num_examples)
+
+  shard_files = []
+  for i, (tmp_file, count, _) in enumerate(shards):
+    tfrecord_file = get_shard_file(output_file_prefix, i, len(shards),
+                                   file_suffix)
+    record_index.move_shard(tmp_file, tfrecord_file)
+    shard_files.append(tfrecord_file)
+    logging.info('Wrote %s examples to %s.', count, tfrecord_file)
+  return shard_files, [entries for _, _, entries in shards], hashes
+
+
+def _write_shard(task):
+  """Writes the examples of a shard.
+
+  Entries for which `read_entry` of the data loader returns None are skipped.
+
+  Args:
+    task: (tfrecord_file, filenames, config) tuple, where config is a
+      `WriterConfig`.
+
+  Returns:
+    (tfrecord_file, number of examples, input hashes) tuple.
+  """
+  tfrecord_file, file_shard, config = task
+  options = tf.io.TFRecordOptions(
+      compression_type=config.compression_type.value)
+  data_loader = config.data_loader(*config.data_loader_args)
+  count = 0
+  hashes = {}
+  index_writer = None
+  with tf.io.TFRecordWriter(tfrecord_file, options=options) as writer:
+    if config.write_index:
+      writer = index_writer = record_index.RecordIndexWriter(writer)
+    packed_writer = serialization.PackedWriter(writer,
+                                               config.examples_per_record)
+    # the next windows are read in background threads while the current one
+    # is compressed, in manifest order
+    examples = parallel.prefetch(data_loader.read_entry, file_shard,
+                                 *config.read_ahead)
+    for entry, example in zip(file_shard, examples):
+      if example is None:
+        continue
+      inputs, outputs, hashes[entry] = example
+      packed_writer.write(inputs, outputs)
+      if index_writer is not None:
+        index_writer.add_example(entry, outputs)
+      count += 1
+    packed_writer.flush()
+  _save_index(index_writer, tfrecord_file, config.examples_per_record)
+  return tfrecord_file, count, hashes
+
+
+def _write_sized_shards(task):
+  """Writes the examples of a part of the manifest into shards of about
+  `target_shard_bytes` each.
+
+  Args:
+    task: (tmp_file_prefix, filenames, config, target_shard_bytes) tuple,
+      where config is a `WriterConfig`.
+
+  Returns:
+    (shards, input hashes) tuple, where shards is a list of (temporary shard
+    file, number of examples, entries) tuples.
+  """
+  tmp_file_prefix, file_part, config, target_shard_bytes = task
+  options = tf.io.TFRecordOptions(
+      compression_type=config.compression_type.value)
+  data_loader = config.data_loader(*config.data_loader_args)
+  shards = []
+  hashes = {}
+  # entries read since the last one assigned to a shard
+  entries = []
+  writer = None
+  try:
+    examples = parallel.prefetch(data_loader.read_entry, file_part,
+                                 *config.read_ahead)
+    for entry, example in zip(file_part, examples):
+      entries.append(entry)
+      if example is None:
+        continue
+      if writer is None:
+        shards.append(
+            ['{}-{:04d}.tmp'.format(tmp_file_prefix, len(shards)), 0, []])
+        writer = tf.io.TFRecordWriter(shards[-1][0], options=options)
+        index_writer = (record_index.RecordIndexWriter(writer)
+                        if config.write_index else None)
+        counting_writer = index_writer or record_index.CountingWriter(writer)
+        packed_writer = serialization.PackedWriter(
+            counting_writer, config.examples_per_record)
+      shards[-1][2].extend(entries)
+      entries = []
+      inputs, outputs, hashes[entry] = example
+      packed_writer.write(inputs, outputs)
+      if index_writer is not None:
+        index_writer.add_example(entry, outputs)
+      shards[-1][1] += 1
+      if _get_shard_bytes(shards[-1][0], counting_writer,
+                          config.compression_type) >= target_shard_bytes:
+        packed_writer.flush()
+        writer.close()
+        writer = None
+        _save_index(index_writer, shards[-1][0], config.examples_per_record)
+    if writer is not None:
+      packed_writer.flush()
+      writer.close()
+      writer = None
+      _save_index(index_writer, shards[-1][0], config.examples_per_record)
+  finally:
+    if writer is not None:
+      writer.close()
+  if shards:
+    shards[-1][2].extend(entries)
+  return [tuple(shard) for shard in shards], hashes
+
+
+def _get_shard_bytes(tfrecord_file, counting_writer, compression_type):
+  """Gets the size of a shard being written.
+
+  The size of an uncompressed shard is counted exactly. The compressed size is
+  only known from the file, which trails the output by the data still
+  buffered in the writer.
+  """
+  if compression_type is CompressionType.NONE:
+    return counting_writer.num_bytes
+  return tf.io.gfile.stat(tfrecord_file).length
+
+
+def _save_index(index_writer, tfrecord_file, examples_per_record):
+  if index_writer is not None:
+    index_writer.save(record_index.get_index_file(tfrecord_file),
+                      examples_per_record)
+
+
+class ArgumentParser():
+  """Parser of the converter flags.
+
+  Args:
+    clip_percentile: Default percentile of the absolute values the data are
+      clipped to, i.e. that of the built-in normalization values of the
+      converter.
+  """
+
+  def __init__(self, clip_percentile):
+    config_parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        add_help=False)
+
+    config_parser.add_argument(
+        '-c', '--config-file',
+        help='Parse script arguments from config file.',
+        default=None,
+        metavar='FILE')
+
+    self._config_parser = config_parser
+
+    self._parser = argparse.ArgumentParser(parents=[config_parser])
+    self._clip_percentile = clip_percentile
+
+  @ staticmethod
+  def _parse_config(items):
+    argv = []
+    for k, v in items:
+      argv.append('--{}'.format(k))
+      argv.append(v)
+    return argv
+
+  def _add_arguments(self, defaults=None):
+    parser = self._parser
+
+    parser.add_argument(
+        '--input_file_pattern',
+        help='Input data files.',
+        default='',
+    )
+    parser.add_argument(
+        '--input_store_pattern',
+        help='Input window store files. Takes precedence over '
+        'input_file_pattern.',
+        default='',
+    )
+    parser.add_argument(
+        '--output_file_prefix',
+        help='Output file prefix.',
+        default='tfrecords/',
+    )
+    parser.add_argument(
+        '--input_height',
+        help='Input data height.',
+        type=int,
+    )
+    parser.add_argument(
+        '--input_width',
+        help='Input data width.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--input_depth',
+        help='Input data depth.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--input_channels',
+        help='Input data channels.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--num_shards',
+        help='Number of shards to generate.',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--target_shard_bytes',
+        help='Target size of the shards. Takes precedence over num_shards, '
+        'and defaults to 100 MB if num_shards is not set.',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--examples_per_record',
+        help='Number of examples packed into each record.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--write_index',
+        help='Write an index of the record offsets next to each shard, for '
+        'random access. Requires uncompressed shards.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--num_workers',
+        help='Number of processes writing shards concurrently.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--read_workers',
+        help='Number of threads per process reading the next windows while '
+        'the current one is written. With no threads, reading and writing '
+        'run in sequence.',
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        '--prefetch_depth',
+        help='Maximum number of windows read ahead of the one being written.',
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        '--compression_type',
+        help='File compression type.',
+        type=CompressionType,
+        choices=list(CompressionType),
+        default=CompressionType.GZIP,
+    )
+    parser.add_argument(
+        '--manifest_file',
+        help='Manifest file.',
+        default='tfrecords/manifests/manifest.txt',
+    )
+    parser.add_argument(
+        '--stats_file',
+        help='Normalization statistics file. Defaults to the built-in '
+        'values.',
+        default='',
+    )
+    parser.add_argument(
+        '--compute_stats',
+        help='Compute the normalization statistics file from the manifest if '
+        'it does not exist. Set for the training manifest only.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--clip_percentile',
+        help='Percentile of the absolute values the data are clipped to.',
+        type=float,
+        default=self._clip_percentile,
+    )
+    parser.add_argument(
+        '--min_val',
+        help='Minimum value.',
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '--max_val',
+        help='Maximum value.',
+        type=float,
+        default=1.0,
+    )
+
+  def parse_known_args(self, argv):
+    args, remaining_argv = self._config_parser.parse_known_args(argv)
+    if args.config_file:
+      with open(args.config_file, 'r') as config:
+        defaults = yaml.safe_load(config)
+      defaults['config_file'] = args.config_file
+    else:
+      defaults = dict()
+    self._add_arguments(defaults=defaults)
+    self._parser.set_defaults(**defaults)
+
+    return self._parser.parse_known_args(remaining_argv)